@@ -1,4 +1,5 @@
 # 请求/响应模型（Pydantic）
+from datetime import datetime
 from pydantic import BaseModel
 from typing import List, Optional
 
@@ -13,21 +14,62 @@ class UploadResponse(BaseModel):
 class DocumentStatusResponse(BaseModel):
     status: str  # API调用状态: 'success' 或 'error'
     filename: str
-    processing_status: str  # 文档处理状态: pending, extracting, chunking, embedding, indexing, completed, failed
+    processing_status: str  # 文档处理状态: pending, extracting, chunking, embedding, indexing, partial, completed, failed
     progress: int = 0  # 处理进度 0-100
     chunks_count: Optional[int] = None  # 已处理的块数
     error: Optional[str] = None  # 如果失败，包含错误信息
+    embedding_cache_hits: int = 0  # 导入时命中嵌入缓存、无需调用嵌入接口的块数
+    embedding_cache_misses: int = 0  # 导入时需要调用嵌入接口的块数
+    pending_chunks: int = 0  # 嵌入失败、在重试队列中尚未写入索引的块数
+
+
+class SearchFilter(BaseModel):
+    """检索范围过滤条件，各条件之间为 AND 关系"""
+
+    sources: Optional[List[str]] = None  # 文档文件名
+    file_types: Optional[List[str]] = None  # 文件扩展名，如 pdf、docx
+    page_from: Optional[int] = None  # 页码范围（含两端）
+    page_to: Optional[int] = None
+    uploaded_after: Optional[datetime] = None  # 写入时间范围（含两端）
+    uploaded_before: Optional[datetime] = None
 
 
 class QueryRequest(BaseModel):
     query: str
     top_k: Optional[int] = None  # 允许在查询时覆盖默认的 top_k
+    nprobe: Optional[int] = None  # IVF 索引探测的聚类数，用于在召回率和延迟之间取舍
+    ef_search: Optional[int] = None  # HNSW 索引的 efSearch 参数
+    filter: Optional[SearchFilter] = None  # 只在满足条件的文档块中检索
+    score_threshold: Optional[float] = None  # 相关性阈值，cosine 度量下为最低相似度
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    top_k: Optional[int] = None
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    filter: Optional[SearchFilter] = None
+    score_threshold: Optional[float] = None
+
+
+class SearchHit(BaseModel):
+    filename: str
+    page_content: str
+    metadata: Optional[dict] = None
+    score: float  # cosine 度量下为余弦相似度，l2 度量下为 L2 距离
+
+
+class BatchSearchResponse(BaseModel):
+    status: str
+    metric: str  # cosine 或 l2，决定 score 的含义
+    results: List[List[SearchHit]]  # 与请求中 queries 顺序一致
 
 
 class SourceDocument(BaseModel):
     filename: str
     page_content: str  # 或者 chunk_content，取决于你的数据结构
     metadata: Optional[dict] = None  # 例如，页码、块 ID 等
+    score: Optional[float] = None  # 检索分数，cosine 度量下为余弦相似度
 
 
 class QueryResponse(BaseModel):
@@ -1,14 +1,17 @@
 # 路由注册
+import asyncio
 import json
 import os
+import time
 import traceback
 from datetime import datetime
 
 # 直接在Python中定义ProcessingStatus枚举
 # 这样可以避免从 TypeScript 文件导入的问题
 from enum import Enum
+from typing import Optional
 
-from config import MAX_UPLOAD_SIZE_MB, TOP_K_RESULTS
+from config import EMBEDDING_RETRY_POLL_SECONDS, MAX_UPLOAD_SIZE_MB, TOP_K_RESULTS
 from fastapi import (
     APIRouter,
     BackgroundTasks,
@@ -16,6 +19,8 @@ from fastapi import (
     Depends,
     File,
     HTTPException,
+    Query,
+    Response,
     UploadFile,
 )
 from fastapi.responses import FileResponse, StreamingResponse
@@ -33,19 +38,34 @@ from services.document_storage import (
     save_document_info,
     update_document_status,
 )
+from services.chunk_store import ChunkFilter
+from services.embedding import (
+    get_embedding_model,
+    get_query_batcher,
+    get_query_cache,
+    get_retry_after_remaining,
+)
+from services.answer_cache import get_answer_cache
+from services.http_clients import http_client_stats
+from services.metrics import REGISTRY
 from services.rag import query_rag_pipeline, query_rag_pipeline_stream
+from services.tracing import start_trace
 from services.vector_store import FAISSVectorStore, get_vector_store
 
 from .auth import router as auth_router
 from .models import (
     AskRequest,
     AskResponse,
+    BatchSearchRequest,
+    BatchSearchResponse,
     DocumentListResponse,
     DocumentMetadata,
     DocumentStatusResponse,
     HealthResponse,
     QueryRequest,
     QueryResponse,
+    SearchFilter,
+    SearchHit,
     UploadResponse,
 )
 
@@ -56,6 +76,7 @@ class ProcessingStatus(str, Enum):
     CHUNKING = "chunking"
     EMBEDDING = "embedding"
     INDEXING = "indexing"
+    PARTIAL = "partial"  # 部分文档块嵌入失败，正在重试队列中等待写入索引
     COMPLETED = "completed"
     FAILED = "failed"
 
@@ -65,12 +86,54 @@ router = APIRouter()
 # 包含认证路由
 router.include_router(auth_router)
 
+UPLOAD_SIZE_BYTES = REGISTRY.histogram(
+    "document_upload_size_bytes",
+    "已接收的上传文件大小（字节，按文件扩展名）",
+    ("file_type",),
+    buckets=tuple(1024 * 4**power for power in range(10)),  # 1KB ~ 256MB
+)
+UPLOAD_REJECTED = REGISTRY.counter(
+    "document_upload_rejected_total", "被拒绝的上传请求数（按原因）", ("reason",)
+)
+INGEST_STAGE_SECONDS = REGISTRY.histogram(
+    "ingest_stage_duration_seconds",
+    "后台文档处理各阶段耗时（秒）：load 加载、split 分块、index 嵌入并写入索引",
+    ("stage",),
+)
+SSE_STREAM_SECONDS = REGISTRY.histogram(
+    "sse_stream_duration_seconds",
+    "流式问答 SSE 响应从开始到结束的时长（秒，按结束方式）",
+    ("outcome",),
+)
+
 
 # Dependency to get the vector store instance
 def get_vector_db() -> FAISSVectorStore:
     return get_vector_store()
 
 
+def to_chunk_filter(search_filter: Optional[SearchFilter]) -> Optional[ChunkFilter]:
+    """把请求中的过滤条件转换为文档块存储的过滤条件"""
+    if search_filter is None:
+        return None
+    return ChunkFilter(
+        sources=search_filter.sources,
+        file_types=search_filter.file_types,
+        page_from=search_filter.page_from,
+        page_to=search_filter.page_to,
+        uploaded_after=(
+            search_filter.uploaded_after.timestamp()
+            if search_filter.uploaded_after
+            else None
+        ),
+        uploaded_before=(
+            search_filter.uploaded_before.timestamp()
+            if search_filter.uploaded_before
+            else None
+        ),
+    )
+
+
 @router.post("/upload_doc/", response_model=UploadResponse)
 async def upload_document_route(
     background_tasks: BackgroundTasks, file: UploadFile = File(...)
@@ -96,6 +159,7 @@ async def upload_document_route(
         # 检查文件大小限制
         max_size_bytes = MAX_UPLOAD_SIZE_MB * 1024 * 1024  # 转换为字节
         if file_size > max_size_bytes:
+            UPLOAD_REJECTED.labels("too_large").inc()
             raise HTTPException(
                 status_code=413,
                 detail=f"文件大小超过限制。最大允许大小: {MAX_UPLOAD_SIZE_MB}MB，当前文件大小: {file_size / 1024 / 1024:.2f}MB",
@@ -105,6 +169,8 @@ async def upload_document_route(
         print("开始保存文件到磁盘...")
         saved_file_path = await save_uploaded_file(safe_filename, content)
         print(f"原始文件已保存到: {saved_file_path}")
+        file_type = os.path.splitext(safe_filename)[1].lstrip(".").lower() or "unknown"
+        UPLOAD_SIZE_BYTES.labels(file_type).observe(file_size)
 
         # 2. 创建文档记录，状态设为处理中
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -157,7 +223,8 @@ async def process_document_async(file_path: str, filename: str):
         # 2. 加载文档
         print(f"开始加载文档: {filename}")
         try:
-            docs = load_document(file_path)
+            with INGEST_STAGE_SECONDS.labels("load").time():
+                docs = await asyncio.to_thread(load_document, file_path)
             print(f"文档加载完成，获得 {len(docs)} 个文档片段")
         except ValueError as ve:
             # 处理扫描版PDF的特定错误
@@ -190,7 +257,8 @@ async def process_document_async(file_path: str, filename: str):
         update_document_status(filename, ProcessingStatus.CHUNKING, progress=30)
 
         # 4. 分割文档
-        chunks = split_documents(docs)
+        with INGEST_STAGE_SECONDS.labels("split").time():
+            chunks = await asyncio.to_thread(split_documents, docs)
         if not chunks:
             update_document_status(
                 filename,
@@ -204,15 +272,20 @@ async def process_document_async(file_path: str, filename: str):
         update_document_status(filename, ProcessingStatus.EMBEDDING, progress=50)
 
         # 6. 生成嵌入并添加到向量存储
-        chunks_added_count = db.add_documents(chunks)
+        ingest_stats = {}
+        with INGEST_STAGE_SECONDS.labels("index").time():
+            chunks_added_count = await db.aadd_documents(
+                chunks, document_id=filename, ingest_stats=ingest_stats
+            )
 
-        if chunks_added_count > 0:
-            # 7. 更新状态为已完成
-            update_document_status(
+        if chunks_added_count > 0 or ingest_stats.get("embedding_failed"):
+            # 7. 更新状态为已完成；有文档块进入重试队列时为部分完成
+            update_embedding_progress(
+                db,
                 filename,
-                ProcessingStatus.COMPLETED,
-                progress=100,
-                chunks_count=chunks_added_count,
+                chunks_added_count,
+                embedding_cache_hits=ingest_stats.get("cache_hits"),
+                embedding_cache_misses=ingest_stats.get("cache_misses"),
             )
             print(
                 f"成功为文件 {filename} 添加了 {chunks_added_count} 个文本块到向量数据库。"
@@ -233,6 +306,78 @@ async def process_document_async(file_path: str, filename: str):
         )
 
 
+def update_embedding_progress(
+    db: FAISSVectorStore, filename: str, chunks_count: int, **stats
+):
+    """
+    按已写入索引的块数和重试队列中的块数更新文档状态：
+    没有待重试的块时为 completed，否则为 partial，进度为已写入索引的块占比。
+    """
+    pending, abandoned = db.retry_queue.document_counts(filename)
+    if not pending and not abandoned:
+        update_document_status(
+            filename,
+            ProcessingStatus.COMPLETED,
+            progress=100,
+            chunks_count=chunks_count,
+            pending_chunks=0,
+            error="",
+            **stats,
+        )
+        return
+    if abandoned:
+        error = f"{abandoned} 个文档块多次重试后仍未能生成嵌入，未写入索引"
+    else:
+        error = f"{pending} 个文档块嵌入生成失败，已加入重试队列，稍后自动写入索引"
+    update_document_status(
+        filename,
+        ProcessingStatus.PARTIAL,
+        progress=int(100 * chunks_count / (chunks_count + pending + abandoned)),
+        chunks_count=chunks_count,
+        pending_chunks=pending + abandoned,
+        error=error,
+        **stats,
+    )
+
+
+async def embedding_retry_worker(poll_interval: float = EMBEDDING_RETRY_POLL_SECONDS):
+    """
+    后台重试嵌入失败的文档块，写入索引后更新所属文档的状态。
+
+    由应用生命周期启动；队列为空时按 poll_interval 轮询，有条目时等到最早的条目到期，
+    服务端要求 Retry-After 时不早于该时间。
+    """
+    print("嵌入重试任务已启动。")
+    while True:
+        delay = poll_interval
+        try:
+            db = get_vector_store()
+            if get_embedding_model().is_available():
+                added = await db.aretry_pending()
+                for filename, count in added.items():
+                    # 逐个文档更新，单个文档出错不影响其余文档的进度
+                    try:
+                        doc_info = get_document_info(filename)
+                        if doc_info is not None:
+                            # 上传流程尚未写入最终块数时 chunks_count 为 None
+                            update_embedding_progress(
+                                db, filename, (doc_info.chunks_count or 0) + count
+                            )
+                    except Exception as e:
+                        print(f"更新文档 {filename} 的嵌入进度时出错: {e}")
+                        traceback.print_exc()
+            next_due = await asyncio.to_thread(db.retry_queue.next_due_in)
+            if next_due is not None:
+                delay = min(delay, next_due)
+            delay = max(delay, get_retry_after_remaining() or 0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"嵌入重试任务出错: {e}")
+            traceback.print_exc()
+        await asyncio.sleep(delay)
+
+
 @router.get("/document_status/{filename}", response_model=DocumentStatusResponse)
 async def get_document_status_route(filename: str):
     """
@@ -249,13 +394,17 @@ async def get_document_status_route(filename: str):
         progress=doc_info.progress,
         chunks_count=doc_info.chunks_count,
         error=doc_info.error,
+        embedding_cache_hits=doc_info.embedding_cache_hits,
+        embedding_cache_misses=doc_info.embedding_cache_misses,
+        pending_chunks=doc_info.pending_chunks,
     )
 
 
 @router.post("/query", response_model=QueryResponse)
-async def query_route(request: QueryRequest = Body(...)):
+async def query_route(response: Response, request: QueryRequest = Body(...)):
     """
     接收用户查询，通过 RAG 流程生成答案并返回。
+    各阶段耗时通过 Server-Timing 响应头返回。
     """
     if not request.query or not request.query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空。")
@@ -265,9 +414,19 @@ async def query_route(request: QueryRequest = Body(...)):
             f"接收到查询请求: '{request.query[:100]}...', top_k: {request.top_k or TOP_K_RESULTS}"
         )
         # top_k 可以从请求中获取，如果未提供则使用配置中的默认值
+        trace = start_trace()
         result = await query_rag_pipeline(
-            request.query, top_k=request.top_k or TOP_K_RESULTS
+            request.query,
+            top_k=request.top_k or TOP_K_RESULTS,
+            nprobe=request.nprobe,
+            ef_search=request.ef_search,
+            metadata_filter=to_chunk_filter(request.filter),
+            score_threshold=request.score_threshold,
+            trace=trace,
         )
+        if trace.enabled:
+            trace.finish("query")
+            response.headers["Server-Timing"] = trace.server_timing()
 
         # query_rag_pipeline 返回的是一个字典，包含 answer 和 sources
         # QueryResponse 模型期望 answer 是字符串，sources 是 SourceDocument 列表
@@ -293,13 +452,22 @@ async def query_stream_route(request: QueryRequest = Body(...)):
         raise HTTPException(status_code=400, detail="查询内容不能为空。")
 
     async def generate_stream():
+        started = time.perf_counter()
+        # 客户端提前断开时生成器被关闭，不会走到正常结束或异常分支
+        outcome = "disconnected"
         try:
             print(
                 f"接收到流式查询请求: '{request.query[:100]}...', top_k: {request.top_k or TOP_K_RESULTS}"
             )
 
             async for chunk in query_rag_pipeline_stream(
-                request.query, top_k=request.top_k or TOP_K_RESULTS
+                request.query,
+                top_k=request.top_k or TOP_K_RESULTS,
+                nprobe=request.nprobe,
+                ef_search=request.ef_search,
+                metadata_filter=to_chunk_filter(request.filter),
+                score_threshold=request.score_threshold,
+                trace=start_trace(),
             ):
                 # 将每个数据块转换为SSE格式，处理SourceDocument序列化
                 if chunk.get("type") == "sources" and "sources" in chunk:
@@ -326,17 +494,21 @@ async def query_stream_route(request: QueryRequest = Body(...)):
                 yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
 
             # 发送结束信号
+            outcome = "completed"
             yield "data: [DONE]\n\n"
 
         except Exception as e:
             print(f"处理流式查询 '{request.query[:100]}...' 时发生意外错误: {e}")
             traceback.print_exc()
+            outcome = "error"
             error_chunk = {
                 "type": "error",
                 "content": f"处理查询时发生内部服务器错误。错误详情: {str(e)}",
             }
             yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
             yield "data: [DONE]\n\n"
+        finally:
+            SSE_STREAM_SECONDS.labels(outcome).observe(time.perf_counter() - started)
 
     return StreamingResponse(
         generate_stream(),
@@ -351,6 +523,50 @@ async def query_stream_route(request: QueryRequest = Body(...)):
     )
 
 
+# 批量检索接口：只检索不生成答案，用于评测任务和批量 FAQ
+@router.post("/search/batch", response_model=BatchSearchResponse)
+def search_batch_route(
+    request: BatchSearchRequest = Body(...),
+    db: FAISSVectorStore = Depends(get_vector_db),
+):
+    """
+    对多个查询一次生成嵌入并执行一次矩阵检索，按请求顺序返回每个查询的命中文档块。
+    """
+    if not request.queries or any(not q or not q.strip() for q in request.queries):
+        raise HTTPException(status_code=400, detail="查询列表不能为空，且每个查询内容不能为空。")
+
+    try:
+        print(f"接收到批量检索请求: {len(request.queries)} 个查询")
+        batch_results = db.search_batch(
+            request.queries,
+            k=request.top_k or TOP_K_RESULTS,
+            nprobe=request.nprobe,
+            ef_search=request.ef_search,
+            metadata_filter=to_chunk_filter(request.filter),
+            score_threshold=request.score_threshold,
+        )
+        return BatchSearchResponse(
+            status="success",
+            metric=db.metric,
+            results=[
+                [
+                    SearchHit(
+                        filename=doc.metadata.get("source", "未知来源"),
+                        page_content=doc.page_content,
+                        metadata=doc.metadata,
+                        score=score,
+                    )
+                    for doc, score in query_results
+                ]
+                for query_results in batch_results
+            ],
+        )
+    except Exception as e:
+        print(f"批量检索时发生错误: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"批量检索时发生错误: {str(e)}")
+
+
 # 新增：基于文档的问答接口
 @router.post("/ask/", response_model=AskResponse)
 async def ask_route(
@@ -367,28 +583,38 @@ async def ask_route(
             f"接收到文档问答请求: '{request.question[:100]}...', 文档ID: {request.documentId or '未指定'}"
         )
 
-        # 如果指定了文档ID，检查文档是否存在
+        # 如果指定了文档ID，检查文档是否存在，并把检索范围限定在该文档内
+        metadata_filter = None
         if request.documentId:
-            documents = get_all_documents()
-            document_exists = any(
-                doc.filename == request.documentId for doc in documents
+            target_doc = next(
+                (
+                    doc
+                    for doc in get_all_documents()
+                    if doc.filename == request.documentId
+                ),
+                None,
             )
-            if not document_exists:
+            if target_doc is None:
                 raise HTTPException(
                     status_code=404, detail=f"找不到指定的文档: {request.documentId}"
                 )
+            # 旧数据的文档块以保存后的文件名作为标识
+            metadata_filter = ChunkFilter(
+                sources=list(
+                    {request.documentId, os.path.basename(target_doc.file_path)}
+                )
+            )
 
         # 获取回答
-        result = await query_rag_pipeline(request.question, top_k=TOP_K_RESULTS)
+        result = await query_rag_pipeline(
+            request.question, top_k=TOP_K_RESULTS, metadata_filter=metadata_filter
+        )
 
-        # 如果指定了文档ID，过滤源文档
         source_filenames = []
         if result["sources"]:
             for source in result["sources"]:
-                filename = source.filename
-                if not request.documentId or filename == request.documentId:
-                    if filename not in source_filenames:
-                        source_filenames.append(filename)
+                if source.filename not in source_filenames:
+                    source_filenames.append(source.filename)
 
         return AskResponse(answer=result["answer"], sources=source_filenames)
 
@@ -451,6 +677,74 @@ async def get_vector_store_size_route(db: FAISSVectorStore = Depends(get_vector_
         )
 
 
+# 压缩存储的内存节省与召回率报告
+@router.get("/vector_store/compression_report", response_model=dict)
+def get_compression_report_route(
+    k: int = Query(10, ge=1), db: FAISSVectorStore = Depends(get_vector_db)
+):
+    """
+    报告当前索引相对 float32 flat 基线节省的内存，以及压缩前后/重排后的 recall@k。
+    """
+    try:
+        report = db.compression_report(k)
+        return {"status": "success", "report": report}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"生成压缩报告时出错: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"生成压缩报告时发生错误: {str(e)}")
+
+
+# 查询向量缓存命中率
+@router.get("/embedding/query_cache", response_model=dict)
+async def get_query_cache_stats_route():
+    """
+    返回查询向量 LRU 缓存的条目数、容量、命中/未命中次数和命中率，以及查询微批处理的合并情况。
+    """
+    return {
+        "status": "success",
+        "stats": get_query_cache().stats(),
+        "batcher": get_query_batcher().stats(),
+    }
+
+
+# 语义答案缓存命中率
+@router.get("/answer_cache", response_model=dict)
+async def get_answer_cache_stats_route():
+    """
+    返回答案缓存的条目数、对应的索引版本、命中/未命中次数、命中率和因索引更新而整体失效的次数。
+    """
+    return {"status": "success", "stats": get_answer_cache().stats()}
+
+
+# 检索结果缓存命中率
+@router.get("/retrieval_cache", response_model=dict)
+async def get_retrieval_cache_stats_route(db: FAISSVectorStore = Depends(get_vector_db)):
+    """
+    返回检索结果缓存的条目数、容量、对应的索引版本、命中/未命中次数和命中率。
+    """
+    return {"status": "success", "stats": db.retrieval_cache.stats()}
+
+
+# 嵌入请求调度状态
+@router.get("/embedding/scheduler", response_model=dict)
+async def get_embedding_scheduler_stats_route():
+    """
+    返回嵌入调度器的令牌桶、在途请求数，以及查询/导入两条通道的队列深度和等待时间（秒）。
+    """
+    return {"status": "success", "stats": get_embedding_model().get_scheduler().stats()}
+
+
+# 共享 HTTP 连接池状态
+@router.get("/http_clients", response_model=dict)
+async def get_http_client_stats_route():
+    """
+    返回 LLM 与嵌入服务连接池的请求数、新建连接数、TLS 握手数和连接复用率。
+    """
+    return {"status": "success", "stats": http_client_stats()}
+
+
 # 添加POST方法路由以兼容前端
 @router.post("/vector_store_size", response_model=dict)
 async def post_vector_store_size_route(db: FAISSVectorStore = Depends(get_vector_db)):
@@ -483,17 +777,12 @@ async def delete_document_route(
         # 3. 删除元数据
         delete_document(filename)
 
-        # 4. 重置向量存储（由于FAISS不支持删除单个文档，我们需要重建索引）
-        db.reset_index()
-
-        # 5. 重新添加其他文档到向量存储
-        remaining_docs = [doc for doc in documents if doc.filename != filename]
-        for doc in remaining_docs:
-            if os.path.exists(doc.file_path):
-                docs = load_document(doc.file_path)
-                if docs:
-                    chunks = split_documents(docs)
-                    db.add_documents(chunks)
+        # 4. 按 chunk ID 从向量存储中删除该文档的向量，无需重建索引
+        removed_count = db.remove_document(filename)
+        if removed_count == 0:
+            # 旧索引中的文档块只记录了磁盘上的文件名
+            removed_count = db.remove_document(os.path.basename(target_doc.file_path))
+        print(f"已从向量存储删除文档 {filename} 的 {removed_count} 个文档块")
 
         return {"status": "success", "message": f"文档 {filename} 已成功删除"}
 
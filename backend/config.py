@@ -67,3 +67,83 @@ print(f"[Config] MAX_UPLOAD_SIZE_MB: {MAX_UPLOAD_SIZE_MB}")
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 800))  # 默认块大小为1000
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))  # 默认块重叠为200
 TOP_K_RESULTS = int(os.getenv("TOP_K_RESULTS", 5))  # 检索时默认返回前5个相关结果
+
+# 向量索引配置
+# 索引类型: flat（精确暴力检索）/ ivf_flat / ivf_pq / hnsw
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat").lower()
+# 当向量数超过该阈值时，后台训练并切换到 VECTOR_INDEX_TYPE 指定的近似索引
+VECTOR_INDEX_PROMOTE_THRESHOLD = int(os.getenv("VECTOR_INDEX_PROMOTE_THRESHOLD", 50000))
+IVF_NLIST = int(os.getenv("IVF_NLIST", 0))  # 0 表示根据向量数自动估算
+IVF_PQ_M = int(os.getenv("IVF_PQ_M", 64))  # PQ 子向量个数（需整除维度，不整除时自动下调）
+IVF_PQ_NBITS = int(os.getenv("IVF_PQ_NBITS", 8))
+HNSW_M = int(os.getenv("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+DEFAULT_NPROBE = int(os.getenv("DEFAULT_NPROBE", 16))  # IVF 查询时探测的聚类数
+DEFAULT_EF_SEARCH = int(os.getenv("DEFAULT_EF_SEARCH", 64))  # HNSW 查询时的候选队列长度
+print(
+    f"[Config] VECTOR_INDEX_TYPE: {VECTOR_INDEX_TYPE}, 切换阈值: {VECTOR_INDEX_PROMOTE_THRESHOLD}"
+)
+# 以内存映射方式只读打开索引文件（读多写少的部署），首次写入时才完整加载到内存
+VECTOR_INDEX_MMAP = os.getenv("VECTOR_INDEX_MMAP", "false").lower() in ("1", "true", "yes")
+# 预写日志超过该大小（字节）时立即触发检查点，把日志合并进新的索引快照
+VECTOR_WAL_CHECKPOINT_BYTES = int(os.getenv("VECTOR_WAL_CHECKPOINT_BYTES", 64 * 1024 * 1024))
+# 有未合并写入时，两次检查点之间的最长间隔（秒）
+VECTOR_CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("VECTOR_CHECKPOINT_INTERVAL_SECONDS", 60))
+# 向量存储精度: float32（原始精度）/ fp16 / sq8（8 位标量量化）/ pq（乘积量化）
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "float32").lower()
+# 压缩存储时，是否在磁盘上保留全精度向量副本，用于对候选结果做精确重排
+VECTOR_KEEP_FULL_PRECISION = os.getenv("VECTOR_KEEP_FULL_PRECISION", "true").lower() in ("1", "true", "yes")
+# 重排时先取 k * VECTOR_RERANK_FACTOR 个候选
+VECTOR_RERANK_FACTOR = int(os.getenv("VECTOR_RERANK_FACTOR", 4))
+# 新建索引的距离度量: l2 / cosine（归一化后用内积检索，分数为 [-1, 1] 的余弦相似度）
+# 默认 l2 与已有索引一致；已有索引沿用其自身的度量，切换需停止服务后运行 migrate_vector_metric.py
+VECTOR_METRIC = os.getenv("VECTOR_METRIC", "l2").lower()
+# 默认相关性阈值：cosine 度量下为最低相似度，l2 度量下为最大距离；未设置时不过滤
+_score_threshold = os.getenv("RETRIEVAL_SCORE_THRESHOLD")
+RETRIEVAL_SCORE_THRESHOLD = float(_score_threshold) if _score_threshold else None
+# 元数据过滤检索：候选文档块不超过该数量时直接精确计算距离，否则在索引上按 ID 过滤检索
+VECTOR_FILTER_EXACT_THRESHOLD = int(os.getenv("VECTOR_FILTER_EXACT_THRESHOLD", 4096))
+# 按 ID 过滤检索时 nprobe / efSearch / 候选数的最大放大倍数
+VECTOR_FILTER_MAX_OVERSAMPLE = int(os.getenv("VECTOR_FILTER_MAX_OVERSAMPLE", 32))
+# 嵌入向量持久化缓存（按模型、嵌入类型和文本 sha256 寻址），重复导入或重建索引时不再调用嵌入接口
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(VECTOR_DB_PATH), "embedding_cache.db")
+)
+# 缓存条目数上限，超出时淘汰最久未使用的记录；0 表示禁用缓存
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 500000))
+# 缓存有效期（天），0 表示不过期
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_DAYS", 0)) * 86400 or None
+# 本地嵌入后端（EMBEDDING_BACKEND=local）：推理线程数与每次前向计算的批大小
+EMBEDDING_LOCAL_WORKERS = int(os.getenv("EMBEDDING_LOCAL_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+EMBEDDING_LOCAL_BATCH_SIZE = int(os.getenv("EMBEDDING_LOCAL_BATCH_SIZE", 32))
+# 本地模型运行设备，例如 cpu / cuda
+EMBEDDING_LOCAL_DEVICE = os.getenv("EMBEDDING_LOCAL_DEVICE", "cpu")
+# 嵌入失败的文档块不写入索引，持久化到重试队列，由后台任务按指数退避（带随机抖动）重试
+EMBEDDING_RETRY_BASE_DELAY_SECONDS = float(os.getenv("EMBEDDING_RETRY_BASE_DELAY_SECONDS", 30))
+EMBEDDING_RETRY_MAX_DELAY_SECONDS = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY_SECONDS", 1800))
+# 超过该次数仍失败的文档块不再自动重试，保留在队列中并在文档状态中报告
+EMBEDDING_RETRY_MAX_ATTEMPTS = int(os.getenv("EMBEDDING_RETRY_MAX_ATTEMPTS", 10))
+# 后台任务每轮最多重试的文档块数，以及没有到期条目时的最长轮询间隔（秒）
+EMBEDDING_RETRY_BATCH_SIZE = int(os.getenv("EMBEDDING_RETRY_BATCH_SIZE", 256))
+EMBEDDING_RETRY_POLL_SECONDS = float(os.getenv("EMBEDDING_RETRY_POLL_SECONDS", 60))
+# 应用生命周期内共享的 HTTP 连接池（LLM 与嵌入服务），连接在请求之间复用
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+# 空闲连接保持时间（秒）
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+# 安装了 h2（pip install "httpx[http2]"）时启用 HTTP/2，多个请求复用同一连接
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))
+# 语义答案缓存：问法相近（查询向量余弦相似度不低于阈值）的问题直接返回已生成的答案和来源，
+# 条目绑定索引内容版本，文档新增、删除或重置后全部失效；条目数为 0 时禁用
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 512))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600))
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95))
+# 检索结果缓存：相同查询（归一化后）、参数和索引版本的检索命中直接复用，跳过查询嵌入和 FAISS 检索；0 表示禁用
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", 2048))
+# Prompt 上下文的 token 预算：相邻文档块合并去重后仍超出预算时，裁剪与问题相关度最低的句子；0 表示不限制
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# 安装了 tiktoken 时用于计数的编码，未安装时按字符数估算
+CONTEXT_TOKENIZER_ENCODING = os.getenv("CONTEXT_TOKENIZER_ENCODING", "cl100k_base")
+# 问答请求分阶段计时（Server-Timing 头、SSE timing 事件和 /metrics 直方图）；关闭后计时代码不做任何事
+REQUEST_TRACING_ENABLED = os.getenv("REQUEST_TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
@@ -5,6 +5,7 @@ os.environ["MKL_NUM_THREADS"] = "1"
 os.environ["TOKENIZERS_PARALLELISM"] = "false"  # 也禁用 tokenizers 的并行处理
 
 # FastAPI 启动入口
+import asyncio
 import sys
 from contextlib import asynccontextmanager
 from datetime import datetime  # 新增: 用于健康检查端点返回当前时间
@@ -12,14 +13,20 @@ from datetime import datetime  # 新增: 用于健康检查端点返回当前时
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 # 将当前目录添加到Python路径，确保可以导入同级模块
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 # 导入配置和路由模块
 from api import routes as api_routes
-from services.embedding import get_embedding_model  # 用于预加载
-from services.vector_store import get_vector_store  # 用于预加载
+from services.embedding import (  # 用于预加载
+    close_embedding_clients,
+    get_embedding_model,
+)
+from services.http_clients import close_http_clients, open_http_clients
+from services.metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY
+from services.vector_store import close_vector_store, get_vector_store  # 用于预加载
 
 # 应用标题和版本，会显示在 Swagger UI
 APP_TITLE = "RAG Enterprise Q&A Assistant API"
@@ -67,12 +74,32 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"启动时加载向量数据库失败: {e}")
 
+    # 创建 LLM 和嵌入服务共享的 HTTP 连接池
+    open_http_clients()
+
+    # 后台重试嵌入失败的文档块
+    retry_task = asyncio.create_task(api_routes.embedding_retry_worker())
+
     print("FastAPI 应用启动完成。")
 
     yield
 
     # 关闭时执行
     print("FastAPI 应用关闭中...")
+    retry_task.cancel()
+    try:
+        await retry_task
+    except asyncio.CancelledError:
+        pass
+    try:
+        close_vector_store()
+    except Exception as e:
+        print(f"关闭向量数据库时出错: {e}")
+    try:
+        await close_embedding_clients()
+    except Exception as e:
+        print(f"关闭嵌入服务客户端时出错: {e}")
+    await close_http_clients()
     print("FastAPI 应用已关闭。")
 
 
@@ -116,6 +143,7 @@ if "*" in origins:
         allow_credentials=False,
         allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         allow_headers=["*"],
+        expose_headers=["Server-Timing"],
         max_age=86400,
     )
 else:
@@ -125,6 +153,7 @@ else:
         allow_credentials=True,
         allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         allow_headers=["*"],
+        expose_headers=["Server-Timing"],
         max_age=86400,
     )
 
@@ -145,6 +174,13 @@ async def health_check():
     }
 
 
+# Prometheus 指标端点
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """以 Prometheus 文本格式导出进程内的计数器和延迟直方图"""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
 # 主运行块，用于直接通过 python main.py 启动 (主要用于开发)
 if __name__ == "__main__":
     # 从环境变量获取端口，如果未设置则默认为 8000
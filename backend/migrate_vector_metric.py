@@ -0,0 +1,34 @@
+"""
+离线迁移向量索引的距离度量
+
+在 backend 目录下、停止服务后执行:
+    python migrate_vector_metric.py --metric cosine
+
+迁移到 cosine 时会把已有向量归一化并重建为内积索引，检索分数变为 [-1, 1] 的余弦相似度；
+不会重新调用嵌入接口。迁移后把 VECTOR_METRIC 设为同一度量，重置后新建的索引才会沿用它。
+"""
+
+import argparse
+
+from config import VECTOR_DB_PATH
+from services.vector_store import METRIC_COSINE, SUPPORTED_METRICS, FAISSVectorStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移 FAISS 索引的距离度量")
+    parser.add_argument("--metric", choices=SUPPORTED_METRICS, default=METRIC_COSINE)
+    parser.add_argument(
+        "--index-prefix", default=VECTOR_DB_PATH, help="索引文件路径前缀"
+    )
+    args = parser.parse_args()
+
+    store = FAISSVectorStore(args.index_prefix, metric=args.metric)
+    try:
+        count = store.migrate_metric(args.metric)
+        print(f"迁移完成，共处理 {count} 个向量。")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# 语义答案缓存：按查询向量相似度复用已生成的答案，问法略有不同的重复问题不再检索和调用 LLM
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+from config import (
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    ANSWER_CACHE_TTL_SECONDS,
+)
+
+
+class CachedAnswer:
+    """一条已缓存的答案：最终答案文本和来源列表"""
+
+    __slots__ = ("query", "answer", "sources", "params", "created_at", "hits")
+
+    def __init__(self, query: str, answer: str, sources: List[Any], params: Hashable):
+        self.query = query
+        self.answer = answer
+        self.sources = sources
+        self.params = params
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class SemanticAnswerCache:
+    """
+    以查询向量为键的答案缓存。
+
+    查询向量归一化后保存在固定容量的矩阵中，查找时一次矩阵乘法算出与全部条目的余弦相似度，
+    取相似度不低于 threshold、检索参数（top_k、过滤条件等）相同且未过期的最相似条目。
+    条目数超过 capacity 时淘汰最久未使用的条目。
+
+    缓存绑定索引内容版本号（IndexGeneration.number）：查找或写入时版本号与缓存的不同，
+    说明文档已新增、删除或重置，全部条目作废；基于旧版本生成的答案不会写入。
+    """
+
+    def __init__(
+        self,
+        capacity: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    ):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None  # (capacity, d)，按槽位存放
+        self._occupied: Optional[np.ndarray] = None
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()  # 槽位 -> 条目，按使用顺序
+        self._generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _sync_generation_locked(self, generation: int) -> bool:
+        """版本号变大时清空缓存；返回 generation 是否为当前版本"""
+        if self._generation is None or generation > self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self._clear_locked()
+            self._generation = generation
+        return generation == self._generation
+
+    def _clear_locked(self):
+        self._entries.clear()
+        if self._occupied is not None:
+            self._occupied[:] = False
+
+    def _remove_locked(self, slot: int):
+        del self._entries[slot]
+        self._occupied[slot] = False
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(vector))
+        if norm == 0.0:
+            return None
+        return vector / norm
+
+    def get(
+        self, query_vector: np.ndarray, generation: int, params: Hashable
+    ) -> Optional[CachedAnswer]:
+        """查找与查询向量足够相似的已缓存答案，未命中时返回 None"""
+        if self.capacity <= 0:
+            return None
+        vector = self._normalize(query_vector)
+        with self._lock:
+            if (
+                vector is None
+                or not self._sync_generation_locked(generation)
+                or not self._entries
+                or self._vectors.shape[1] != len(vector)
+            ):
+                self.misses += 1
+                return None
+
+            scores = self._vectors @ vector
+            scores[~self._occupied] = -np.inf
+            expired_before = time.time() - self.ttl_seconds if self.ttl_seconds else None
+            for slot in np.argsort(-scores):
+                if scores[slot] < self.threshold:
+                    break
+                slot = int(slot)
+                entry = self._entries[slot]
+                if expired_before is not None and entry.created_at < expired_before:
+                    self._remove_locked(slot)
+                    continue
+                if entry.params != params:
+                    continue
+                self._entries.move_to_end(slot)
+                entry.hits += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        query: str,
+        query_vector: np.ndarray,
+        generation: int,
+        params: Hashable,
+        answer: str,
+        sources: List[Any],
+    ):
+        """缓存一条答案；generation 早于当前版本（生成期间索引已更新）时忽略"""
+        if self.capacity <= 0 or not answer:
+            return
+        vector = self._normalize(query_vector)
+        if vector is None:
+            return
+        with self._lock:
+            if not self._sync_generation_locked(generation):
+                return
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.capacity, len(vector)), dtype=np.float32)
+                self._occupied = np.zeros(self.capacity, dtype=bool)
+                self._entries.clear()
+
+            free = np.flatnonzero(~self._occupied)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot, _ = self._entries.popitem(last=False)
+            self._vectors[slot] = vector
+            self._occupied[slot] = True
+            self._entries[slot] = CachedAnswer(query, answer, list(sources), params)
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "generation": self._generation,
+                "similarity_threshold": self.threshold,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+_answer_cache = SemanticAnswerCache()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """获取共享的答案缓存"""
+    return _answer_cache
@@ -8,6 +8,7 @@ from typing import Optional
 from fastapi import HTTPException, status
 from models.auth import User, UserSession
 from schemas.auth import UserCreate
+from services.metrics import REGISTRY
 from sqlalchemy import and_
 from sqlalchemy.orm import Session
 from utils.auth import (
@@ -17,6 +18,10 @@ from utils.auth import (
     verify_password,
 )
 
+AUTH_LOOKUP_SECONDS = REGISTRY.histogram(
+    "auth_db_lookup_duration_seconds", "认证相关数据库查询耗时（秒）", ("lookup",)
+)
+
 
 class AuthService:
     """认证服务类"""
@@ -82,15 +87,18 @@ class AuthService:
 
     def get_user_by_username(self, username: str) -> Optional[User]:
         """通过用户名获取用户"""
-        return self.db.query(User).filter(User.username == username).first()
+        with AUTH_LOOKUP_SECONDS.labels("user_by_username").time():
+            return self.db.query(User).filter(User.username == username).first()
 
     def get_user_by_email(self, email: str) -> Optional[User]:
         """通过邮箱获取用户"""
-        return self.db.query(User).filter(User.email == email).first()
+        with AUTH_LOOKUP_SECONDS.labels("user_by_email").time():
+            return self.db.query(User).filter(User.email == email).first()
 
     def get_user_by_id(self, user_id: int) -> Optional[User]:
         """通过ID获取用户"""
-        return self.db.query(User).filter(User.id == user_id).first()
+        with AUTH_LOOKUP_SECONDS.labels("user_by_id").time():
+            return self.db.query(User).filter(User.id == user_id).first()
 
     def create_user_session(
         self, user: User, access_token: str, refresh_token: str
@@ -110,17 +118,18 @@ class AuthService:
 
     def get_user_session(self, token: str) -> Optional[UserSession]:
         """获取用户会话"""
-        return (
-            self.db.query(UserSession)
-            .filter(
-                and_(
-                    UserSession.token == token,
-                    UserSession.is_active,
-                    UserSession.expires_at > datetime.now(timezone.utc),
+        with AUTH_LOOKUP_SECONDS.labels("user_session").time():
+            return (
+                self.db.query(UserSession)
+                .filter(
+                    and_(
+                        UserSession.token == token,
+                        UserSession.is_active,
+                        UserSession.expires_at > datetime.now(timezone.utc),
+                    )
                 )
+                .first()
             )
-            .first()
-        )
 
     def revoke_user_session(self, token: str) -> bool:
         """撤销用户会话"""
@@ -0,0 +1,340 @@
+# 文档块内容存储：以 chunk ID 为主键的 SQLite 表，支持按 ID 点查和增量写入
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document as LangchainDocument
+
+CHUNK_DB_EXTENSION = ".chunks.db"
+
+# SQLite 单条语句允许的参数个数有限，批量查询时分段执行
+_SQL_BATCH_SIZE = 500
+
+
+def document_key(doc: LangchainDocument) -> str:
+    """文档块所属文档的标识：优先使用上传时的文件名，旧数据退回到 source"""
+    return doc.metadata.get("document_id") or doc.metadata.get("source", "")
+
+
+def file_type_of(name: str) -> str:
+    """由文件名得到小写的扩展名（不含点），用作文件类型"""
+    return os.path.splitext(name)[1].lstrip(".").lower()
+
+
+class ChunkFilter:
+    """
+    文档块元数据过滤条件。
+
+    各条件之间为 AND 关系，未设置的条件不参与过滤：
+        sources: 文档标识（上传时的文件名，旧数据为 source）
+        file_types: 文件扩展名，如 pdf、docx
+        page_from / page_to: 页码范围（含两端），只对带页码的文档块生效
+        uploaded_after / uploaded_before: 写入时间范围（Unix 时间戳，含两端）
+    """
+
+    def __init__(
+        self,
+        sources: Optional[List[str]] = None,
+        file_types: Optional[List[str]] = None,
+        page_from: Optional[int] = None,
+        page_to: Optional[int] = None,
+        uploaded_after: Optional[float] = None,
+        uploaded_before: Optional[float] = None,
+    ):
+        self.sources = sources
+        self.file_types = (
+            [file_type.lstrip(".").lower() for file_type in file_types]
+            if file_types is not None
+            else None
+        )
+        self.page_from = page_from
+        self.page_to = page_to
+        self.uploaded_after = uploaded_after
+        self.uploaded_before = uploaded_before
+
+    def is_empty(self) -> bool:
+        return all(
+            value is None
+            for value in (
+                self.sources,
+                self.file_types,
+                self.page_from,
+                self.page_to,
+                self.uploaded_after,
+                self.uploaded_before,
+            )
+        )
+
+    def cache_key(self) -> tuple:
+        """可哈希的条件表示，用作检索/答案缓存键的一部分"""
+        return (
+            tuple(sorted(self.sources)) if self.sources is not None else None,
+            tuple(sorted(self.file_types)) if self.file_types is not None else None,
+            self.page_from,
+            self.page_to,
+            self.uploaded_after,
+            self.uploaded_before,
+        )
+
+    def to_sql(self) -> Tuple[str, list]:
+        """转换为 WHERE 子句及其参数"""
+        clauses: List[str] = []
+        params: list = []
+        if self.sources is not None:
+            clauses.append(f"document_id IN ({','.join('?' * len(self.sources))})")
+            params.extend(self.sources)
+        if self.file_types is not None:
+            clauses.append(f"file_type IN ({','.join('?' * len(self.file_types))})")
+            params.extend(self.file_types)
+        if self.page_from is not None:
+            clauses.append("page >= ?")
+            params.append(self.page_from)
+        if self.page_to is not None:
+            clauses.append("page <= ?")
+            params.append(self.page_to)
+        if self.uploaded_after is not None:
+            clauses.append("uploaded_at >= ?")
+            params.append(self.uploaded_after)
+        if self.uploaded_before is not None:
+            clauses.append("uploaded_at <= ?")
+            params.append(self.uploaded_before)
+        return " AND ".join(clauses) or "1", params
+
+
+class ChunkStore:
+    """
+    文档块存储。
+
+    每个文档块一行，主键即索引中的向量 ID，并在 document_id 上建立索引。
+    写入新文档块只追加新行，删除文档只删除对应的行，检索命中时按 ID 点查，
+    因此读写开销与变更量成正比，而与知识库总规模无关。
+
+    索引使用压缩存储时，chunk_vectors 表保存全精度向量副本，供重排和重建索引使用。
+    页码、文件类型和写入时间单独成列并建立索引，检索时先把元数据过滤条件解析为 chunk ID 集合。
+    """
+
+    def __init__(self, path_prefix: str):
+        self.db_file = path_prefix + CHUNK_DB_EXTENSION
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file)
+            # WAL 模式下读不阻塞写，多个进程也可以同时读取
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    document_id TEXT NOT NULL,
+                    page_content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    page INTEGER,
+                    file_type TEXT,
+                    uploaded_at REAL
+                )
+                """
+            )
+            self._migrate_filter_columns(conn)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunks_document_id ON chunks(document_id, page)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunks_file_type ON chunks(file_type)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunks_uploaded_at ON chunks(uploaded_at)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_vectors (id INTEGER PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+
+    @staticmethod
+    def _migrate_filter_columns(conn: sqlite3.Connection):
+        """旧版数据库补充过滤列，并从元数据中回填页码和文件类型；写入时间未知时保持为空"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(chunks)")}
+        if "page" in columns:
+            return
+        print("正在为文档块存储添加元数据过滤列...")
+        conn.execute("DROP INDEX IF EXISTS idx_chunks_document_id")
+        conn.execute("ALTER TABLE chunks ADD COLUMN page INTEGER")
+        conn.execute("ALTER TABLE chunks ADD COLUMN file_type TEXT")
+        conn.execute("ALTER TABLE chunks ADD COLUMN uploaded_at REAL")
+        rows = conn.execute("SELECT id, document_id, metadata FROM chunks").fetchall()
+        conn.executemany(
+            "UPDATE chunks SET page = ?, file_type = ? WHERE id = ?",
+            [
+                (json.loads(metadata).get("page"), file_type_of(document_id), chunk_id)
+                for chunk_id, document_id, metadata in rows
+            ],
+        )
+
+    @staticmethod
+    def _row_to_document(page_content: str, metadata: str) -> LangchainDocument:
+        return LangchainDocument(page_content=page_content, metadata=json.loads(metadata))
+
+    def count(self) -> int:
+        row = self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return int(row[0])
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def next_chunk_id(self) -> int:
+        """下一个可用的 chunk ID；ID 单调递增，删除后不会复用"""
+        row = (
+            self._connection()
+            .execute("SELECT value FROM store_meta WHERE key = 'next_chunk_id'")
+            .fetchone()
+        )
+        return int(row[0]) if row else 0
+
+    def get(self, chunk_id: int) -> Optional[LangchainDocument]:
+        return self.get_many([chunk_id]).get(int(chunk_id))
+
+    def get_many(self, chunk_ids: Iterable[int]) -> Dict[int, LangchainDocument]:
+        """按 ID 批量读取文档块，不存在的 ID 会被忽略"""
+        ids = [int(chunk_id) for chunk_id in chunk_ids]
+        result: Dict[int, LangchainDocument] = {}
+        conn = self._connection()
+        for start in range(0, len(ids), _SQL_BATCH_SIZE):
+            batch = ids[start : start + _SQL_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT id, page_content, metadata FROM chunks WHERE id IN ({placeholders})",
+                batch,
+            )
+            for chunk_id, page_content, metadata in rows:
+                result[chunk_id] = self._row_to_document(page_content, metadata)
+        return result
+
+    def add_many(
+        self,
+        chunks: Dict[int, LangchainDocument],
+        vectors: Optional[np.ndarray] = None,
+        uploaded_at: Optional[float] = None,
+    ):
+        """
+        在一个事务中追加新文档块，并推进 next_chunk_id。
+
+        Args:
+            chunks: chunk ID -> 文档块
+            vectors: 可选，与 chunks 顺序一致的全精度向量
+            uploaded_at: 写入时间（Unix 时间戳），默认为当前时间
+        """
+        if not chunks:
+            return
+        if uploaded_at is None:
+            uploaded_at = time.time()
+        rows = [
+            (
+                chunk_id,
+                document_key(doc),
+                doc.page_content,
+                json.dumps(doc.metadata, ensure_ascii=False, default=str),
+                doc.metadata.get("page"),
+                file_type_of(document_key(doc)),
+                uploaded_at,
+            )
+            for chunk_id, doc in chunks.items()
+        ]
+        next_id = max(max(chunks) + 1, self.next_chunk_id())
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, document_id, page_content, metadata, page, file_type, uploaded_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('next_chunk_id', ?)",
+                (str(next_id),),
+            )
+            if vectors is not None:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunk_vectors (id, vector) VALUES (?, ?)",
+                    [
+                        (chunk_id, np.asarray(vector, dtype=np.float32).tobytes())
+                        for chunk_id, vector in zip(chunks, vectors)
+                    ],
+                )
+
+    def get_vectors(self, chunk_ids: Iterable[int]) -> Dict[int, np.ndarray]:
+        """按 ID 读取全精度向量，未保存向量的 ID 会被忽略"""
+        ids = [int(chunk_id) for chunk_id in chunk_ids]
+        result: Dict[int, np.ndarray] = {}
+        conn = self._connection()
+        for start in range(0, len(ids), _SQL_BATCH_SIZE):
+            batch = ids[start : start + _SQL_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT id, vector FROM chunk_vectors WHERE id IN ({placeholders})",
+                batch,
+            )
+            for chunk_id, blob in rows:
+                result[chunk_id] = np.frombuffer(blob, dtype=np.float32)
+        return result
+
+    def update_vectors(self, chunk_ids: np.ndarray, vectors: np.ndarray):
+        """覆盖已保存的全精度向量，没有副本的 ID 会被忽略"""
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "UPDATE chunk_vectors SET vector = ? WHERE id = ?",
+                [
+                    (np.asarray(vector, dtype=np.float32).tobytes(), int(chunk_id))
+                    for chunk_id, vector in zip(chunk_ids, vectors)
+                ],
+            )
+
+    def document_chunk_ids(self, document_id: str) -> List[int]:
+        rows = self._connection().execute(
+            "SELECT id FROM chunks WHERE document_id = ? ORDER BY id", (document_id,)
+        )
+        return [row[0] for row in rows]
+
+    def filter_chunk_ids(self, chunk_filter: ChunkFilter) -> np.ndarray:
+        """把元数据过滤条件解析为满足条件的 chunk ID（升序）"""
+        where, params = chunk_filter.to_sql()
+        rows = self._connection().execute(
+            f"SELECT id FROM chunks WHERE {where} ORDER BY id", params
+        )
+        return np.fromiter((row[0] for row in rows), dtype=np.int64)
+
+    def delete_many(self, chunk_ids: Iterable[int]):
+        ids = [int(chunk_id) for chunk_id in chunk_ids]
+        conn = self._connection()
+        with conn:
+            for start in range(0, len(ids), _SQL_BATCH_SIZE):
+                batch = ids[start : start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                conn.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+                conn.execute(
+                    f"DELETE FROM chunk_vectors WHERE id IN ({placeholders})", batch
+                )
+
+    def clear(self):
+        """删除全部文档块，并重置 chunk ID 计数"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM chunk_vectors")
+            conn.execute("DELETE FROM store_meta")
+
@@ -0,0 +1,249 @@
+# 上下文组装：合并相邻文档块并去掉重叠部分，按 token 预算裁剪低相关度的句子，减少 Prompt 长度
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_TOKENIZER_ENCODING
+from langchain_core.documents import Document as LangchainDocument
+from services.chunk_store import document_key
+from services.embedding import estimate_tokens
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# 句子切分位置：中英文句末标点、分号和换行之后
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?；;\n])|(?<=[.])(?=\s)")
+_LATIN_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[\u2e80-\u9fff\uf900-\ufaff]+")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """tiktoken 为可选依赖，未安装或编码加载失败时使用 estimate_tokens 估算"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"[context] tiktoken 不可用，按字符数估算 token: {e}")
+            _encoding = None
+    return _encoding
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """文本的 token 数；文档块和句子在请求之间反复出现，结果按文本缓存"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def _terms(text: str) -> Set[str]:
+    """用于相关度计算的词项：英文/数字单词，以及中日韩文字的二元组"""
+    text = text.casefold()
+    terms = {word for word in _LATIN_WORD.findall(text) if len(word) > 1}
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i : i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _split_sentences(text: str) -> List[str]:
+    return [sentence for sentence in _SENTENCE_BOUNDARY.split(text) if sentence]
+
+
+def _overlap_length(left: str, right: str, expected: int) -> int:
+    """
+    left 的结尾与 right 的开头重叠的字符数。只采用由 start_index 算出的 expected，
+    文本核对不一致时按无重叠处理，不按字符猜测，避免删掉恰好相同的原文
+    """
+    expected = min(expected, len(left), len(right))
+    if expected > 0 and left.endswith(right[:expected]):
+        return expected
+    return 0
+
+
+class _Segment:
+    """合并后的一段连续上下文"""
+
+    __slots__ = ("rank", "text", "start", "end", "chunks", "sentences")
+
+    def __init__(self, rank: int, text: str, start: Optional[int]):
+        self.rank = rank  # 所含文档块中最靠前的检索名次
+        self.text = text
+        self.start = start
+        self.end = start + len(text) if start is not None else None
+        self.chunks = 1
+        self.sentences: List[Tuple[str, int, int]] = []  # (句子, token 数, 相关度)
+
+    def absorb(self, text: str, start: int, rank: int):
+        """并入一个起点不晚于本段结尾的文档块，只追加不重叠的部分"""
+        end = start + len(text)
+        self.rank = min(self.rank, rank)
+        self.chunks += 1
+        if end <= self.end:
+            return
+        overlap = _overlap_length(self.text, text, self.end - start)
+        self.text += text[overlap:]
+        self.end = end
+
+
+class PackedContext:
+    """组装好的上下文文本，以及本次组装节省的 token 数"""
+
+    def __init__(
+        self,
+        text: str,
+        chunks: int,
+        segments: int,
+        pruned_sentences: int,
+        tokens_before: int,
+        tokens_after: int,
+        token_budget: int,
+    ):
+        self.text = text
+        self.chunks = chunks
+        self.segments = segments
+        self.pruned_sentences = pruned_sentences
+        self.tokens_before = tokens_before
+        self.tokens_after = tokens_after
+        self.token_budget = token_budget
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.tokens_before - self.tokens_after)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chunks": self.chunks,
+            "segments": self.segments,
+            "pruned_sentences": self.pruned_sentences,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": self.tokens_saved,
+            "token_budget": self.token_budget,
+        }
+
+
+def _merge_chunks(chunks: List[LangchainDocument]) -> List[_Segment]:
+    """
+    同一文档同一页内按 start_index 排序，把重叠或首尾相接的文档块合并为一段；
+    没有 start_index 的文档块单独成段，内容完全相同的文档块只保留一个。
+    结果按各段最靠前的检索名次排序。
+    """
+    groups: Dict[tuple, List[Tuple[int, int, str]]] = {}
+    segments: List[_Segment] = []
+    for rank, doc in enumerate(chunks):
+        start = doc.metadata.get("start_index")
+        if isinstance(start, int):
+            key = (document_key(doc), doc.metadata.get("page"))
+            groups.setdefault(key, []).append((start, rank, doc.page_content))
+        else:
+            segments.append(_Segment(rank, doc.page_content, None))
+
+    for members in groups.values():
+        members.sort()
+        current: Optional[_Segment] = None
+        for start, rank, text in members:
+            if current is not None and start <= current.end:
+                current.absorb(text, start, rank)
+            else:
+                current = _Segment(rank, text, start)
+                segments.append(current)
+
+    segments.sort(key=lambda segment: segment.rank)
+    unique: List[_Segment] = []
+    seen: Dict[str, _Segment] = {}
+    for segment in segments:
+        duplicate = seen.get(segment.text)
+        if duplicate is not None:
+            duplicate.chunks += segment.chunks
+            continue
+        seen[segment.text] = segment
+        unique.append(segment)
+    return unique
+
+
+def pack_context(
+    query: str,
+    chunks: List[LangchainDocument],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> PackedContext:
+    """
+    把按相关度排序的检索结果组装成 Prompt 上下文。
+
+    先合并相邻文档块并去掉重叠部分；总 token 数超过 token_budget 时，按句子与查询的
+    词项重合度从低到高删除句子（重合度相同时先删检索名次靠后的段落、段内靠后的句子），
+    直到满足预算。token_budget 为 0 时不限制长度。
+    """
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+    tokens_before = sum(count_tokens(doc.page_content) for doc in chunks) + separator_tokens * max(
+        0, len(chunks) - 1
+    )
+    segments = _merge_chunks(chunks)
+
+    query_terms = _terms(query)
+    total = 0
+    for segment in segments:
+        segment.sentences = [
+            (sentence, count_tokens(sentence), len(_terms(sentence) & query_terms))
+            for sentence in _split_sentences(segment.text)
+        ]
+        total += sum(tokens for _, tokens, _ in segment.sentences)
+    # 只有仍含句子的段之间才有分隔符
+    live_segments = sum(1 for segment in segments if segment.sentences)
+    total += separator_tokens * max(0, live_segments - 1)
+
+    pruned = 0
+    if token_budget > 0 and total > token_budget:
+        candidates = sorted(
+            (
+                (relevance, -segment_index, -sentence_index)
+                for segment_index, segment in enumerate(segments)
+                for sentence_index, (_, _, relevance) in enumerate(segment.sentences)
+            )
+        )
+        removed: Dict[int, Set[int]] = {}
+        remaining = [len(segment.sentences) for segment in segments]
+        for _, negative_segment, negative_sentence in candidates:
+            if total <= token_budget:
+                break
+            segment_index, sentence_index = -negative_segment, -negative_sentence
+            removed.setdefault(segment_index, set()).add(sentence_index)
+            total -= segments[segment_index].sentences[sentence_index][1]
+            remaining[segment_index] -= 1
+            if remaining[segment_index] == 0:
+                live_segments -= 1
+                # 删空一段时少一个分隔符；删空最后一段时已没有分隔符可减
+                if live_segments > 0:
+                    total -= separator_tokens
+            pruned += 1
+        for segment_index, sentence_indexes in removed.items():
+            segment = segments[segment_index]
+            segment.sentences = [
+                sentence
+                for sentence_index, sentence in enumerate(segment.sentences)
+                if sentence_index not in sentence_indexes
+            ]
+
+    texts = [
+        "".join(sentence for sentence, _, _ in segment.sentences).strip()
+        for segment in segments
+    ]
+    texts = [text for text in texts if text]
+    return PackedContext(
+        text=CONTEXT_SEPARATOR.join(texts),
+        chunks=len(chunks),
+        segments=len(texts),
+        pruned_sentences=pruned,
+        tokens_before=tokens_before,
+        tokens_after=total,
+        token_budget=token_budget,
+    )
@@ -21,6 +21,9 @@ class DocumentInfo:
         status: str = "pending",
         progress: int = 0,
         error: Optional[str] = None,
+        embedding_cache_hits: int = 0,
+        embedding_cache_misses: int = 0,
+        pending_chunks: int = 0,
     ):
         self.filename = filename
         self.file_path = file_path
@@ -30,6 +33,9 @@ class DocumentInfo:
         self.status = status
         self.progress = progress
         self.error = error
+        self.embedding_cache_hits = embedding_cache_hits
+        self.embedding_cache_misses = embedding_cache_misses
+        self.pending_chunks = pending_chunks
 
     def to_dict(self) -> Dict:
         return {
@@ -41,6 +47,9 @@ class DocumentInfo:
             "status": self.status,
             "progress": self.progress,
             "error": self.error,
+            "embedding_cache_hits": self.embedding_cache_hits,
+            "embedding_cache_misses": self.embedding_cache_misses,
+            "pending_chunks": self.pending_chunks,
         }
 
     @classmethod
@@ -54,6 +63,9 @@ class DocumentInfo:
             status=data.get("status", "pending"),
             progress=data.get("progress", 0),
             error=data.get("error", None),
+            embedding_cache_hits=data.get("embedding_cache_hits", 0),
+            embedding_cache_misses=data.get("embedding_cache_misses", 0),
+            pending_chunks=data.get("pending_chunks", 0),
         )
 
 
@@ -141,8 +153,11 @@ def update_document_status(
     progress: Optional[int] = None,
     chunks_count: Optional[int] = None,
     error: Optional[str] = None,
+    embedding_cache_hits: Optional[int] = None,
+    embedding_cache_misses: Optional[int] = None,
+    pending_chunks: Optional[int] = None,
 ) -> bool:
-    """更新文档处理状态"""
+    """更新文档处理状态；error 传入空字符串时清除之前的错误信息"""
     try:
         documents = get_all_documents()
         found = False
@@ -155,7 +170,13 @@ def update_document_status(
                 if chunks_count is not None:
                     doc.chunks_count = chunks_count
                 if error is not None:
-                    doc.error = error
+                    doc.error = error or None
+                if embedding_cache_hits is not None:
+                    doc.embedding_cache_hits = embedding_cache_hits
+                if embedding_cache_misses is not None:
+                    doc.embedding_cache_misses = embedding_cache_misses
+                if pending_chunks is not None:
+                    doc.pending_chunks = pending_chunks
                 found = True
                 break
 
@@ -1,49 +1,209 @@
 """
 嵌入服务模块：将文本转换为向量表示
-使用Cohere API生成文本的嵌入向量
+默认使用Cohere API生成文本的嵌入向量，也可通过 EMBEDDING_BACKEND=local 使用本地CPU模型
 优化为在Railway环境中可靠运行
 """
 
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import math
 import os
+import threading
 import time
+import unicodedata
 import traceback
+from email.utils import parsedate_to_datetime
 import httpx
+import numpy as np
+from services.embedding_cache import get_embedding_cache
+from services.embedding_scheduler import (
+    LANE_INGEST,
+    LANE_INTERACTIVE,
+    EmbeddingScheduler,
+)
+from services.http_clients import CLIENT_EMBEDDING, get_http_client, register_http_client
+from services.metrics import REGISTRY
 
 # 直接从环境变量获取配置，提高Railway部署的兼容性
+EMBEDDING_BACKEND_COHERE = "cohere"
+EMBEDDING_BACKEND_LOCAL = "local"
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", EMBEDDING_BACKEND_COHERE).lower()
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY", "")
 COHERE_API_BASE_URL = os.environ.get("COHERE_API_BASE_URL", "https://api.cohere.ai")
 COHERE_EMBEDDING_MODEL = os.environ.get(
     "COHERE_EMBEDDING_MODEL", "embed-multilingual-v3.0"
 )
 
+# 向 Cohere 请求的嵌入类型: float / int8 / uint8 / binary / ubinary
+# 压缩类型的响应体更小，解码后按 float32 写入索引（int8 与 VECTOR_STORAGE=sq8 搭配几乎无损，
+# binary/ubinary 展开为 ±1 向量，适合 cosine 度量）
+COHERE_EMBEDDING_TYPE = os.environ.get("COHERE_EMBEDDING_TYPE", "float").lower()
+SUPPORTED_EMBEDDING_TYPES = ("float", "int8", "uint8", "binary", "ubinary")
+if COHERE_EMBEDDING_TYPE not in SUPPORTED_EMBEDDING_TYPES:
+    print(f"[embedding] 不支持的 COHERE_EMBEDDING_TYPE={COHERE_EMBEDDING_TYPE}，改用 float")
+    COHERE_EMBEDDING_TYPE = "float"
+
 # Cohere配置常量
 EMBEDDING_DIMENSION = int(
     os.environ.get("COHERE_EMBEDDING_DIMENSION", 1024)
 )  # Cohere embedding的默认维度
 EMBEDDING_BATCH_SIZE = int(
-    os.environ.get("COHERE_EMBEDDING_BATCH_SIZE", 5)
-)  # 每批处理的文本数量
+    os.environ.get("COHERE_EMBEDDING_BATCH_SIZE", 32)
+)  # 每批处理的初始文本数量，之后根据延迟和限流响应自动调整
+EMBEDDING_MAX_BATCH_SIZE = 96  # Cohere embed 接口单次请求允许的最大文本数量
+EMBEDDING_MAX_BATCH_TOKENS = int(
+    os.environ.get("COHERE_MAX_BATCH_TOKENS", 32000)
+)  # 每批文本的估算 token 总数上限
+EMBEDDING_TARGET_BATCH_LATENCY = float(
+    os.environ.get("COHERE_TARGET_BATCH_LATENCY", 3.0)
+)  # 单批请求的目标延迟(秒)，低于该值时逐步增大批次，超过两倍时减半
 EMBEDDING_REQUEST_TIMEOUT = int(
     os.environ.get("COHERE_REQUEST_TIMEOUT", 60)
 )  # 请求超时时间(秒)
 EMBEDDING_MAX_RETRIES = int(os.environ.get("COHERE_MAX_RETRIES", 3))  # 最大重试次数
+EMBEDDING_MAX_RETRY_AFTER = float(
+    os.environ.get("COHERE_MAX_RETRY_AFTER", 30)
+)  # 请求内最多按 Retry-After 等待的秒数，更长时直接失败，交给重试队列稍后处理
+QUERY_EMBEDDING_CACHE_SIZE = int(
+    os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024)
+)  # 查询向量 LRU 缓存的条目数，0 表示不缓存
+QUERY_EMBEDDING_BATCH_WAIT_MS = float(
+    os.environ.get("QUERY_EMBEDDING_BATCH_WAIT_MS", 5)
+)  # 异步查询嵌入攒批的最长等待时间(毫秒)
+QUERY_EMBEDDING_MAX_BATCH = int(
+    os.environ.get("QUERY_EMBEDDING_MAX_BATCH", 64)
+)  # 攒够该数量的查询立即发送
+EMBEDDING_MAX_CONCURRENCY = int(
+    os.environ.get("COHERE_MAX_CONCURRENCY", 4)
+)  # 同时在途的请求数上限
+EMBEDDING_RATE_LIMIT_PER_MINUTE = float(
+    os.environ.get("COHERE_RATE_LIMIT_PER_MINUTE", 2000)
+)  # 每分钟最多发出的嵌入请求数（令牌桶），0 表示不限速
+EMBEDDING_RATE_LIMIT_BURST = int(
+    os.environ.get("COHERE_RATE_LIMIT_BURST", 0)
+)  # 令牌桶容量，0 表示并发上限的两倍
+EMBEDDING_INTERACTIVE_RESERVE = int(
+    os.environ.get("EMBEDDING_INTERACTIVE_RESERVE", 1)
+)  # 查询压力较高时为查询保留的并发名额和令牌数
+EMBEDDING_QUERY_PRESSURE_WINDOW = float(
+    os.environ.get("EMBEDDING_QUERY_PRESSURE_WINDOW", 5.0)
+)  # 最近多少秒内出现过查询即视为查询压力较高，导入让出保留名额
+
+# Cohere 嵌入类型：文档入库与用户查询使用不同的 input_type
+INPUT_TYPE_DOCUMENT = "search_document"
+INPUT_TYPE_QUERY = "search_query"
+
+if EMBEDDING_BACKEND == EMBEDDING_BACKEND_LOCAL:
+    print("[服务初始化] 使用本地嵌入模型，模型名称见 EMBEDDING_MODEL_NAME")
+else:
+    print(
+        f"[服务初始化] 使用Cohere Embedding API: {COHERE_EMBEDDING_MODEL}, 维度: {EMBEDDING_DIMENSION}"
+    )
+    if not COHERE_API_KEY:
+        print("警告: 未设置COHERE_API_KEY环境变量。请确保在生产环境中设置此变量。")
+        print("嵌入功能将不可用，但应用程序会继续启动。")
+
+# 异步嵌入请求使用应用级共享连接池，连接数与并发上限一致
+register_http_client(
+    CLIENT_EMBEDDING,
+    timeout=EMBEDDING_REQUEST_TIMEOUT,
+    max_connections=EMBEDDING_MAX_CONCURRENCY,
+    max_keepalive_connections=EMBEDDING_MAX_CONCURRENCY,
+)
 
-print(
-    f"[服务初始化] 使用Cohere Embedding API: {COHERE_EMBEDDING_MODEL}, 维度: {EMBEDDING_DIMENSION}"
+EMBEDDING_BATCH_TEXTS = REGISTRY.histogram(
+    "embedding_batch_size",
+    "每次嵌入请求包含的文本数",
+    ("lane",),
+    buckets=(1, 2, 4, 8, 16, 32, 48, 64, 96),
 )
-if not COHERE_API_KEY:
-    print("警告: 未设置COHERE_API_KEY环境变量。请确保在生产环境中设置此变量。")
-    print("嵌入功能将不可用，但应用程序会继续启动。")
+EMBEDDING_REQUEST_SECONDS = REGISTRY.histogram(
+    "embedding_request_duration_seconds",
+    "单次嵌入请求耗时（秒）",
+    ("lane", "outcome"),
+)
+EMBEDDING_RETRIES = REGISTRY.counter(
+    "embedding_retries_total", "嵌入请求失败后的重试次数（按失败原因）", ("reason",)
+)
+EMBEDDING_FAILED_TEXTS = REGISTRY.counter(
+    "embedding_failed_texts_total", "重试耗尽后交给重试队列的文本数"
+)
+
+
+class EmbeddingBackend:
+    """
+    嵌入后端接口。
+
+    generate_embeddings 等批处理、重试和缓存逻辑只依赖这里的方法，
+    新的后端实现 generate_batch_embeddings、get_dimension 和 get_model_name 即可接入。
+    """
 
+    _scheduler: Optional[EmbeddingScheduler] = None
+    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY
+    rate_limit_per_minute: float = 0  # 后端的请求速率限制，0 表示不限速
 
-class CohereEmbeddingSingleton:
+    def is_available(self) -> bool:
+        """后端是否可用（例如已配置 API 密钥）；不可用时返回零向量"""
+        return True
+
+    def get_dimension(self) -> int:
+        raise NotImplementedError
+
+    def get_model_name(self) -> str:
+        raise NotImplementedError
+
+    def generate_batch_embeddings(
+        self,
+        texts: List[str],
+        input_type: str = INPUT_TYPE_DOCUMENT,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        为一批文本生成嵌入，返回 (len(texts), dimension) 的 float32 数组。
+
+        传入 out 时直接写入该数组（通常是调用方预分配结果的一个切片）并返回它。
+        """
+        raise NotImplementedError
+
+    async def agenerate_batch_embeddings(
+        self,
+        texts: List[str],
+        input_type: str = INPUT_TYPE_DOCUMENT,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """默认在线程中执行同步实现"""
+        return await asyncio.to_thread(
+            self.generate_batch_embeddings, texts, input_type, out
+        )
+
+    def zeros(self, count: int) -> np.ndarray:
+        return np.zeros((count, self.get_dimension()), dtype=np.float32)
+
+    def get_scheduler(self) -> EmbeddingScheduler:
+        """所有嵌入请求共用的调度器：限制并发与速率，查询优先于导入"""
+        if self._scheduler is None:
+            self._scheduler = EmbeddingScheduler(
+                self.max_concurrency,
+                self.rate_limit_per_minute,
+                burst=EMBEDDING_RATE_LIMIT_BURST,
+                reserve=EMBEDDING_INTERACTIVE_RESERVE,
+                pressure_window=EMBEDDING_QUERY_PRESSURE_WINDOW,
+            )
+        return self._scheduler
+
+    async def aclose(self):
+        """释放后端持有的资源"""
+
+
+class CohereEmbeddingSingleton(EmbeddingBackend):
     """Cohere Embedding API封装类，实现单例模式"""
 
     _instance = None
     _http_client: Optional[httpx.Client] = None
     _dimension: int = EMBEDDING_DIMENSION
     _model_name: str = COHERE_EMBEDDING_MODEL
+    rate_limit_per_minute: float = EMBEDDING_RATE_LIMIT_PER_MINUTE
 
     def __new__(cls):
         if cls._instance is None:
@@ -74,82 +234,144 @@ class CohereEmbeddingSingleton:
         self._init_client_if_needed()
         return self._http_client
 
+    def get_async_client(self) -> httpx.AsyncClient:
+        """获取共享的异步HTTP客户端（连接池在所有请求之间复用，由应用生命周期管理）"""
+        return get_http_client(CLIENT_EMBEDDING)
+
+    def is_available(self) -> bool:
+        return bool(COHERE_API_KEY)
+
+    async def aclose(self):
+        """关闭同步HTTP客户端；异步客户端属于共享连接池，由 close_http_clients 关闭"""
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
     def get_dimension(self) -> int:
         """获取嵌入向量的维度"""
         return self._dimension
 
-    def generate_batch_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """为一批文本生成嵌入向量"""
-        if not texts:
-            print("[CohereEmbeddingSingleton] 警告: 接收到空文本列表，返回空结果")
-            return []
+    def get_model_name(self) -> str:
+        """获取嵌入模型名称；请求压缩嵌入类型时附加类型，使缓存与浮点嵌入区分"""
+        if COHERE_EMBEDDING_TYPE == "float":
+            return self._model_name
+        return f"{self._model_name}:{COHERE_EMBEDDING_TYPE}"
+
+    def _build_request(self, texts: List[str], input_type: str):
+        """构造Cohere API请求的 url、请求头和请求体"""
+        url = f"{COHERE_API_BASE_URL}/v1/embed"
+        headers = {
+            "Authorization": f"Bearer {COHERE_API_KEY}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        payload = {
+            "model": self._model_name,
+            "texts": texts,
+            "input_type": input_type,  # 文档入库为 search_document，查询为 search_query
+            "embedding_types": [COHERE_EMBEDDING_TYPE],
+        }
 
+        # 打印请求细节（不包含完整API密钥）
+        print(f"[CohereEmbeddingSingleton] 请求: {url}")
+        print(f"[CohereEmbeddingSingleton] 模型: {self._model_name}")
+        print(f"[CohereEmbeddingSingleton] 文本数量: {len(texts)}, 类型: {input_type}")
+        return url, headers, payload
+
+    def _parse_response(
+        self,
+        response: httpx.Response,
+        texts: List[str],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """检查响应状态并把嵌入向量解码到 float32 数组，失败时抛出异常以触发重试"""
+        print(f"[CohereEmbeddingSingleton] 响应状态码: {response.status_code}")
+
+        # 错误处理
+        if response.status_code != 200:
+            error_message = f"Cohere API错误: 状态码 {response.status_code}"
+
+            try:
+                response_data = response.json()
+                if "message" in response_data:
+                    error_message += f", 信息: {response_data['message']}"
+            except Exception:
+                response_text = (
+                    response.text[:200] + "..."
+                    if len(response.text) > 200
+                    else response.text
+                )
+                error_message += f", 响应: {response_text}"
+
+            print(f"[CohereEmbeddingSingleton] {error_message}")
+            response.raise_for_status()  # 抛出异常以触发重试
+
+        # 从响应中提取嵌入向量；指定 embedding_types 时按类型分组返回
+        response_data = response.json()
+        embeddings = response_data.get("embeddings", [])
+        if isinstance(embeddings, dict):
+            embeddings = embeddings.get(COHERE_EMBEDDING_TYPE, [])
+
+        if len(embeddings) != len(texts):
+            raise ValueError(
+                f"返回的嵌入向量数量({len(embeddings)})与请求文本数量({len(texts)})不符"
+            )
+
+        if out is None:
+            out = np.empty((len(texts), self._dimension), dtype=np.float32)
+        decode_embeddings(embeddings, COHERE_EMBEDDING_TYPE, out)
+        print(f"[CohereEmbeddingSingleton] 成功获取 {len(embeddings)} 个嵌入向量")
+        return out
+
+    def generate_batch_embeddings(
+        self,
+        texts: List[str],
+        input_type: str = INPUT_TYPE_DOCUMENT,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """为一批文本生成嵌入向量"""
         if not COHERE_API_KEY:
             print(
                 "[CohereEmbeddingSingleton] 错误: 未设置COHERE_API_KEY，无法生成嵌入向量"
             )
             # 返回零向量作为占位符
-            return [[0.0] * self._dimension for _ in range(len(texts))]
+            return _fill_zeros(self, len(texts), out)
 
         self._init_client_if_needed()
 
         try:
-            # 准备Cohere API请求
-            url = f"{COHERE_API_BASE_URL}/v1/embed"
-            headers = {
-                "Authorization": f"Bearer {COHERE_API_KEY}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            }
-            payload = {
-                "model": self._model_name,
-                "texts": texts,
-                "input_type": "search_document",  # 用于文档检索的嵌入类型
-            }
-
-            # 打印请求细节（不包含完整API密钥）
-            print(f"[CohereEmbeddingSingleton] 请求: {url}")
-            print(f"[CohereEmbeddingSingleton] 模型: {self._model_name}")
-            print(f"[CohereEmbeddingSingleton] 文本数量: {len(texts)}")
+            url, headers, payload = self._build_request(texts, input_type)
 
             # 发送请求
             if self._http_client is None:
                 raise RuntimeError("HTTP客户端未初始化")
             response = self._http_client.post(url, headers=headers, json=payload)
+            return self._parse_response(response, texts, out)
 
-            # 分析响应
-            print(f"[CohereEmbeddingSingleton] 响应状态码: {response.status_code}")
-
-            # 错误处理
-            if response.status_code != 200:
-                error_message = f"Cohere API错误: 状态码 {response.status_code}"
-
-                try:
-                    response_data = response.json()
-                    if "message" in response_data:
-                        error_message += f", 信息: {response_data['message']}"
-                except Exception:
-                    response_text = (
-                        response.text[:200] + "..."
-                        if len(response.text) > 200
-                        else response.text
-                    )
-                    error_message += f", 响应: {response_text}"
-
-                print(f"[CohereEmbeddingSingleton] {error_message}")
-                response.raise_for_status()  # 抛出异常以触发重试
-
-            # 从响应中提取嵌入向量
-            response_data = response.json()
-            embeddings = response_data.get("embeddings", [])
+        except Exception as e:
+            print(f"[CohereEmbeddingSingleton] 生成嵌入向量出错: {e}")
+            traceback.print_exc()
+            raise  # 让调用函数处理重试逻辑
 
-            if len(embeddings) != len(texts):
-                print(
-                    f"[CohereEmbeddingSingleton] 警告: 返回的嵌入向量数量({len(embeddings)})与请求文本数量({len(texts)})不符"
-                )
+    async def agenerate_batch_embeddings(
+        self,
+        texts: List[str],
+        input_type: str = INPUT_TYPE_DOCUMENT,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """generate_batch_embeddings 的异步版本，等待响应期间不阻塞事件循环"""
+        if not COHERE_API_KEY:
+            print(
+                "[CohereEmbeddingSingleton] 错误: 未设置COHERE_API_KEY，无法生成嵌入向量"
+            )
+            return _fill_zeros(self, len(texts), out)
 
-            print(f"[CohereEmbeddingSingleton] 成功获取 {len(embeddings)} 个嵌入向量")
-            return embeddings
+        try:
+            url, headers, payload = self._build_request(texts, input_type)
+            response = await self.get_async_client().post(
+                url, headers=headers, json=payload
+            )
+            return self._parse_response(response, texts, out)
 
         except Exception as e:
             print(f"[CohereEmbeddingSingleton] 生成嵌入向量出错: {e}")
@@ -157,79 +379,786 @@ class CohereEmbeddingSingleton:
             raise  # 让调用函数处理重试逻辑
 
 
-def get_embedding_model() -> CohereEmbeddingSingleton:
-    """获取嵌入模型单例实例"""
+def decode_embeddings(embeddings: list, embedding_type: str, out: np.ndarray):
+    """
+    把接口返回的嵌入解码写入 float32 数组 out。
+
+    float/int8/uint8 按数值直接写入；binary/ubinary 每字节打包 8 维，展开为 ±1。
+    """
+    if embedding_type in ("binary", "ubinary"):
+        packed = np.asarray(
+            embeddings, dtype=np.int8 if embedding_type == "binary" else np.uint8
+        ).view(np.uint8)
+        bits = np.unpackbits(packed, axis=1, count=out.shape[1])
+        np.multiply(bits, 2, out=out, casting="unsafe")
+        out -= 1
+    else:
+        out[...] = embeddings
+
+
+def _fill_zeros(model: EmbeddingBackend, count: int, out: Optional[np.ndarray]) -> np.ndarray:
+    if out is None:
+        return model.zeros(count)
+    out[...] = 0.0
+    return out
+
+
+def get_embedding_model() -> EmbeddingBackend:
+    """获取 EMBEDDING_BACKEND 指定的嵌入后端单例实例"""
+    if EMBEDDING_BACKEND == EMBEDDING_BACKEND_LOCAL:
+        # 本地后端依赖可选的 sentence-transformers，仅在启用时导入
+        from services.local_embedding import get_local_embedding_model
+
+        return get_local_embedding_model()
     return CohereEmbeddingSingleton()
 
 
 def get_embedding_dimension() -> int:
     """获取嵌入向量的维度"""
-    return CohereEmbeddingSingleton().get_dimension()
+    return get_embedding_model().get_dimension()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的 token 数：中日韩字符按每字 1 个 token，其余字符按每 4 个 1 个 token
+    """
+    cjk = sum(1 for ch in text if ch >= "\u2e80")
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def lane_for(input_type: str) -> str:
+    """查询走交互通道，文档导入走批量通道"""
+    return LANE_INTERACTIVE if input_type == INPUT_TYPE_QUERY else LANE_INGEST
+
+
+def _is_throttled(error: Exception) -> Optional[int]:
+    """返回 413/429 状态码（请求过大或被限流），其他错误返回 None"""
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (
+        413,
+        429,
+    ):
+        return error.response.status_code
+    return None
+
+
+# 服务端通过 Retry-After 要求等待到的时间点（time.monotonic()）
+_retry_after_until = 0.0
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """解析 429/503 响应的 Retry-After（秒数或 HTTP 日期），并记录等待截止时间"""
+    global _retry_after_until
+    if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code not in (
+        429,
+        503,
+    ):
+        return None
+    value = error.response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    seconds = max(0.0, seconds)
+    _retry_after_until = max(_retry_after_until, time.monotonic() + seconds)
+    return seconds
 
 
-def generate_embeddings(texts: List[str]) -> List[List[float]]:
+def get_retry_after_remaining() -> Optional[float]:
+    """距服务端 Retry-After 要求的时间点还剩的秒数，没有等待要求时返回 None"""
+    remaining = _retry_after_until - time.monotonic()
+    return remaining if remaining > 0 else None
+
+
+class AdaptiveBatchSizer:
+    """
+    嵌入请求批次大小的自适应调整（加性增、乘性减）。
+
+    满批请求的延迟低于目标延迟时逐步增大批次；延迟超过目标两倍或收到 413/429 时批次减半。
+    所有嵌入请求共享同一个实例，调整结果在多次导入之间保留。
+    """
+
+    def __init__(
+        self,
+        initial: int = EMBEDDING_BATCH_SIZE,
+        maximum: int = EMBEDDING_MAX_BATCH_SIZE,
+        max_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+        target_latency: float = EMBEDDING_TARGET_BATCH_LATENCY,
+    ):
+        self.maximum = maximum
+        self.max_tokens = max_tokens
+        self.target_latency = target_latency
+        self._batch_size = max(1, min(initial, maximum))
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    def next_batch(
+        self, token_counts: List[int], start: int, batch_size: Optional[int] = None
+    ) -> int:
+        """
+        从 start 开始按文本数量和 token 上限打包下一批，返回批次的结束位置（不含）。
+
+        单个文本超过 token 上限时单独成批。
+        """
+        limit = min(batch_size or self._batch_size, self.maximum)
+        end = start
+        tokens = 0
+        while end < len(token_counts) and end - start < limit:
+            if end > start and tokens + token_counts[end] > self.max_tokens:
+                break
+            tokens += token_counts[end]
+            end += 1
+        return end
+
+    def record_success(self, batch_len: int, latency: float):
+        with self._lock:
+            if latency > self.target_latency * 2:
+                self._shrink(batch_len, f"延迟 {latency:.2f}s")
+            elif latency < self.target_latency and batch_len >= self._batch_size:
+                # 只有满批请求才能说明还有增大的空间
+                self._batch_size = min(
+                    self.maximum, self._batch_size + max(1, self._batch_size // 4)
+                )
+
+    def record_throttled(self, batch_len: int, status_code: int):
+        with self._lock:
+            self._shrink(batch_len, f"状态码 {status_code}")
+
+    def _shrink(self, batch_len: int, reason: str):
+        # 以出错批次的大小为准减半：并发在途的多个批次同时失败时只收缩一次
+        new_size = max(1, min(self._batch_size, batch_len // 2))
+        if new_size != self._batch_size:
+            print(
+                f"[embedding] {reason}，批处理大小 {self._batch_size} -> {new_size}"
+            )
+        self._batch_size = new_size
+
+
+_batch_sizer = AdaptiveBatchSizer()
+
+
+def get_batch_sizer() -> AdaptiveBatchSizer:
+    """获取共享的批次大小调整器"""
+    return _batch_sizer
+
+
+def _record_batch_success(batch: List[str], input_type: str, elapsed: float):
+    lane = lane_for(input_type)
+    EMBEDDING_BATCH_TEXTS.labels(lane).observe(len(batch))
+    EMBEDDING_REQUEST_SECONDS.labels(lane, "success").observe(elapsed)
+
+
+def _record_batch_error(error: Exception, input_type: str, elapsed: float) -> str:
+    """记录一次失败的请求，返回失败原因（HTTP 状态码或 error）"""
+    EMBEDDING_REQUEST_SECONDS.labels(lane_for(input_type), "error").observe(elapsed)
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    return "error"
+
+
+def _generate_batch_with_retry(
+    batch: List[str],
+    batch_num: int,
+    out: np.ndarray,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+):
+    """
+    同步处理单个批次，结果直接写入 out（预分配结果中对应本批的切片）。
+
+    413 时拆半处理，其他失败退避重试；达到最大重试次数后写入零向量。
+    """
+    sizer = get_batch_sizer()
+    max_retries = EMBEDDING_MAX_RETRIES
+    for retry in range(1, max_retries + 1):
+        started = time.monotonic()
+        try:
+            get_embedding_model().generate_batch_embeddings(batch, input_type, out)
+            elapsed = time.monotonic() - started
+            sizer.record_success(len(batch), elapsed)
+            _record_batch_success(batch, input_type, elapsed)
+            print(f"[embedding] 批次 {batch_num} 处理成功")
+            return
+        except Exception as e:
+            reason = _record_batch_error(e, input_type, time.monotonic() - started)
+            print(
+                f"[embedding] 批次 {batch_num} 处理失败 (尝试 {retry}/{max_retries}): {str(e)}"
+            )
+            status_code = _is_throttled(e)
+            retry_after = _retry_after(e)
+            if status_code is not None:
+                sizer.record_throttled(len(batch), status_code)
+                if status_code == 429:
+                    # 限流时暂停调度器放行新请求，避免其他批次继续触发限流
+                    get_embedding_model().get_scheduler().pause(retry_after or 0)
+                if status_code == 413 and len(batch) > 1:
+                    EMBEDDING_RETRIES.labels("split").inc()
+                    middle = len(batch) // 2
+                    _generate_batch_with_retry(
+                        batch[:middle], batch_num, out[:middle], input_type
+                    )
+                    _generate_batch_with_retry(
+                        batch[middle:], batch_num, out[middle:], input_type
+                    )
+                    return
+
+            if retry_after is not None and retry_after > EMBEDDING_MAX_RETRY_AFTER:
+                print(f"[embedding] 服务端要求 {retry_after:.0f} 秒后重试，本批次交给重试队列处理")
+                break
+            if retry < max_retries:
+                # 逐步增加等待时间，服务端给出 Retry-After 时不早于该时间
+                wait_time = max(retry * 2, retry_after or 0)
+                EMBEDDING_RETRIES.labels(reason).inc()
+                print(f"[embedding] 等待 {wait_time} 秒后重试...")
+                time.sleep(wait_time)
+
+    print(f"[embedding] 批次 {batch_num} 达到最大重试次数，标记为失败（零向量）")
+    EMBEDDING_FAILED_TEXTS.inc(len(batch))
+    # 失败的批次写入零向量作为标记，调用方据此把对应文本加入重试队列而不是写入索引
+    out[...] = 0.0
+
+
+def generate_embeddings(
+    texts: List[str],
+    batch_size: Optional[int] = None,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+) -> np.ndarray:
     """
     为一组文本生成嵌入向量
 
+    文本按数量和估算 token 数打包成批，批次大小由 AdaptiveBatchSizer 根据延迟和限流响应调整。
+    结果数组一次性预分配，各批次的响应直接解码写入对应的行。
+
     Args:
         texts: 要处理的文本列表
+        batch_size: 固定每次请求的文本数量（最大 EMBEDDING_MAX_BATCH_SIZE），默认自适应
+        input_type: Cohere 嵌入类型，默认为文档类型
 
     Returns:
-        List[List[float]]: 嵌入向量列表，每个向量对应一个输入文本
+        np.ndarray: (len(texts), dimension) 的 float32 数组，每行对应一个输入文本；
+        生成失败的文本对应全零行
     """
-    if not texts:
-        return []
-
-    # 如果没有设置API密钥，返回零向量
-    if not COHERE_API_KEY:
-        print("[embedding] 警告: 未设置COHERE_API_KEY，返回零向量")
-        return [[0.0] * EMBEDDING_DIMENSION for _ in range(len(texts))]
+    model = get_embedding_model()
+    # 后端不可用（如未设置API密钥）时返回零向量
+    if not texts or not model.is_available():
+        if texts:
+            print("[embedding] 警告: 嵌入后端不可用（未设置COHERE_API_KEY），返回零向量")
+        return model.zeros(len(texts))
 
-    # 获取配置参数
-    batch_size = EMBEDDING_BATCH_SIZE
-    max_retries = EMBEDDING_MAX_RETRIES
-    all_embeddings = []
+    sizer = get_batch_sizer()
+    token_counts = [estimate_tokens(text) for text in texts]
+    all_embeddings = np.empty((len(texts), model.get_dimension()), dtype=np.float32)
 
     print(
-        f"[embedding] 使用Cohere模型({COHERE_EMBEDDING_MODEL})为{len(texts)}个文本生成嵌入向量"
+        f"[embedding] 使用模型({model.get_model_name()})为{len(texts)}个文本生成嵌入向量"
+    )
+    print(
+        f"[embedding] 批处理大小: {batch_size or sizer.batch_size}, 最大重试次数: {EMBEDDING_MAX_RETRIES}"
     )
-    print(f"[embedding] 批处理大小: {batch_size}, 最大重试次数: {max_retries}")
 
-    # 分批处理文本
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i : i + batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (len(texts) + batch_size - 1) // batch_size
+    # 分批处理文本，每批在调度器放行后按最新的批次大小打包
+    scheduler = model.get_scheduler()
+    lane = lane_for(input_type)
+    start = 0
+    batch_num = 0
+    while start < len(texts):
+        scheduler.acquire_blocking(lane)
+        try:
+            end = sizer.next_batch(token_counts, start, batch_size)
+            batch_num += 1
+            _generate_batch_with_retry(
+                texts[start:end], batch_num, all_embeddings[start:end], input_type
+            )
+        finally:
+            scheduler.release(lane)
+        start = end
+
+    print(f"[embedding] 完成所有批次处理，共生成 {len(all_embeddings)} 个嵌入向量")
+    return all_embeddings
 
-        print(f"[embedding] 处理批次 {batch_num}/{total_batches}")
 
-        # 重试逻辑
-        for retry in range(1, max_retries + 1):
-            try:
-                batch_embeddings = get_embedding_model().generate_batch_embeddings(
-                    batch
-                )
-                all_embeddings.extend(batch_embeddings)
-                print(f"[embedding] 批次 {batch_num} 处理成功")
+async def _agenerate_batch_with_retry(
+    batch: List[str],
+    batch_num: int,
+    out: np.ndarray,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+):
+    """_generate_batch_with_retry 的异步版本，重试等待不阻塞事件循环"""
+    sizer = get_batch_sizer()
+    max_retries = EMBEDDING_MAX_RETRIES
+    for retry in range(1, max_retries + 1):
+        started = time.monotonic()
+        try:
+            await get_embedding_model().agenerate_batch_embeddings(
+                batch, input_type, out
+            )
+            elapsed = time.monotonic() - started
+            sizer.record_success(len(batch), elapsed)
+            _record_batch_success(batch, input_type, elapsed)
+            print(f"[embedding] 批次 {batch_num} 处理成功")
+            return
+        except Exception as e:
+            reason = _record_batch_error(e, input_type, time.monotonic() - started)
+            print(
+                f"[embedding] 批次 {batch_num} 处理失败 (尝试 {retry}/{max_retries}): {str(e)}"
+            )
+            status_code = _is_throttled(e)
+            retry_after = _retry_after(e)
+            if status_code is not None:
+                sizer.record_throttled(len(batch), status_code)
+                if status_code == 429:
+                    # 限流时暂停调度器放行新请求，避免其他批次继续触发限流
+                    get_embedding_model().get_scheduler().pause(retry_after or 0)
+                if status_code == 413 and len(batch) > 1:
+                    EMBEDDING_RETRIES.labels("split").inc()
+                    middle = len(batch) // 2
+                    await _agenerate_batch_with_retry(
+                        batch[:middle], batch_num, out[:middle], input_type
+                    )
+                    await _agenerate_batch_with_retry(
+                        batch[middle:], batch_num, out[middle:], input_type
+                    )
+                    return
+
+            if retry_after is not None and retry_after > EMBEDDING_MAX_RETRY_AFTER:
+                print(f"[embedding] 服务端要求 {retry_after:.0f} 秒后重试，本批次交给重试队列处理")
                 break
-            except Exception as e:
-                print(
-                    f"[embedding] 批次 {batch_num} 处理失败 (尝试 {retry}/{max_retries}): {str(e)}"
-                )
+            if retry < max_retries:
+                # 逐步增加等待时间，服务端给出 Retry-After 时不早于该时间
+                wait_time = max(retry * 2, retry_after or 0)
+                EMBEDDING_RETRIES.labels(reason).inc()
+                print(f"[embedding] 等待 {wait_time} 秒后重试...")
+                await asyncio.sleep(wait_time)
 
-                if retry < max_retries:
-                    wait_time = retry * 2  # 逐步增加等待时间
-                    print(f"[embedding] 等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
-                else:
-                    print(
-                        f"[embedding] 批次 {batch_num} 达到最大重试次数，使用零向量替代"
-                    )
-                    # 对于失败的批次，使用零向量替代
-                    zero_embeddings = [
-                        [0.0] * EMBEDDING_DIMENSION for _ in range(len(batch))
-                    ]
-                    all_embeddings.extend(zero_embeddings)
+    print(f"[embedding] 批次 {batch_num} 达到最大重试次数，标记为失败（零向量）")
+    EMBEDDING_FAILED_TEXTS.inc(len(batch))
+    out[...] = 0.0
+
+
+async def agenerate_embeddings(
+    texts: List[str],
+    batch_size: Optional[int] = None,
+    input_type: str = INPUT_TYPE_DOCUMENT,
+) -> np.ndarray:
+    """
+    generate_embeddings 的异步版本
+
+    各批次并发发送，由共享的 EmbeddingScheduler 限制并发与速率，查询批次优先于导入批次；
+    每个批次在被调度器放行时才打包，因此会使用最新调整后的批次大小。
+    重试等待使用 asyncio.sleep，不会阻塞事件循环上的其他请求。
+
+    Args:
+        texts: 要处理的文本列表
+        batch_size: 固定每次请求的文本数量（最大 EMBEDDING_MAX_BATCH_SIZE），默认自适应
+        input_type: Cohere 嵌入类型，默认为文档类型
+
+    Returns:
+        np.ndarray: (len(texts), dimension) 的 float32 数组，与输入文本顺序一致
+    """
+    model = get_embedding_model()
+    if not texts or not model.is_available():
+        if texts:
+            print("[embedding] 警告: 嵌入后端不可用（未设置COHERE_API_KEY），返回零向量")
+        return model.zeros(len(texts))
+
+    sizer = get_batch_sizer()
+    scheduler = model.get_scheduler()
+    lane = lane_for(input_type)
+    token_counts = [estimate_tokens(text) for text in texts]
+    all_embeddings = np.empty((len(texts), model.get_dimension()), dtype=np.float32)
+
+    print(
+        f"[embedding] 使用模型({model.get_model_name()})为{len(texts)}个文本异步生成嵌入向量"
+    )
+    print(
+        f"[embedding] 批处理大小: {batch_size or sizer.batch_size}, 并发上限: {model.max_concurrency}"
+    )
+
+    async def run_batch(batch: List[str], batch_num: int, out: np.ndarray):
+        try:
+            await _agenerate_batch_with_retry(batch, batch_num, out, input_type)
+        finally:
+            scheduler.release(lane)
+
+    tasks: List[asyncio.Task] = []
+    start = 0
+    try:
+        while start < len(texts):
+            await scheduler.acquire(lane)
+            end = sizer.next_batch(token_counts, start, batch_size)
+            tasks.append(
+                asyncio.ensure_future(
+                    run_batch(texts[start:end], len(tasks) + 1, all_embeddings[start:end])
+                )
+            )
+            start = end
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
     print(f"[embedding] 完成所有批次处理，共生成 {len(all_embeddings)} 个嵌入向量")
     return all_embeddings
+
+
+def normalize_query(text: str) -> str:
+    """查询文本归一化：Unicode NFKC、合并空白、忽略大小写"""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    查询向量的 LRU 缓存，键为 (模型名, 归一化后的查询文本)。
+
+    命中时直接返回已缓存的向量，跳过嵌入接口调用；记录命中/未命中次数用于观察命中率。
+    """
+
+    def __init__(self, capacity: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: Tuple[str, str], vector: np.ndarray):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_query_cache = QueryEmbeddingCache()
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    """获取共享的查询向量缓存"""
+    return _query_cache
+
+
+def _lookup_queries(texts: List[str]):
+    """
+    在缓存中查找一组查询，返回 (缓存键列表, 已命中的结果, 未命中的 归一化文本 -> 原始文本)。
+
+    归一化文本只用作缓存和合并请求的键；发送给嵌入接口的是每个键首次出现时的原始文本，
+    查询向量与按原文嵌入的文档保持一致。
+    """
+    cache = get_query_cache()
+    model_name = get_embedding_model().get_model_name()
+    keys = [(model_name, normalize_query(text)) for text in texts]
+    results: List[Optional[np.ndarray]] = [cache.get(key) for key in keys]
+    missing: Dict[str, str] = {}
+    for text, key, result in zip(texts, keys, results):
+        if result is None:
+            missing.setdefault(key[1], text)
+    return keys, results, missing
+
+
+def _cache_queries(model_name: str, normalized: List[str], embeddings: np.ndarray):
+    """
+    把新生成的查询向量按归一化文本写入缓存，返回 归一化文本 -> 向量；
+    生成失败（全零向量）的结果不缓存
+    """
+    cache = get_query_cache()
+    embedded = {}
+    for key, vector in zip(normalized, embeddings):
+        if vector.any():
+            # 复制单行，避免缓存条目引用整批结果数组
+            vector = vector.copy()
+            cache.put((model_name, key), vector)
+            embedded[key] = vector
+    return embedded
+
+
+def _fill_queries(keys, results, embedded: Dict[str, Optional[np.ndarray]]):
+    """用新生成的向量补全缓存未命中的结果"""
+    return [
+        result if result is not None else embedded.get(key[1])
+        for key, result in zip(keys, results)
+    ]
+
+
+class QueryMicroBatcher:
+    """
+    异步查询嵌入的微批处理器。
+
+    并发到达的查询先进入待发送队列，等待 max_wait 秒或攒够 max_batch 个后合并为一次
+    search_query 请求；相同的（归一化后）查询文本在等待或请求期间共享同一个 future，
+    只请求一次。突发流量下以几毫秒的延迟换取更少的上游请求数。
+    """
+
+    def __init__(
+        self,
+        max_wait_ms: float = QUERY_EMBEDDING_BATCH_WAIT_MS,
+        max_batch: int = QUERY_EMBEDDING_MAX_BATCH,
+    ):
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.max_batch = max(1, min(max_batch, EMBEDDING_MAX_BATCH_SIZE))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Dict[str, asyncio.Future] = {}  # 归一化文本 -> future
+        self._pending_texts: Dict[str, str] = {}  # 归一化文本 -> 发送给接口的原始文本
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self._requests = 0
+        self._coalesced = 0
+        self._batches = 0
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # 切换到新的事件循环（如测试或重启）时丢弃旧循环上的状态
+            self._loop = loop
+            self._pending = {}
+            self._pending_texts = {}
+            self._in_flight = {}
+            self._flush_handle = None
+        return loop
+
+    async def embed(self, queries: Dict[str, str]) -> List[Optional[np.ndarray]]:
+        """
+        为一组去重后的查询（归一化文本 -> 原始文本）生成嵌入，按 queries 的顺序返回，
+        失败的查询对应 None
+        """
+        loop = self._bind_loop()
+        futures = []
+        for key, text in queries.items():
+            self._requests += 1
+            future = self._in_flight.get(key) or self._pending.get(key)
+            if future is not None:
+                self._coalesced += 1
+            else:
+                future = loop.create_future()
+                self._pending[key] = future
+                self._pending_texts[key] = text
+                if len(self._pending) >= self.max_batch:
+                    self._flush()
+                elif self._flush_handle is None:
+                    self._flush_handle = loop.call_later(self.max_wait, self._flush)
+            futures.append(future)
+        # shield: 单个调用方被取消时不影响共享同一 future 的其他调用方
+        return list(await asyncio.gather(*(asyncio.shield(f) for f in futures)))
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        texts, self._pending_texts = self._pending_texts, {}
+        self._in_flight.update(batch)
+        self._batches += 1
+        task = self._loop.create_task(self._run(batch, texts))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[str, asyncio.Future], texts: Dict[str, str]):
+        keys = list(batch)
+        try:
+            model_name = get_embedding_model().get_model_name()
+            embeddings = await agenerate_embeddings(
+                [texts[key] for key in keys],
+                batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                input_type=INPUT_TYPE_QUERY,
+            )
+            embedded = _cache_queries(model_name, keys, embeddings)
+            for key, future in batch.items():
+                if not future.done():
+                    future.set_result(embedded.get(key))
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # 所有调用方都已取消时避免“异常未被读取”的警告
+                    future.exception()
+        finally:
+            for key, future in batch.items():
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+
+    def stats(self) -> Dict[str, float]:
+        """提交的查询数、合并到已有请求的查询数、实际发送的批次数和平均批大小"""
+        sent = self._requests - self._coalesced
+        return {
+            "requests": self._requests,
+            "coalesced": self._coalesced,
+            "batches": self._batches,
+            "avg_batch_size": sent / self._batches if self._batches else 0.0,
+            "pending": len(self._pending),
+            "in_flight": len(self._in_flight),
+        }
+
+
+_query_batcher = QueryMicroBatcher()
+
+
+def get_query_batcher() -> QueryMicroBatcher:
+    """获取共享的查询嵌入微批处理器"""
+    return _query_batcher
+
+
+def embed_queries(texts: List[str]) -> List[Optional[np.ndarray]]:
+    """
+    为一组用户查询生成 search_query 类型的嵌入，先查 LRU 缓存，只为未命中的查询调用接口。
+
+    Returns:
+        与输入顺序一致的 float32 向量列表；生成失败的查询对应 None
+    """
+    if not texts:
+        return []
+    keys, results, missing = _lookup_queries(texts)
+    if not missing:
+        return results
+    embeddings = generate_embeddings(
+        list(missing.values()),
+        batch_size=EMBEDDING_MAX_BATCH_SIZE,
+        input_type=INPUT_TYPE_QUERY,
+    )
+    return _fill_queries(
+        keys, results, _cache_queries(keys[0][0], list(missing), embeddings)
+    )
+
+
+async def aembed_queries(texts: List[str]) -> List[Optional[np.ndarray]]:
+    """
+    embed_queries 的异步版本；缓存未命中的查询经 QueryMicroBatcher 与其他并发请求合并发送
+    """
+    if not texts:
+        return []
+    keys, results, missing = _lookup_queries(texts)
+    if not missing:
+        return results
+    vectors = await get_query_batcher().embed(missing)
+    return _fill_queries(keys, results, dict(zip(missing, vectors)))
+
+
+def embed_query(text: str) -> Optional[np.ndarray]:
+    """为单个用户查询生成嵌入，命中缓存时不调用接口；失败时返回 None"""
+    return embed_queries([text])[0]
+
+
+async def aembed_query(text: str) -> Optional[np.ndarray]:
+    """embed_query 的异步版本"""
+    return (await aembed_queries([text]))[0]
+
+
+def cached_query_embedding(text: str) -> Optional[np.ndarray]:
+    """只在查询向量缓存中查找，不调用嵌入接口；未命中时返回 None"""
+    model_name = get_embedding_model().get_model_name()
+    return get_query_cache().get((model_name, normalize_query(text)))
+
+
+def _lookup_documents(texts: List[str]):
+    """
+    在持久化缓存中查找文档嵌入，返回 (缓存, 已命中的位置 -> 向量, 未命中的去重文本)
+    """
+    cache = get_embedding_cache()
+    hits: Dict[int, np.ndarray] = {}
+    if cache is not None:
+        try:
+            hits = cache.get_many(
+                get_embedding_model().get_model_name(), INPUT_TYPE_DOCUMENT, texts
+            )
+        except Exception as e:
+            print(f"[embedding] 读取嵌入缓存失败，全部重新生成: {e}")
+            cache = None
+    missing = list(
+        dict.fromkeys(text for i, text in enumerate(texts) if i not in hits)
+    )
+    return cache, hits, missing
+
+
+def _merge_documents(texts, cache, hits, missing, embeddings: np.ndarray):
+    """把新生成的文档嵌入写入缓存（全零的失败结果不写入），并按输入顺序合并结果"""
+    stats = {"cache_hits": len(hits), "cache_misses": len(texts) - len(hits)}
+    if cache is not None and missing:
+        generated = embeddings.any(axis=1)
+        try:
+            cache.put_many(
+                get_embedding_model().get_model_name(),
+                INPUT_TYPE_DOCUMENT,
+                [(text, embeddings[row]) for row, text in enumerate(missing) if generated[row]],
+            )
+        except Exception as e:
+            print(f"[embedding] 写入嵌入缓存失败: {e}")
+    print(
+        f"[embedding] 嵌入缓存命中 {stats['cache_hits']} 个，未命中 {stats['cache_misses']} 个"
+        f"（去重后请求 {len(missing)} 个）"
+    )
+    if len(missing) == len(texts):
+        # 没有命中也没有重复文本时，生成结果即为最终结果，无需复制
+        return embeddings, stats
+
+    result = np.empty((len(texts), get_embedding_dimension()), dtype=np.float32)
+    for position, vector in hits.items():
+        result[position] = vector
+    if missing:
+        row_of = {text: row for row, text in enumerate(missing)}
+        positions = [i for i in range(len(texts)) if i not in hits]
+        result[positions] = embeddings[[row_of[texts[i]] for i in positions]]
+    return result, stats
+
+
+def embed_documents(texts: List[str]) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    为文档块生成 search_document 类型的嵌入，先查持久化缓存，只为未命中的文本调用接口。
+
+    Returns:
+        ((len(texts), dimension) 的 float32 数组, {"cache_hits": 命中数, "cache_misses": 未命中数})
+    """
+    cache, hits, missing = _lookup_documents(texts)
+    embeddings = generate_embeddings(missing)
+    return _merge_documents(texts, cache, hits, missing, embeddings)
+
+
+async def aembed_documents(texts: List[str]) -> Tuple[np.ndarray, Dict[str, int]]:
+    """embed_documents 的异步版本，缓存读写在线程池中执行"""
+    cache, hits, missing = await asyncio.to_thread(_lookup_documents, texts)
+    embeddings = await agenerate_embeddings(missing)
+    return await asyncio.to_thread(
+        _merge_documents, texts, cache, hits, missing, embeddings
+    )
+
+
+async def close_embedding_clients():
+    """关闭嵌入服务持有的异步HTTP客户端（应用关闭时调用）"""
+    await get_embedding_model().aclose()
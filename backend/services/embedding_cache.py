@@ -0,0 +1,205 @@
+# 嵌入向量持久化缓存：按 (模型, 嵌入类型, 文本 sha256) 保存已生成的向量，重复导入和重建时不再调用嵌入接口
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from config import (
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_TTL_SECONDS,
+)
+
+# SQLite 单条语句允许的参数个数有限，批量查询时分段执行
+_SQL_BATCH_SIZE = 500
+# 超出容量时一次淘汰到容量的该比例，避免每次写入都触发淘汰
+_EVICT_TO_RATIO = 0.9
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    以 SQLite 存储的内容寻址嵌入缓存。
+
+    每条记录的主键为 (模型名, 嵌入类型, 文本 sha256)，值为 float32 向量。
+    读取命中时刷新 last_used；条目数超过 max_entries 时按 last_used 淘汰最久未使用的记录，
+    设置了 ttl_seconds 时，超过有效期的记录视为未命中并在淘汰时删除。
+    """
+
+    def __init__(
+        self,
+        db_file: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        ttl_seconds: Optional[float] = EMBEDDING_CACHE_TTL_SECONDS,
+    ):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self._init_schema()
+        self._count = self._query_count()
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    input_type TEXT NOT NULL,
+                    text_hash BLOB NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, input_type, text_hash)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)"
+            )
+
+    def _query_count(self) -> int:
+        row = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return int(row[0])
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get_many(
+        self, model: str, input_type: str, texts: List[str]
+    ) -> Dict[int, np.ndarray]:
+        """
+        查找一组文本的缓存向量。
+
+        Returns:
+            文本在 texts 中的位置 -> 向量；未命中或已过期的文本不在结果中
+        """
+        digests = [text_digest(text) for text in texts]
+        positions: Dict[bytes, List[int]] = {}
+        for position, digest in enumerate(digests):
+            positions.setdefault(digest, []).append(position)
+
+        now = time.time()
+        min_created = now - self.ttl_seconds if self.ttl_seconds else 0.0
+        unique = list(positions)
+        result: Dict[int, np.ndarray] = {}
+        hit_digests = []
+        conn = self._connection()
+        for start in range(0, len(unique), _SQL_BATCH_SIZE):
+            batch = unique[start : start + _SQL_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND input_type = ?"
+                f" AND created_at >= ? AND text_hash IN ({placeholders})",
+                [model, input_type, min_created, *batch],
+            )
+            for digest, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float32)
+                for position in positions[digest]:
+                    result[position] = vector
+                hit_digests.append(digest)
+
+        if hit_digests:
+            with self._write_lock, conn:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND input_type = ? AND text_hash = ?",
+                    [(now, model, input_type, digest) for digest in hit_digests],
+                )
+        return result
+
+    def put_many(
+        self,
+        model: str,
+        input_type: str,
+        items: Iterable[Tuple[str, np.ndarray]],
+    ):
+        """写入 (文本, 向量) 列表，已存在的记录会被覆盖"""
+        now = time.time()
+        rows = {
+            text_digest(text): np.asarray(vector, dtype=np.float32).tobytes()
+            for text, vector in items
+        }
+        if not rows:
+            return
+        conn = self._connection()
+        with self._write_lock:
+            with conn:
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (model, input_type, text_hash, vector, created_at, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (model, input_type, digest, blob, now, now)
+                        for digest, blob in rows.items()
+                    ],
+                )
+                self._count += conn.total_changes - before
+                conn.executemany(
+                    "UPDATE embeddings SET vector = ?, created_at = ?, last_used = ?"
+                    " WHERE model = ? AND input_type = ? AND text_hash = ? AND created_at < ?",
+                    [
+                        (blob, now, now, model, input_type, digest, now)
+                        for digest, blob in rows.items()
+                    ],
+                )
+            if self._count > self.max_entries:
+                self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """删除过期记录，并按 last_used 淘汰到容量的 90%"""
+        with conn:
+            if self.ttl_seconds:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE created_at < ?",
+                    (time.time() - self.ttl_seconds,),
+                )
+            excess = self._query_count() - int(self.max_entries * _EVICT_TO_RATIO)
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE (model, input_type, text_hash) IN"
+                    " (SELECT model, input_type, text_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+        self._count = self._query_count()
+        print(f"[embedding_cache] 已淘汰旧记录，当前缓存 {self._count} 条嵌入向量")
+
+    def clear(self):
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM embeddings")
+            self._count = 0
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """获取共享的嵌入缓存；EMBEDDING_CACHE_MAX_ENTRIES 为 0 时禁用缓存"""
+    global _embedding_cache
+    if EMBEDDING_CACHE_MAX_ENTRIES <= 0:
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
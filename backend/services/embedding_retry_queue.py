@@ -0,0 +1,233 @@
+# 嵌入重试队列：重试耗尽仍未生成嵌入的文档块持久化在 SQLite 中，不写入索引，由后台任务退避重试
+import json
+import random
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import (
+    EMBEDDING_RETRY_BASE_DELAY_SECONDS,
+    EMBEDDING_RETRY_MAX_ATTEMPTS,
+    EMBEDDING_RETRY_MAX_DELAY_SECONDS,
+)
+from langchain_core.documents import Document as LangchainDocument
+from services.chunk_store import document_key
+
+RETRY_DB_EXTENSION = ".retry.db"
+
+# SQLite 单条语句允许的参数个数有限，批量操作时分段执行
+_SQL_BATCH_SIZE = 500
+
+
+class EmbeddingRetryQueue:
+    """
+    嵌入失败的文档块队列。
+
+    每个条目保存文档块内容、元数据、所属文档、已重试次数和下次重试时间。
+    下次重试时间按指数退避并加入随机抖动，服务端返回 Retry-After 时不早于该时间；
+    重试次数达到 max_attempts 后 next_attempt_at 置空，条目保留但不再自动重试。
+    """
+
+    def __init__(
+        self,
+        path_prefix: str,
+        max_attempts: int = EMBEDDING_RETRY_MAX_ATTEMPTS,
+        base_delay: float = EMBEDDING_RETRY_BASE_DELAY_SECONDS,
+        max_delay: float = EMBEDDING_RETRY_MAX_DELAY_SECONDS,
+    ):
+        self.db_file = path_prefix + RETRY_DB_EXTENSION
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pending_chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_id TEXT NOT NULL,
+                    page_content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_next_attempt ON pending_chunks(next_attempt_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_document_id ON pending_chunks(document_id)"
+            )
+
+    def _backoff(self, attempts: int, retry_after: Optional[float]) -> float:
+        """第 attempts 次失败后的等待时间：指数退避取 [50%, 100%] 的随机值，且不短于 Retry-After"""
+        delay = min(self.max_delay, self.base_delay * (2**attempts))
+        delay *= random.uniform(0.5, 1.0)
+        return max(delay, retry_after or 0.0)
+
+    def add_many(
+        self,
+        documents: List[LangchainDocument],
+        document_id: Optional[str] = None,
+        retry_after: Optional[float] = None,
+    ) -> int:
+        """把嵌入失败的文档块加入队列，返回加入的条目数"""
+        now = time.time()
+        rows = [
+            (
+                document_id or document_key(doc),
+                doc.page_content,
+                json.dumps(doc.metadata, ensure_ascii=False, default=str),
+                now + self._backoff(0, retry_after),
+                now,
+            )
+            for doc in documents
+        ]
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO pending_chunks (document_id, page_content, metadata, next_attempt_at, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def due(
+        self, limit: int, now: Optional[float] = None
+    ) -> List[Tuple[int, str, LangchainDocument]]:
+        """返回已到重试时间的条目 (条目 ID, 文档标识, 文档块)，按到期时间排序"""
+        now = time.time() if now is None else now
+        rows = self._connection().execute(
+            "SELECT id, document_id, page_content, metadata FROM pending_chunks"
+            " WHERE next_attempt_at IS NOT NULL AND next_attempt_at <= ?"
+            " ORDER BY next_attempt_at LIMIT ?",
+            (now, limit),
+        )
+        return [
+            (
+                entry_id,
+                document_id,
+                LangchainDocument(page_content=page_content, metadata=json.loads(metadata)),
+            )
+            for entry_id, document_id, page_content, metadata in rows
+        ]
+
+    def next_due_in(self) -> Optional[float]:
+        """距最早一个条目到期的秒数；没有待重试条目时返回 None"""
+        row = (
+            self._connection()
+            .execute("SELECT MIN(next_attempt_at) FROM pending_chunks")
+            .fetchone()
+        )
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def existing(self, entry_ids: Iterable[int]) -> List[int]:
+        """返回仍在队列中的条目 ID（所属文档被删除后条目会被移除）"""
+        ids = [int(entry_id) for entry_id in entry_ids]
+        result: List[int] = []
+        conn = self._connection()
+        for start in range(0, len(ids), _SQL_BATCH_SIZE):
+            batch = ids[start : start + _SQL_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT id FROM pending_chunks WHERE id IN ({placeholders})", batch
+            )
+            result.extend(row[0] for row in rows)
+        return result
+
+    def reschedule(self, entry_ids: Iterable[int], retry_after: Optional[float] = None) -> int:
+        """
+        记录一次失败并安排下次重试，返回因达到最大重试次数而放弃的条目数。
+        """
+        ids = [int(entry_id) for entry_id in entry_ids]
+        now = time.time()
+        abandoned = 0
+        conn = self._connection()
+        with conn:
+            for start in range(0, len(ids), _SQL_BATCH_SIZE):
+                batch = ids[start : start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT id, attempts FROM pending_chunks WHERE id IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                updates = []
+                for entry_id, attempts in rows:
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        next_attempt_at = None
+                        abandoned += 1
+                    else:
+                        next_attempt_at = now + self._backoff(attempts, retry_after)
+                    updates.append((attempts, next_attempt_at, entry_id))
+                conn.executemany(
+                    "UPDATE pending_chunks SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                    updates,
+                )
+        return abandoned
+
+    def remove_many(self, entry_ids: Iterable[int]):
+        ids = [int(entry_id) for entry_id in entry_ids]
+        conn = self._connection()
+        with conn:
+            for start in range(0, len(ids), _SQL_BATCH_SIZE):
+                batch = ids[start : start + _SQL_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                conn.execute(f"DELETE FROM pending_chunks WHERE id IN ({placeholders})", batch)
+
+    def remove_document(self, document_id: str) -> int:
+        """删除指定文档的全部条目，返回删除的条目数"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM pending_chunks WHERE document_id = ?", (document_id,)
+            )
+        return cursor.rowcount
+
+    def document_counts(self, document_id: str) -> Tuple[int, int]:
+        """返回指定文档 (等待重试的条目数, 已放弃重试的条目数)"""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(next_attempt_at), COUNT(*) - COUNT(next_attempt_at)"
+                " FROM pending_chunks WHERE document_id = ?",
+                (document_id,),
+            )
+            .fetchone()
+        )
+        return int(row[0]), int(row[1])
+
+    def stats(self) -> Dict[str, int]:
+        """队列中等待重试和已放弃重试的条目总数"""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT COUNT(next_attempt_at), COUNT(*) - COUNT(next_attempt_at) FROM pending_chunks"
+            )
+            .fetchone()
+        )
+        return {"pending": int(row[0]), "abandoned": int(row[1])}
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM pending_chunks")
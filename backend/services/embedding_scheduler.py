@@ -0,0 +1,245 @@
+# 嵌入请求调度：令牌桶限速 + 并发上限，交互查询优先于批量导入
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+LANE_INTERACTIVE = "interactive"  # 用户查询
+LANE_INGEST = "ingest"  # 文档导入与后台重试
+LANES = (LANE_INTERACTIVE, LANE_INGEST)
+
+# 每条通道保留最近的等待时间样本数，用于统计分位数
+_WAIT_SAMPLES = 512
+
+
+class _Ticket:
+    """一个等待中的请求；异步调用方通过 future 唤醒，同步调用方通过 event 唤醒"""
+
+    __slots__ = ("lane", "enqueued_at", "granted", "loop", "future", "event")
+
+    def __init__(self, lane: str, loop=None, future=None, event=None):
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.loop = loop
+        self.future = future
+        self.event = event
+
+    def wake(self):
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        else:
+            self.event.set()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _LaneStats:
+    def __init__(self):
+        self.granted = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+    def record_wait(self, wait: float):
+        self.granted += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.recent_waits.append(wait)
+
+
+def _percentile(samples, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class EmbeddingScheduler:
+    """
+    所有嵌入请求共用的调度器。
+
+    每个请求（一个批次）占用一个并发名额和一个令牌，令牌按 rate_per_minute 匀速补充，
+    桶容量为 burst；rate_per_minute 为 0 时不限速。交互查询和批量导入分两条队列，
+    有交互请求等待时导入请求不会被放行。最近 pressure_window 秒内出现过交互请求时
+    视为查询压力较高，导入最多使用 max_concurrency - reserve 个名额，并为查询保留
+    reserve 个令牌。收到限流响应时令牌桶清空，导入暂停到 Retry-After 指定的时间，
+    查询只受令牌补充速度限制，不会被长时间的暂停阻塞。
+
+    异步调用方使用 acquire/release，同步调用方（线程池中的检索与导入）使用 acquire_blocking/release，
+    两者共享同一个令牌桶和并发计数。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        rate_per_minute: float = 0,
+        burst: Optional[int] = None,
+        reserve: int = 1,
+        pressure_window: float = 5.0,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst if burst else self.max_concurrency * 2)
+        # 导入至少保留一个名额，避免查询持续时导入完全停滞
+        self.reserve = max(0, min(reserve, self.max_concurrency - 1))
+        self.pressure_window = pressure_window
+
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque[_Ticket]] = {lane: deque() for lane in LANES}
+        self._stats: Dict[str, _LaneStats] = {lane: _LaneStats() for lane in LANES}
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_interactive = float("-inf")
+        self._timer: Optional[threading.Timer] = None
+        self._timer_due = 0.0
+
+    def _refill_locked(self, now: float):
+        if self.rate > 0:
+            self._tokens = min(
+                float(self.burst), self._tokens + (now - self._refilled_at) * self.rate
+            )
+        self._refilled_at = now
+
+    def _under_pressure(self, now: float) -> bool:
+        return (
+            bool(self._queues[LANE_INTERACTIVE])
+            or now - self._last_interactive < self.pressure_window
+        )
+
+    def _dispatch_locked(self):
+        """按优先级放行等待中的请求；令牌不足或暂停时安排定时唤醒"""
+        now = time.monotonic()
+        self._refill_locked(now)
+        while True:
+            if self._queues[LANE_INTERACTIVE]:
+                lane = LANE_INTERACTIVE
+            elif self._queues[LANE_INGEST]:
+                lane = LANE_INGEST
+            else:
+                return
+
+            concurrency = self.max_concurrency
+            tokens_needed = 1.0
+            if lane == LANE_INGEST and self._under_pressure(now):
+                concurrency -= self.reserve
+                tokens_needed += self.reserve
+            if self._in_flight >= concurrency:
+                # 等待名额释放，release 时会重新调度
+                return
+            if lane == LANE_INGEST and now < self._paused_until:
+                self._schedule_wakeup_locked(self._paused_until - now)
+                return
+            if self.rate > 0 and self._tokens < tokens_needed:
+                self._schedule_wakeup_locked((tokens_needed - self._tokens) / self.rate)
+                return
+
+            ticket = self._queues[lane].popleft()
+            if self.rate > 0:
+                self._tokens -= 1.0
+            self._in_flight += 1
+            stats = self._stats[lane]
+            stats.in_flight += 1
+            stats.record_wait(now - ticket.enqueued_at)
+            ticket.granted = True
+            ticket.wake()
+
+    def _schedule_wakeup_locked(self, delay: float):
+        due = time.monotonic() + delay
+        if self._timer is not None and self._timer_due <= due:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch_locked()
+
+    def _enqueue_locked(self, ticket: _Ticket):
+        if ticket.lane == LANE_INTERACTIVE:
+            self._last_interactive = ticket.enqueued_at
+        self._queues[ticket.lane].append(ticket)
+        self._dispatch_locked()
+
+    async def acquire(self, lane: str):
+        """等待放行；被取消时归还已获得的名额"""
+        loop = asyncio.get_running_loop()
+        ticket = _Ticket(lane, loop=loop, future=loop.create_future())
+        with self._lock:
+            self._enqueue_locked(ticket)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if ticket.granted:
+                    self._release_locked(lane)
+                else:
+                    self._queues[lane].remove(ticket)
+            raise
+
+    def acquire_blocking(self, lane: str):
+        """acquire 的同步版本，阻塞当前线程直到放行"""
+        ticket = _Ticket(lane, event=threading.Event())
+        with self._lock:
+            self._enqueue_locked(ticket)
+        ticket.event.wait()
+
+    def _release_locked(self, lane: str):
+        self._in_flight -= 1
+        self._stats[lane].in_flight -= 1
+        self._dispatch_locked()
+
+    def release(self, lane: str):
+        with self._lock:
+            self._release_locked(lane)
+
+    def pause(self, seconds: float):
+        """收到限流响应后暂停放行导入请求，并清空令牌桶"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._refilled_at = now
+            self._dispatch_locked()
+
+    def stats(self) -> dict:
+        """各通道的队列深度、在途请求数和等待时间（秒）"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            lanes = {}
+            for lane in LANES:
+                stats = self._stats[lane]
+                lanes[lane] = {
+                    "queue_depth": len(self._queues[lane]),
+                    "oldest_wait": (
+                        now - self._queues[lane][0].enqueued_at if self._queues[lane] else 0.0
+                    ),
+                    "in_flight": stats.in_flight,
+                    "granted": stats.granted,
+                    "avg_wait": stats.wait_total / stats.granted if stats.granted else 0.0,
+                    "p50_wait": _percentile(stats.recent_waits, 0.5),
+                    "p95_wait": _percentile(stats.recent_waits, 0.95),
+                    "max_wait": stats.wait_max,
+                }
+            return {
+                "max_concurrency": self.max_concurrency,
+                "rate_limit_per_minute": self.rate * 60,
+                "tokens": round(self._tokens, 2) if self.rate > 0 else None,
+                "in_flight": self._in_flight,
+                "paused_for": max(0.0, self._paused_until - now),
+                "query_pressure": self._under_pressure(now),
+                "lanes": lanes,
+            }
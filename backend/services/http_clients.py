@@ -0,0 +1,128 @@
+# 共享 HTTP 客户端：LLM 与嵌入服务各使用一个应用生命周期内的连接池，由 main.lifespan 创建和关闭
+import importlib.util
+from typing import Dict, Optional
+
+import httpx
+from config import (
+    HTTP2_ENABLED,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+)
+
+CLIENT_LLM = "llm"
+CLIENT_EMBEDDING = "embedding"
+
+# HTTP/2 依赖可选的 h2 包
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class ConnectionStats:
+    """
+    一个连接池的连接复用统计。
+
+    通过 httpcore 的 trace 扩展记录新建 TCP 连接和 TLS 握手的次数，
+    其余请求即复用了连接池中的已有连接。
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.http2_responses = 0
+
+    async def on_request(self, request: httpx.Request):
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def on_response(self, response: httpx.Response):
+        if response.http_version == "HTTP/2":
+            self.http2_responses += 1
+
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.new_connections += 1
+        elif event_name == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    def to_dict(self) -> Dict[str, float]:
+        reused = max(0, self.requests - self.new_connections)
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "tls_handshakes": self.tls_handshakes,
+            "reused_connections": reused,
+            "reuse_rate": reused / self.requests if self.requests else 0.0,
+            "http2_responses": self.http2_responses,
+        }
+
+
+_specs: Dict[str, dict] = {}
+_clients: Dict[str, httpx.AsyncClient] = {}
+_stats: Dict[str, ConnectionStats] = {}
+
+
+def register_http_client(
+    name: str,
+    timeout: float,
+    max_connections: int = HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+):
+    """登记一个共享客户端的超时和连接池大小，客户端在 open_http_clients 或首次使用时创建"""
+    _specs[name] = {
+        "timeout": timeout,
+        "max_connections": max_connections,
+        "max_keepalive_connections": min(max_keepalive_connections, max_connections),
+    }
+
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """获取共享的异步客户端，连接在所有请求之间复用"""
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        spec = _specs[name]
+        stats = _stats.setdefault(name, ConnectionStats())
+        http2 = HTTP2_ENABLED and HTTP2_AVAILABLE
+        print(
+            f"[http_clients] 创建 {name} 连接池: 最大连接 {spec['max_connections']}, "
+            f"保活连接 {spec['max_keepalive_connections']}, HTTP/2: {'启用' if http2 else '未启用'}"
+        )
+        client = httpx.AsyncClient(
+            timeout=spec["timeout"],
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=spec["max_connections"],
+                max_keepalive_connections=spec["max_keepalive_connections"],
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [stats.on_request], "response": [stats.on_response]},
+        )
+        _clients[name] = client
+    return client
+
+
+def open_http_clients():
+    """应用启动时创建全部已登记的客户端"""
+    if HTTP2_ENABLED and not HTTP2_AVAILABLE:
+        print("[http_clients] 未安装 h2，连接池使用 HTTP/1.1（pip install \"httpx[http2]\" 可启用 HTTP/2）")
+    for name in _specs:
+        get_http_client(name)
+
+
+async def close_http_clients():
+    """应用关闭时关闭全部客户端"""
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"[http_clients] 关闭 {name} 连接池时出错: {e}")
+    _clients.clear()
+
+
+def http_client_stats(name: Optional[str] = None) -> Dict[str, dict]:
+    """各连接池的请求数、新建连接数、TLS 握手数和连接复用率"""
+    names = [name] if name is not None else list(_specs)
+    return {
+        client_name: _stats.get(client_name, ConnectionStats()).to_dict()
+        for client_name in names
+    }
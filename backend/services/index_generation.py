@@ -0,0 +1,130 @@
+# 向量索引版本：不可变的基础索引 + 只追加的增量向量 + 删除标记，写入方发布新版本，读取方持有快照
+from typing import Any, FrozenSet, Iterable, Optional
+
+import numpy as np
+
+# 增量缓冲区初始容量（向量数），不足时按 2 倍扩容
+_INITIAL_DELTA_CAPACITY = 1024
+
+
+class _DeltaBuffer:
+    """
+    只追加的增量向量缓冲区。
+
+    多个版本共享同一个缓冲区，各自只读取前 count 行；写入方只在所有已发布版本的
+    count 之后追加，因此读取方看到的行永远不会被修改。
+    """
+
+    def __init__(self, dimension: int, capacity: int = _INITIAL_DELTA_CAPACITY):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.vectors = np.empty((capacity, dimension), dtype=np.float32)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.ids)
+
+
+class IndexGeneration:
+    """
+    一个不可变的索引版本。
+
+    base 发布后不再被修改；新增的向量追加到增量缓冲区，删除的 ID 记入 tombstones，
+    检索时在 base 上排除 tombstones，并对增量向量做精确检索后合并结果。
+    后台检查点把增量和删除标记合并成新的 base，再发布下一个版本。
+
+    number 是内容版本号，每次新增、删除或重置都会递增；合并不改变内容，版本号保持不变，
+    可用作检索/答案缓存的失效依据。
+    """
+
+    def __init__(
+        self,
+        number: int,
+        base: Any,
+        ntotal: Optional[int] = None,
+        delta: Optional[_DeltaBuffer] = None,
+        delta_count: int = 0,
+        tombstones: FrozenSet[int] = frozenset(),
+        mmapped: bool = False,
+    ):
+        self.number = number
+        self.base = base
+        self.delta = delta or _DeltaBuffer(base.d)
+        self.delta_count = delta_count
+        self.tombstones = tombstones
+        self.tombstone_array = np.fromiter(sorted(tombstones), dtype=np.int64)
+        self.mmapped = mmapped  # base 是否为只读内存映射
+        self.ntotal = base.ntotal if ntotal is None else ntotal
+
+    @property
+    def dimension(self) -> int:
+        return self.base.d
+
+    @property
+    def delta_ids(self) -> np.ndarray:
+        return self.delta.ids[: self.delta_count]
+
+    @property
+    def delta_vectors(self) -> np.ndarray:
+        return self.delta.vectors[: self.delta_count]
+
+    def with_added(self, ids: np.ndarray, vectors: np.ndarray) -> "IndexGeneration":
+        """返回追加了一批向量的新版本；当前版本看到的数据保持不变"""
+        count = self.delta_count + len(ids)
+        delta = self.delta
+        if count > delta.capacity:
+            delta = _DeltaBuffer(self.dimension, max(count, delta.capacity * 2))
+            delta.ids[: self.delta_count] = self.delta_ids
+            delta.vectors[: self.delta_count] = self.delta_vectors
+        delta.ids[self.delta_count : count] = ids
+        delta.vectors[self.delta_count : count] = vectors
+        return IndexGeneration(
+            self.number + 1,
+            self.base,
+            self.ntotal + len(ids),
+            delta,
+            count,
+            self.tombstones,
+            self.mmapped,
+        )
+
+    def with_removed(self, ids: Iterable[int]) -> "IndexGeneration":
+        """返回删除了指定 ID 的新版本"""
+        removed = frozenset(int(chunk_id) for chunk_id in ids) - self.tombstones
+        return IndexGeneration(
+            self.number + 1,
+            self.base,
+            self.ntotal - len(removed),
+            self.delta,
+            self.delta_count,
+            self.tombstones | removed,
+            self.mmapped,
+        )
+
+    def rebased(
+        self, base: Any, merged_from: "IndexGeneration", mmapped: bool = False
+    ) -> "IndexGeneration":
+        """
+        返回以新 base 替换旧版本内容后的版本。
+
+        base 已包含 merged_from 的全部内容；merged_from 之后追加的增量和删除标记保留下来，
+        内容版本号不变。
+        """
+        delta = _DeltaBuffer(
+            self.dimension, max(_INITIAL_DELTA_CAPACITY, self.delta_count - merged_from.delta_count)
+        )
+        pending = self.delta_count - merged_from.delta_count
+        delta.ids[:pending] = self.delta_ids[merged_from.delta_count :]
+        delta.vectors[:pending] = self.delta_vectors[merged_from.delta_count :]
+        return IndexGeneration(
+            self.number,
+            base,
+            self.ntotal,
+            delta,
+            pending,
+            self.tombstones - merged_from.tombstones,
+            mmapped,
+        )
+
+    def has_pending_changes(self) -> bool:
+        """是否有尚未合并进 base 的增量或删除"""
+        return self.delta_count > 0 or bool(self.tombstones)
@@ -0,0 +1,124 @@
+# 向量索引预写日志：追加记录新增/删除的向量，由检查点合并进索引快照
+import os
+import struct
+import threading
+import zlib
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+WAL_EXTENSION = ".wal"
+
+OP_ADD = 1
+OP_REMOVE = 2
+
+# 记录头: 操作类型(uint8) + 向量数(uint32) + 维度(uint32) + 负载 CRC32(uint32)
+_HEADER = struct.Struct("<BIII")
+
+
+def fsync_directory(path: str):
+    """fsync 文件所在目录，确保 rename 结果落盘"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class IndexWriteAheadLog:
+    """
+    索引预写日志。
+
+    每条记录包含一批 chunk ID 以及（新增时）对应的 float32 向量，写入后立即 fsync。
+    启动时在快照之上重放日志，遇到不完整或校验失败的尾部记录时截断。
+    """
+
+    def __init__(self, path_prefix: str):
+        self.wal_file = path_prefix + WAL_EXTENSION
+        self._lock = threading.Lock()
+        self._file = open(self.wal_file, "ab")
+
+    def size(self) -> int:
+        with self._lock:
+            return self._file.tell()
+
+    def _append(self, op: int, ids: np.ndarray, vectors: Optional[np.ndarray]):
+        payload = np.ascontiguousarray(ids, dtype=np.int64).tobytes()
+        dimension = 0
+        if vectors is not None:
+            dimension = vectors.shape[1]
+            payload += np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+        header = _HEADER.pack(op, len(ids), dimension, zlib.crc32(payload))
+        with self._lock:
+            self._file.write(header + payload)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def append_add(self, ids: np.ndarray, vectors: np.ndarray):
+        self._append(OP_ADD, ids, vectors)
+
+    def append_remove(self, ids: np.ndarray):
+        self._append(OP_REMOVE, ids, None)
+
+    def replay(self) -> Iterator[Tuple[int, np.ndarray, Optional[np.ndarray]]]:
+        """按写入顺序返回 (操作类型, chunk ID, 向量)，并截断损坏的尾部"""
+        with self._lock:
+            self._file.flush()
+            with open(self.wal_file, "rb") as f:
+                data = f.read()
+
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            op, count, dimension, crc = _HEADER.unpack_from(data, offset)
+            payload_size = count * 8 + count * dimension * 4
+            start = offset + _HEADER.size
+            payload = data[start : start + payload_size]
+            if len(payload) < payload_size or zlib.crc32(payload) != crc:
+                break
+            ids = np.frombuffer(payload[: count * 8], dtype=np.int64)
+            vectors = None
+            if op == OP_ADD:
+                vectors = np.frombuffer(payload[count * 8 :], dtype=np.float32).reshape(
+                    count, dimension
+                )
+            yield op, ids, vectors
+            offset = start + payload_size
+
+        if offset < len(data):
+            print(f"预写日志尾部存在 {len(data) - offset} 字节不完整记录，已截断。")
+            self.discard_after(offset)
+
+    def discard_after(self, offset: int):
+        """丢弃 offset 之后的内容"""
+        with self._lock:
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+    def discard_prefix(self, offset: int):
+        """丢弃已合并进快照的前 offset 字节，保留之后追加的记录"""
+        with self._lock:
+            self._file.flush()
+            with open(self.wal_file, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            tmp_file = self.wal_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_file, self.wal_file)
+            fsync_directory(self.wal_file)
+            self._file = open(self.wal_file, "ab")
+
+    def clear(self):
+        self.discard_after(0)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,116 @@
+# 本地 CPU 嵌入后端：使用 sentence-transformers 在进程内批量推理，不依赖远程接口，可离线运行
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from config import (
+    EMBEDDING_LOCAL_BATCH_SIZE,
+    EMBEDDING_LOCAL_DEVICE,
+    EMBEDDING_LOCAL_WORKERS,
+    EMBEDDING_MODEL_NAME,
+)
+from services.embedding import INPUT_TYPE_DOCUMENT, EmbeddingBackend
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """
+    sentence-transformers 模型封装。
+
+    一批文本按 EMBEDDING_LOCAL_BATCH_SIZE 切分后分发到线程池并行推理（模型推理时释放 GIL），
+    异步接口同时在途的批次数与线程数一致。模型在首次使用时加载。
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL_NAME,
+        workers: int = EMBEDDING_LOCAL_WORKERS,
+        batch_size: int = EMBEDDING_LOCAL_BATCH_SIZE,
+        device: str = EMBEDDING_LOCAL_DEVICE,
+    ):
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.device = device
+        self.max_concurrency = max(1, workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrency, thread_name_prefix="local-embedding"
+        )
+        self._model = None
+        self._dimension: Optional[int] = None
+        self._load_lock = threading.Lock()
+
+    def _load_model(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError(
+                            "EMBEDDING_BACKEND=local 需要安装 sentence-transformers: "
+                            "pip install sentence-transformers"
+                        ) from e
+                    print(f"[LocalEmbedding] 加载本地嵌入模型: {self.model_name} ({self.device})")
+                    model = SentenceTransformer(self.model_name, device=self.device)
+                    self._dimension = model.get_sentence_embedding_dimension()
+                    self._model = model
+                    print(f"[LocalEmbedding] 模型加载完成，维度: {self._dimension}")
+        return self._model
+
+    def get_dimension(self) -> int:
+        self._load_model()
+        return self._dimension
+
+    def get_model_name(self) -> str:
+        return self.model_name
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self._load_model().encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32)
+
+    def generate_batch_embeddings(
+        self,
+        texts: List[str],
+        input_type: str = INPUT_TYPE_DOCUMENT,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        为一批文本生成嵌入向量，结果写入 out（未提供时新建）。
+
+        本地模型不区分文档和查询，input_type 仅为与其他后端保持接口一致。
+        """
+        self._load_model()
+        if out is None:
+            out = np.empty((len(texts), self._dimension), dtype=np.float32)
+        if not texts:
+            return out
+        chunks = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+        if len(chunks) == 1:
+            out[...] = self._encode(chunks[0])
+            return out
+        start = 0
+        for result in self._executor.map(self._encode, chunks):
+            out[start : start + len(result)] = result
+            start += len(result)
+        return out
+
+
+_local_model: Optional[LocalEmbeddingBackend] = None
+_local_model_lock = threading.Lock()
+
+
+def get_local_embedding_model() -> LocalEmbeddingBackend:
+    """获取本地嵌入后端单例"""
+    global _local_model
+    if _local_model is None:
+        with _local_model_lock:
+            if _local_model is None:
+                _local_model = LocalEmbeddingBackend()
+    return _local_model
@@ -1,17 +1,68 @@
 # RAG 流程：检索 + 构造 Prompt + 调用 LLM
 
+import asyncio
 import json
-from typing import Any, AsyncGenerator, Dict, List, Optional
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
 
 import httpx
+import numpy as np
 from api.models import SourceDocument
 from config import (
     CHAT_MODEL,
     DEEPSEEK_API_BASE_URL,
     DEEPSEEK_API_KEY,
+    LLM_REQUEST_TIMEOUT,
+    RETRIEVAL_SCORE_THRESHOLD,
     TOP_K_RESULTS,
 )
-from services.vector_store import LangchainDocument, get_vector_store
+from services.answer_cache import CachedAnswer, get_answer_cache
+from services.chunk_store import ChunkFilter
+from services.context_packer import PackedContext, pack_context
+from services.embedding import aembed_query, cached_query_embedding
+from services.http_clients import CLIENT_LLM, get_http_client, register_http_client
+from services.metrics import REGISTRY
+from services.tracing import (
+    DISABLED_TRACE,
+    STAGE_ANSWER_CACHE,
+    STAGE_EMBED,
+    STAGE_GENERATE,
+    STAGE_LLM,
+    STAGE_PROMPT,
+    STAGE_SEARCH,
+    STAGE_TTFT,
+    Trace,
+)
+from services.index_generation import IndexGeneration
+from services.vector_store import FAISSVectorStore, LangchainDocument, get_vector_store
+
+# DeepSeek 请求使用应用级共享连接池，避免每次回答都重新建立 TCP/TLS 连接
+register_http_client(CLIENT_LLM, timeout=LLM_REQUEST_TIMEOUT)
+
+LLM_TTFT_SECONDS = REGISTRY.histogram(
+    "llm_time_to_first_token_seconds", "流式 LLM 请求发出到收到首个 token 的耗时（秒）"
+)
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "llm_tokens_per_second",
+    "流式 LLM 首个 token 之后的生成速度（token/秒）",
+    buckets=(1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300),
+)
+LLM_COMPLETION_TOKENS = REGISTRY.counter("llm_completion_tokens_total", "LLM 生成的 token 数")
+LLM_REQUEST_ERRORS = REGISTRY.counter(
+    "llm_request_errors_total", "LLM 请求失败次数（按 HTTP 状态码或错误类型）", ("reason",)
+)
+
+
+def _pack_context(query: str, context_chunks: List[LangchainDocument]) -> PackedContext:
+    """合并、去重并按 token 预算裁剪检索到的文档块，记录本次节省的 token 数"""
+    packed = pack_context(query, context_chunks)
+    if context_chunks:
+        print(
+            f"[context] {packed.chunks} 个文档块组装为 {packed.segments} 段，"
+            f"裁剪 {packed.pruned_sentences} 句，token {packed.tokens_before} -> {packed.tokens_after}"
+            f"（节省 {packed.tokens_saved}）"
+        )
+    return packed
 
 
 async def generate_answer_from_llm_stream(
@@ -20,9 +71,13 @@ async def generate_answer_from_llm_stream(
     api_key: Optional[str] = None,
     base_url: Optional[str] = None,
     chat_model: Optional[str] = None,
+    trace: Trace = DISABLED_TRACE,
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     使用提供的上下文块和用户查询，调用 DeepSeek API 生成流式答案。
+
+    上下文组装完成后先产出一项 {"context": 组装统计}，之后为 {"content": ...} 或 {"error": ...}。
+    trace 记录 Prompt 组装、首个 token 等待（ttft）和后续生成的耗时。
     """
     # 设置默认值
     if api_key is None:
@@ -40,7 +95,10 @@ async def generate_answer_from_llm_stream(
     if not context_chunks:
         print("警告: 没有提供上下文块，将直接向 LLM提问（可能导致幻觉）。")
 
-    context_str = "\n\n---\n\n".join([doc.page_content for doc in context_chunks])
+    with trace.stage(STAGE_PROMPT):
+        packed = _pack_context(query, context_chunks)
+    yield {"context": packed.stats()}
+    context_str = packed.text
 
     prompt = f"""基于以下提供的上下文信息，请用中文回答用户的问题。
 如果上下文中没有足够的信息来回答问题，请明确说明上下文中没有找到相关答案，不要编造。
@@ -68,58 +126,88 @@ async def generate_answer_from_llm_stream(
         "temperature": 0.7,
         "max_tokens": 1500,
         "stream": True,  # 启用流式传输
+        # 最后一个数据块附带 usage，用于统计生成速度
+        "stream_options": {"include_usage": True},
     }
 
     # DeepSeek API 端点
     api_endpoint = f"{base_url.rstrip('/')}/v1/chat/completions"
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
+    client = get_http_client(CLIENT_LLM)
+    requested_at = time.perf_counter()
+    first_token_at: Optional[float] = None
+    content_chunks = 0
+    completion_tokens: Optional[int] = None
+    try:
+        async with client.stream(
+            "POST", api_endpoint, headers=headers, json=payload
+        ) as response:
+            response.raise_for_status()
+
+            async for line in response.aiter_lines():
+                if line.strip():
+                    if line.startswith("data: "):
+                        data = line[6:]  # 移除 "data: " 前缀
+                        if data.strip() == "[DONE]":
+                            break
+                        try:
+                            json_data = json.loads(data)
+                            usage = json_data.get("usage")
+                            if usage and usage.get("completion_tokens") is not None:
+                                completion_tokens = usage["completion_tokens"]
+                            if (
+                                "choices" in json_data
+                                and len(json_data["choices"]) > 0
+                            ):
+                                delta = json_data["choices"][0].get("delta", {})
+                                if "content" in delta:
+                                    if first_token_at is None:
+                                        first_token_at = time.perf_counter()
+                                        trace.record(STAGE_TTFT, first_token_at - requested_at)
+                                        LLM_TTFT_SECONDS.observe(first_token_at - requested_at)
+                                    content_chunks += 1
+                                    yield {"content": delta["content"]}
+                        except json.JSONDecodeError as e:
+                            print(
+                                f"[DeepSeek Stream] JSON解析错误: {e}, 数据: {data}"
+                            )
+                            continue
+
+    except httpx.HTTPStatusError as e:
+        # 对于流式响应，需要先读取响应内容
+        error_content = ""
         try:
-            async with client.stream(
-                "POST", api_endpoint, headers=headers, json=payload
-            ) as response:
-                response.raise_for_status()
-
-                async for line in response.aiter_lines():
-                    if line.strip():
-                        if line.startswith("data: "):
-                            data = line[6:]  # 移除 "data: " 前缀
-                            if data.strip() == "[DONE]":
-                                break
-                            try:
-                                json_data = json.loads(data)
-                                if (
-                                    "choices" in json_data
-                                    and len(json_data["choices"]) > 0
-                                ):
-                                    delta = json_data["choices"][0].get("delta", {})
-                                    if "content" in delta:
-                                        yield {"content": delta["content"]}
-                            except json.JSONDecodeError as e:
-                                print(
-                                    f"[DeepSeek Stream] JSON解析错误: {e}, 数据: {data}"
-                                )
-                                continue
-
-        except httpx.HTTPStatusError as e:
-            # 对于流式响应，需要先读取响应内容
-            error_content = ""
-            try:
-                error_content = e.response.text
-            except Exception:
-                # 如果无法读取响应内容，使用状态码信息
-                error_content = f"HTTP {e.response.status_code}"
+            error_content = e.response.text
+        except Exception:
+            # 如果无法读取响应内容，使用状态码信息
+            error_content = f"HTTP {e.response.status_code}"
             
-            print(
-                f"DeepSeek API 请求失败，状态码: {e.response.status_code}, 响应: {error_content}"
-            )
-            yield {"error": f"与语言模型通信时出错 (HTTP {e.response.status_code})"}
-        except httpx.RequestError as e:
-            print(f"DeepSeek API 请求失败: {e}")
-            yield {"error": "与语言模型通信时发生网络错误"}
-        except Exception as e:
-            print(f"处理 DeepSeek API 响应时发生未知错误: {e}")
-            yield {"error": "处理语言模型响应时发生未知错误"}
+        print(
+            f"DeepSeek API 请求失败，状态码: {e.response.status_code}, 响应: {error_content}"
+        )
+        LLM_REQUEST_ERRORS.labels(str(e.response.status_code)).inc()
+        yield {"error": f"与语言模型通信时出错 (HTTP {e.response.status_code})"}
+    except httpx.RequestError as e:
+        print(f"DeepSeek API 请求失败: {e}")
+        LLM_REQUEST_ERRORS.labels("network").inc()
+        yield {"error": "与语言模型通信时发生网络错误"}
+    except Exception as e:
+        print(f"处理 DeepSeek API 响应时发生未知错误: {e}")
+        LLM_REQUEST_ERRORS.labels("error").inc()
+        yield {"error": "处理语言模型响应时发生未知错误"}
+    finally:
+        if first_token_at is not None:
+            generate_seconds = time.perf_counter() - first_token_at
+            trace.record(STAGE_GENERATE, generate_seconds)
+            # 服务端未返回 usage 时，按内容数据块数估算（通常每块一个 token）
+            tokens = completion_tokens if completion_tokens is not None else content_chunks
+            LLM_COMPLETION_TOKENS.inc(tokens)
+            if generate_seconds > 0 and tokens > 1:
+                # 首个 token 计入 TTFT，生成速度按其后的 token 计算
+                LLM_TOKENS_PER_SECOND.observe((tokens - 1) / generate_seconds)
+        else:
+            # 没有收到任何 token（请求失败或被取消），整个调用记为 llm 阶段
+            trace.record(STAGE_LLM, time.perf_counter() - requested_at)
 
 
 async def generate_answer_from_llm(
@@ -128,9 +216,11 @@ async def generate_answer_from_llm(
     api_key: Optional[str] = None,
     base_url: Optional[str] = None,
     chat_model: Optional[str] = None,
+    trace: Trace = DISABLED_TRACE,
 ) -> Optional[Dict[str, Any]]:
     """
     使用提供的上下文块和用户查询，调用 DeepSeek API 生成答案。
+    trace 记录 Prompt 组装和 LLM 调用的耗时。
     """
     # 设置默认值
     if api_key is None:
@@ -149,7 +239,8 @@ async def generate_answer_from_llm(
         # 或者可以返回一个提示信息，告知用户没有找到相关上下文
         # return {"answer": "抱歉，我没有在已上传的文档中找到与您问题相关的信息。", "sources": []}
 
-    context_str = "\n\n---\n\n".join([doc.page_content for doc in context_chunks])
+    with trace.stage(STAGE_PROMPT):
+        context_str = _pack_context(query, context_chunks).text
 
     prompt = f"""基于以下提供的上下文信息，请用中文回答用户的问题。
 如果上下文中没有足够的信息来回答问题，请明确说明上下文中没有找到相关答案，不要编造。
@@ -186,57 +277,162 @@ async def generate_answer_from_llm(
     print(f"使用模型: {chat_model}")
     print(f"Prompt (部分): {prompt[:200]}...")
 
-    async with httpx.AsyncClient(timeout=60.0) as client:  # 设置超时时间
-        try:
-            response = await client.post(api_endpoint, headers=headers, json=payload)
-            response.raise_for_status()  # 如果是 4xx 或 5xx 错误，则抛出 HTTPError
-
-            api_response = response.json()
-            print("DeepSeek API 响应状态: 成功")
-
-            # 检查OpenAI格式的响应
-            if "choices" in api_response and len(api_response["choices"]) > 0:
-                answer = api_response["choices"][0]["message"]["content"]
-                return {"answer": answer.strip(), "raw_response": api_response}
-            else:
-                print(f"DeepSeek API 返回了意外的响应格式: {api_response}")
-                return {
-                    "answer": "抱歉，处理模型响应时遇到格式问题。",
-                    "raw_response": api_response,
-                }
-
-        except httpx.HTTPStatusError as e:
-            print(
-                f"DeepSeek API 请求失败，状态码: {e.response.status_code}, 响应: {e.response.text}"
-            )
-            return {
-                "answer": f"抱歉，与语言模型通信时出错 (HTTP {e.response.status_code})。",
-                "raw_response": e.response.text,
-            }
-        except httpx.RequestError as e:
-            print(f"DeepSeek API 请求失败: {e}")
-            return {
-                "answer": "抱歉，与语言模型通信时发生网络错误。",
-                "raw_response": str(e),
-            }
-        except Exception as e:
-            print(f"处理 DeepSeek API 响应时发生未知错误: {e}")
+    client = get_http_client(CLIENT_LLM)
+    requested_at = time.perf_counter()
+    try:
+        response = await client.post(api_endpoint, headers=headers, json=payload)
+        response.raise_for_status()  # 如果是 4xx 或 5xx 错误，则抛出 HTTPError
+
+        api_response = response.json()
+        print("DeepSeek API 响应状态: 成功")
+
+        # 检查OpenAI格式的响应
+        if "choices" in api_response and len(api_response["choices"]) > 0:
+            answer = api_response["choices"][0]["message"]["content"]
+            return {"answer": answer.strip(), "raw_response": api_response}
+        else:
+            print(f"DeepSeek API 返回了意外的响应格式: {api_response}")
             return {
-                "answer": "抱歉，处理语言模型响应时发生未知错误。",
-                "raw_response": str(e),
+                "answer": "抱歉，处理模型响应时遇到格式问题。",
+                "raw_response": api_response,
             }
 
+    except httpx.HTTPStatusError as e:
+        print(
+            f"DeepSeek API 请求失败，状态码: {e.response.status_code}, 响应: {e.response.text}"
+        )
+        LLM_REQUEST_ERRORS.labels(str(e.response.status_code)).inc()
+        return {
+            "answer": f"抱歉，与语言模型通信时出错 (HTTP {e.response.status_code})。",
+            "raw_response": e.response.text,
+        }
+    except httpx.RequestError as e:
+        print(f"DeepSeek API 请求失败: {e}")
+        LLM_REQUEST_ERRORS.labels("network").inc()
+        return {
+            "answer": "抱歉，与语言模型通信时发生网络错误。",
+            "raw_response": str(e),
+        }
+    except Exception as e:
+        print(f"处理 DeepSeek API 响应时发生未知错误: {e}")
+        LLM_REQUEST_ERRORS.labels("error").inc()
+        return {
+            "answer": "抱歉，处理语言模型响应时发生未知错误。",
+            "raw_response": str(e),
+        }
+    finally:
+        trace.record(STAGE_LLM, time.perf_counter() - requested_at)
+
+
+def _answer_cache_params(
+    top_k: int,
+    nprobe: Optional[int],
+    ef_search: Optional[int],
+    metadata_filter: Optional[ChunkFilter],
+    score_threshold: Optional[float],
+) -> tuple:
+    """影响检索结果的参数，只有参数相同的问题才能复用缓存的答案"""
+    filter_key = (
+        metadata_filter.cache_key()
+        if metadata_filter is not None and not metadata_filter.is_empty()
+        else None
+    )
+    return (top_k, nprobe, ef_search, filter_key, score_threshold, CHAT_MODEL)
+
+
+async def _cached_retrieval(
+    vector_store: FAISSVectorStore,
+    snapshot: IndexGeneration,
+    user_query: str,
+    top_k: int,
+    nprobe: Optional[int],
+    ef_search: Optional[int],
+    metadata_filter: Optional[ChunkFilter],
+    score_threshold: Optional[float],
+    trace: Trace = DISABLED_TRACE,
+) -> Optional[List[Tuple[LangchainDocument, float]]]:
+    """在生成查询嵌入之前查找检索结果缓存，未命中时返回 None"""
+    with trace.stage(STAGE_SEARCH):
+        return await asyncio.to_thread(
+            vector_store.cached_search,
+            user_query,
+            k=top_k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            snapshot=snapshot,
+            metadata_filter=metadata_filter,
+            score_threshold=score_threshold,
+        )
+
+
+async def _lookup_cached_answer(
+    user_query: str,
+    generation: int,
+    params: tuple,
+    trace: Trace = DISABLED_TRACE,
+    embed: bool = True,
+) -> Tuple[Optional[np.ndarray], Optional[CachedAnswer]]:
+    """
+    获取查询嵌入并查找答案缓存，返回 (查询嵌入, 命中的答案)。
+
+    缓存禁用时不生成嵌入，由检索步骤自行生成；嵌入失败时两者均为 None。
+    embed 为 False（检索结果已命中缓存）时只使用查询向量缓存中已有的向量，不调用嵌入接口。
+    """
+    cache = get_answer_cache()
+    if cache.capacity <= 0:
+        return None, None
+    if embed:
+        with trace.stage(STAGE_EMBED):
+            query_embedding = await aembed_query(user_query)
+    else:
+        query_embedding = cached_query_embedding(user_query)
+    if query_embedding is None:
+        return None, None
+    with trace.stage(STAGE_ANSWER_CACHE):
+        cached = cache.get(query_embedding, generation, params)
+    if cached is not None:
+        print(f"RAG Pipeline: 命中答案缓存，相近的问题: '{cached.query[:50]}...'")
+    return query_embedding, cached
+
 
 async def query_rag_pipeline_stream(
-    user_query: str, top_k: Optional[int] = None
+    user_query: str,
+    top_k: Optional[int] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    metadata_filter: Optional[ChunkFilter] = None,
+    score_threshold: Optional[float] = RETRIEVAL_SCORE_THRESHOLD,
+    trace: Trace = DISABLED_TRACE,
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     完整的 RAG 流程：检索、构造 Prompt、调用 LLM（流式版本）。
+
+    启用计时时，最后产出一项 {"type": "timing", "timings": 各阶段耗时（毫秒）}。
     """
+    async for event in _query_rag_pipeline_stream(
+        user_query, top_k, nprobe, ef_search, metadata_filter, score_threshold, trace
+    ):
+        yield event
+    if trace.enabled:
+        trace.finish("query_stream")
+        yield {"type": "timing", "timings": trace.to_dict()}
+
+
+async def _query_rag_pipeline_stream(
+    user_query: str,
+    top_k: Optional[int],
+    nprobe: Optional[int],
+    ef_search: Optional[int],
+    metadata_filter: Optional[ChunkFilter],
+    score_threshold: Optional[float],
+    trace: Trace,
+) -> AsyncGenerator[Dict[str, Any], None]:
     vector_store = get_vector_store()
     actual_top_k = top_k if top_k is not None else TOP_K_RESULTS
+    # 整个请求使用同一个索引版本，检索期间的写入或重置不影响本次查询
+    snapshot = vector_store.snapshot()
 
-    if vector_store.get_index_size() == 0:
+    if snapshot is None or snapshot.ntotal == 0:
         print("RAG Pipeline: 向量数据库为空，无法进行检索。")
         yield {
             "type": "error",
@@ -245,10 +441,49 @@ async def query_rag_pipeline_stream(
         }
         return
 
-    print(
-        f"RAG Pipeline: 正在为查询 '{user_query[:50]}...' 检索 top-{actual_top_k} 相关文档块..."
+    cache_params = _answer_cache_params(
+        actual_top_k, nprobe, ef_search, metadata_filter, score_threshold
+    )
+    # 先查检索结果缓存：命中时不再为答案缓存生成查询嵌入，也不再检索索引
+    cached_chunks = await _cached_retrieval(
+        vector_store,
+        snapshot,
+        user_query,
+        actual_top_k,
+        nprobe,
+        ef_search,
+        metadata_filter,
+        score_threshold,
+        trace,
+    )
+    query_embedding, cached = await _lookup_cached_answer(
+        user_query, snapshot.number, cache_params, trace, embed=cached_chunks is None
     )
-    retrieved_chunks_with_scores = vector_store.search(user_query, k=actual_top_k)
+    if cached is not None:
+        # 命中缓存：按正常流程的事件顺序直接回放答案和来源
+        yield {"type": "content", "content": cached.answer}
+        yield {"type": "sources", "sources": list(cached.sources)}
+        yield {"type": "done", "cached": True}
+        return
+
+    if cached_chunks is not None:
+        retrieved_chunks_with_scores = cached_chunks
+    else:
+        print(
+            f"RAG Pipeline: 正在为查询 '{user_query[:50]}...' 检索 top-{actual_top_k} 相关文档块..."
+        )
+        retrieved_chunks_with_scores = await vector_store.asearch(
+            user_query,
+            k=actual_top_k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            snapshot=snapshot,
+            metadata_filter=metadata_filter,
+            score_threshold=score_threshold,
+            query_embedding=query_embedding,
+            trace=trace,
+            check_cache=False,
+        )
 
     retrieved_docs = [doc for doc, score in retrieved_chunks_with_scores]
 
@@ -268,11 +503,20 @@ async def query_rag_pipeline_stream(
     )
 
     # 先流式生成答案
-    async for chunk in generate_answer_from_llm_stream(user_query, retrieved_docs):
+    answer_parts: List[str] = []
+    llm_failed = False
+    context_stats: Optional[Dict[str, int]] = None
+    async for chunk in generate_answer_from_llm_stream(
+        user_query, retrieved_docs, trace=trace
+    ):
         if "content" in chunk:
+            answer_parts.append(chunk["content"])
             yield {"type": "content", "content": chunk["content"]}
         elif "error" in chunk:
+            llm_failed = True
             yield {"type": "error", "content": chunk["error"]}
+        elif "context" in chunk:
+            context_stats = chunk["context"]
 
     # 答案完成后发送sources信息
     formatted_sources = [
@@ -280,35 +524,90 @@ async def query_rag_pipeline_stream(
             filename=doc.metadata.get("source", "未知来源"),
             page_content=doc.page_content,
             metadata=doc.metadata,
+            score=score,
         )
-        for doc in retrieved_docs
+        for doc, score in retrieved_chunks_with_scores
     ]
 
+    # 只缓存完整生成的答案
+    if not llm_failed and query_embedding is not None:
+        get_answer_cache().put(
+            user_query,
+            query_embedding,
+            snapshot.number,
+            cache_params,
+            "".join(answer_parts).strip(),
+            formatted_sources,
+        )
+
     yield {"type": "sources", "sources": formatted_sources}
 
-    # 发送完成信号
-    yield {"type": "done"}
+    # 发送完成信号，附带本次上下文组装节省的 token 数
+    yield {"type": "done", "context": context_stats}
 
 
 async def query_rag_pipeline(
-    user_query: str, top_k: Optional[int] = None
+    user_query: str,
+    top_k: Optional[int] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    metadata_filter: Optional[ChunkFilter] = None,
+    score_threshold: Optional[float] = RETRIEVAL_SCORE_THRESHOLD,
+    trace: Trace = DISABLED_TRACE,
 ) -> Dict[str, Any]:
     """
-    完整的 RAG 流程：检索、构造 Prompt、调用 LLM。
+    完整的 RAG 流程：检索、构造 Prompt、调用 LLM。各阶段耗时记录在 trace 中。
     """
     vector_store = get_vector_store()
     actual_top_k = top_k if top_k is not None else TOP_K_RESULTS
+    # 整个请求使用同一个索引版本，检索期间的写入或重置不影响本次查询
+    snapshot = vector_store.snapshot()
 
-    if vector_store.get_index_size() == 0:
+    if snapshot is None or snapshot.ntotal == 0:
         print("RAG Pipeline: 向量数据库为空，无法进行检索。")
         # 根据需求，可以直接返回提示，或者尝试不带上下文调用LLM（如果允许）
         # 这里选择提示用户上传文档
         return {"answer": "知识库为空，请先上传文档后再进行提问。", "sources": []}
 
-    print(
-        f"RAG Pipeline: 正在为查询 '{user_query[:50]}...' 检索 top-{actual_top_k} 相关文档块..."
+    cache_params = _answer_cache_params(
+        actual_top_k, nprobe, ef_search, metadata_filter, score_threshold
+    )
+    # 先查检索结果缓存：命中时不再为答案缓存生成查询嵌入，也不再检索索引
+    cached_chunks = await _cached_retrieval(
+        vector_store,
+        snapshot,
+        user_query,
+        actual_top_k,
+        nprobe,
+        ef_search,
+        metadata_filter,
+        score_threshold,
+        trace,
     )
-    retrieved_chunks_with_scores = vector_store.search(user_query, k=actual_top_k)
+    query_embedding, cached = await _lookup_cached_answer(
+        user_query, snapshot.number, cache_params, trace, embed=cached_chunks is None
+    )
+    if cached is not None:
+        return {"answer": cached.answer, "sources": list(cached.sources)}
+
+    if cached_chunks is not None:
+        retrieved_chunks_with_scores = cached_chunks
+    else:
+        print(
+            f"RAG Pipeline: 正在为查询 '{user_query[:50]}...' 检索 top-{actual_top_k} 相关文档块..."
+        )
+        retrieved_chunks_with_scores = await vector_store.asearch(
+            user_query,
+            k=actual_top_k,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            snapshot=snapshot,
+            metadata_filter=metadata_filter,
+            score_threshold=score_threshold,
+            query_embedding=query_embedding,
+            trace=trace,
+            check_cache=False,
+        )
 
     retrieved_docs = [doc for doc, score in retrieved_chunks_with_scores]
 
@@ -326,7 +625,7 @@ async def query_rag_pipeline(
     print(
         f"RAG Pipeline: 已检索到 {len(retrieved_docs)} 个文档块，准备调用 LLM 生成答案..."
     )
-    llm_result = await generate_answer_from_llm(user_query, retrieved_docs)
+    llm_result = await generate_answer_from_llm(user_query, retrieved_docs, trace=trace)
 
     if llm_result and "answer" in llm_result:
         formatted_sources = [
@@ -334,9 +633,25 @@ async def query_rag_pipeline(
                 filename=doc.metadata.get("source", "未知来源"),
                 page_content=doc.page_content,
                 metadata=doc.metadata,
+                score=score,
             )
-            for doc in retrieved_docs
+            for doc, score in retrieved_chunks_with_scores
         ]
+        # 只缓存模型正常返回的答案，通信失败或格式异常时的提示不缓存
+        raw_response = llm_result.get("raw_response")
+        if (
+            query_embedding is not None
+            and isinstance(raw_response, dict)
+            and raw_response.get("choices")
+        ):
+            get_answer_cache().put(
+                user_query,
+                query_embedding,
+                snapshot.number,
+                cache_params,
+                llm_result["answer"],
+                formatted_sources,
+            )
         return {"answer": llm_result["answer"], "sources": formatted_sources}
     else:
         # LLM 调用失败或未返回期望格式
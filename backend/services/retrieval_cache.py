@@ -0,0 +1,82 @@
+# 检索结果缓存：相同查询、参数和索引版本的检索结果直接复用，跳过查询嵌入和 FAISS 检索
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+from config import RETRIEVAL_CACHE_MAX_ENTRIES
+
+# 一个查询的检索命中：(chunk ID 数组, 分数数组)，按相关性排序
+SearchHits = Tuple[np.ndarray, np.ndarray]
+
+
+class RetrievalCache:
+    """
+    检索结果的 LRU 缓存，键为 (归一化后的查询文本, 检索参数, 索引内容版本号)。
+
+    只保存 chunk ID 和分数，命中时从 chunk 存储读取文档块。索引内容版本号变化后
+    旧条目不会再命中，缓存同时整体清空以释放空间。
+    """
+
+    def __init__(self, capacity: int = RETRIEVAL_CACHE_MAX_ENTRIES):
+        self.capacity = capacity
+        self._entries: "OrderedDict[Hashable, SearchHits]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _sync_generation_locked(self, generation: int) -> bool:
+        """版本号变大时清空缓存；返回 generation 是否为当前版本"""
+        if self._generation is None or generation > self._generation:
+            self._entries.clear()
+            self._generation = generation
+        return generation == self._generation
+
+    def get(self, generation: int, key: Hashable) -> Optional[SearchHits]:
+        if self.capacity <= 0:
+            return None
+        with self._lock:
+            hits = (
+                self._entries.get(key)
+                if self._sync_generation_locked(generation)
+                else None
+            )
+            if hits is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return hits
+
+    def put(self, generation: int, key: Hashable, hits: SearchHits):
+        """缓存一个查询的检索命中；generation 早于当前版本时忽略"""
+        if self.capacity <= 0:
+            return
+        hit_ids, scores = hits
+        hit_ids, scores = hit_ids.copy(), scores.copy()
+        hit_ids.flags.writeable = False
+        scores.flags.writeable = False
+        with self._lock:
+            if not self._sync_generation_locked(generation):
+                return
+            self._entries[key] = (hit_ids, scores)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "generation": self._generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,108 @@
+# 请求分阶段计时：记录问答流程各阶段的耗时，输出 Server-Timing 头和 SSE timing 事件，并写入直方图
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple, Union
+
+from config import REQUEST_TRACING_ENABLED
+from services.metrics import REGISTRY
+
+# 问答流程的阶段名，也用作 Server-Timing 的指标名
+STAGE_ANSWER_CACHE = "answer_cache"
+STAGE_EMBED = "embed"
+STAGE_SEARCH = "search"
+STAGE_PROMPT = "prompt"
+STAGE_TTFT = "ttft"  # 发出 LLM 请求到收到第一个 token
+STAGE_GENERATE = "generate"  # 第一个 token 到生成结束
+STAGE_LLM = "llm"  # 非流式接口的完整 LLM 调用
+
+RAG_STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds", "问答流程各阶段耗时（秒）", ("stage",)
+)
+RAG_REQUEST_SECONDS = REGISTRY.histogram(
+    "rag_request_duration_seconds", "问答请求总耗时（秒）", ("endpoint",)
+)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class RequestTrace:
+    """
+    一次请求的阶段耗时记录。
+
+    各阶段使用 time.perf_counter 计时，同名阶段多次出现时耗时累加；
+    记录的同时写入 rag_stage_duration_seconds 直方图。
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.finished_at: Optional[float] = None
+
+    def record(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        RAG_STAGE_SECONDS.labels(stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def finish(self, endpoint: str):
+        """请求结束，记录总耗时；重复调用只记录一次"""
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+            RAG_REQUEST_SECONDS.labels(endpoint).observe(self.total)
+
+    @property
+    def total(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started_at
+
+    def _timings_ms(self) -> List[Tuple[str, float]]:
+        timings = [(stage, seconds * 1000) for stage, seconds in self.stages.items()]
+        timings.append(("total", self.total * 1000))
+        return timings
+
+    def server_timing(self) -> str:
+        """Server-Timing 头的值，例如 embed;dur=12.3, search;dur=1.8, total;dur=950.2"""
+        return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in self._timings_ms())
+
+    def to_dict(self) -> Dict[str, float]:
+        """各阶段耗时（毫秒）"""
+        return {stage: round(ms, 1) for stage, ms in self._timings_ms()}
+
+
+class _DisabledTrace:
+    """关闭计时时使用的空实现，各方法不做任何事"""
+
+    enabled = False
+    stages: Dict[str, float] = {}
+
+    def record(self, stage: str, seconds: float):
+        pass
+
+    def stage(self, stage: str):
+        return _NULL_CONTEXT
+
+    def finish(self, endpoint: str):
+        pass
+
+    def server_timing(self) -> str:
+        return ""
+
+    def to_dict(self) -> Dict[str, float]:
+        return {}
+
+
+DISABLED_TRACE = _DisabledTrace()
+Trace = Union[RequestTrace, _DisabledTrace]
+
+
+def start_trace() -> Trace:
+    """开始一次请求的计时；REQUEST_TRACING_ENABLED 关闭时返回空实现"""
+    return RequestTrace() if REQUEST_TRACING_ENABLED else DISABLED_TRACE
@@ -1,55 +1,533 @@
 # FAISS 索引构建与查询
+import asyncio
+import math
 import os
 import pickle
-from typing import Any, List, Optional, Tuple
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 import faiss  # type: ignore
 import numpy as np
-from config import TOP_K_RESULTS, VECTOR_DB_PATH
+from config import (
+    DEFAULT_EF_SEARCH,
+    DEFAULT_NPROBE,
+    EMBEDDING_RETRY_BATCH_SIZE,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_M,
+    IVF_NLIST,
+    IVF_PQ_M,
+    IVF_PQ_NBITS,
+    TOP_K_RESULTS,
+    VECTOR_CHECKPOINT_INTERVAL_SECONDS,
+    VECTOR_DB_PATH,
+    VECTOR_FILTER_EXACT_THRESHOLD,
+    VECTOR_FILTER_MAX_OVERSAMPLE,
+    VECTOR_INDEX_MMAP,
+    VECTOR_INDEX_PROMOTE_THRESHOLD,
+    VECTOR_INDEX_TYPE,
+    VECTOR_KEEP_FULL_PRECISION,
+    VECTOR_METRIC,
+    VECTOR_RERANK_FACTOR,
+    VECTOR_STORAGE,
+    VECTOR_WAL_CHECKPOINT_BYTES,
+)
 from langchain_core.documents import Document as LangchainDocument
+from services.chunk_store import ChunkFilter, ChunkStore
 from services.embedding import (
-    generate_embeddings,
+    aembed_documents,
+    aembed_query,
+    embed_documents,
+    embed_queries,
+    embed_query,
     get_embedding_dimension,
     get_embedding_model,
+    get_retry_after_remaining,
+    normalize_query,
 )
+from services.embedding_retry_queue import EmbeddingRetryQueue
+from services.index_generation import IndexGeneration
+from services.index_wal import OP_ADD, IndexWriteAheadLog, fsync_directory
+from services.metrics import REGISTRY
+from services.retrieval_cache import RetrievalCache, SearchHits
+from services.tracing import DISABLED_TRACE, STAGE_EMBED, STAGE_SEARCH, Trace
 
+# 旧版元数据文件（仅用于迁移），文档块现在存放在 ChunkStore 中
 METADATA_EXTENSION = ".meta.pkl"
 INDEX_EXTENSION = ".index"
 
+INDEX_TYPE_FLAT = "flat"
+INDEX_TYPE_IVF_FLAT = "ivf_flat"
+INDEX_TYPE_IVF_PQ = "ivf_pq"
+INDEX_TYPE_HNSW = "hnsw"
+SUPPORTED_INDEX_TYPES = (
+    INDEX_TYPE_FLAT,
+    INDEX_TYPE_IVF_FLAT,
+    INDEX_TYPE_IVF_PQ,
+    INDEX_TYPE_HNSW,
+)
+
+STORAGE_FLOAT32 = "float32"
+STORAGE_FP16 = "fp16"
+STORAGE_SQ8 = "sq8"
+STORAGE_PQ = "pq"
+SUPPORTED_STORAGE_TYPES = (STORAGE_FLOAT32, STORAGE_FP16, STORAGE_SQ8, STORAGE_PQ)
+# 无需训练、可以从空索引直接使用的存储类型
+UNTRAINED_STORAGE_TYPES = (STORAGE_FLOAT32, STORAGE_FP16)
+
+# 距离度量：l2 为原始向量上的欧氏距离；cosine 在写入和查询时先归一化，再用内积索引，
+# 检索结果的分数为 [-1, 1] 区间内的余弦相似度
+METRIC_L2 = "l2"
+METRIC_COSINE = "cosine"
+SUPPORTED_METRICS = (METRIC_L2, METRIC_COSINE)
+_FAISS_METRICS = {
+    METRIC_L2: faiss.METRIC_L2,
+    METRIC_COSINE: faiss.METRIC_INNER_PRODUCT,
+}
+
+# 训练 IVF 聚类中心时最多使用的样本数，避免大语料下训练时间过长
+MAX_TRAINING_SAMPLES = 256 * 1024
+
+# 压缩率报告中用于估算 recall@k 的查询样本数
+REPORT_SAMPLE_QUERIES = 200
+
+VECTOR_SEARCH_SECONDS = REGISTRY.histogram(
+    "vector_search_duration_seconds",
+    "FAISS 索引检索耗时（秒），不含查询嵌入和读取文档块",
+    ("mode",),
+)
+VECTOR_SEARCH_QUERIES = REGISTRY.counter(
+    "vector_search_queries_total", "检索的查询数（按结果来源：缓存或索引）", ("source",)
+)
+VECTOR_STORE_NTOTAL = REGISTRY.gauge("vector_store_ntotal", "当前索引版本中的向量数")
+
+
+def _unwrap_index(index: Any) -> Any:
+    """返回 IndexIDMap/IndexIDMap2 包装下的实际索引"""
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(concrete.index)
+    return concrete
+
+
+def get_index_type(index: Any) -> str:
+    """根据 faiss 索引对象推断其类型名称"""
+    if index is None:
+        return INDEX_TYPE_FLAT
+    concrete = _unwrap_index(index)
+    if isinstance(concrete, faiss.IndexHNSW):
+        return INDEX_TYPE_HNSW
+    if isinstance(concrete, faiss.IndexIVFPQ):
+        return INDEX_TYPE_IVF_PQ
+    if isinstance(concrete, faiss.IndexIVF):
+        return INDEX_TYPE_IVF_FLAT
+    return INDEX_TYPE_FLAT
+
+
+def get_metric(index: Any) -> str:
+    """根据 faiss 索引对象推断其距离度量"""
+    if index is not None and index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return METRIC_COSINE
+    return METRIC_L2
+
+
+def normalize_vectors(vectors: np.ndarray, inplace: bool = False) -> np.ndarray:
+    """按行 L2 归一化，零向量保持不变；inplace 为 True 时直接覆盖传入的 float32 数组"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.maximum(
+        np.linalg.norm(vectors, axis=1, keepdims=True), np.finfo(np.float32).tiny
+    )
+    if inplace:
+        return np.divide(vectors, norms, out=vectors)
+    return vectors / norms
+
+
+def _flat_index(dimension: int, metric: str) -> Any:
+    if metric == METRIC_COSINE:
+        return faiss.IndexFlatIP(dimension)
+    return faiss.IndexFlatL2(dimension)
+
+
+def exact_knn(
+    queries: np.ndarray, vectors: np.ndarray, k: int, metric: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """精确 top-k 检索；返回的距离统一为越小越相似（内积取负）"""
+    distances, rows = faiss.knn(queries, vectors, k, metric=_FAISS_METRICS[metric])
+    if metric == METRIC_COSINE:
+        distances = -distances
+    return distances, rows
+
+
+def get_storage_type(index: Any) -> str:
+    """根据 faiss 索引对象推断其向量存储精度"""
+    if index is None:
+        return STORAGE_FLOAT32
+    concrete = _unwrap_index(index)
+    if isinstance(concrete, faiss.IndexHNSW):
+        concrete = faiss.downcast_index(concrete.storage)
+    if isinstance(concrete, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return STORAGE_PQ
+    if isinstance(concrete, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        if concrete.sq.qtype == faiss.ScalarQuantizer.QT_fp16:
+            return STORAGE_FP16
+        return STORAGE_SQ8
+    return STORAGE_FLOAT32
+
+
+def _choose_nlist(num_vectors: int) -> int:
+    """估算 IVF 聚类数：约 4*sqrt(N)，同时保证每个聚类至少有 39 个训练样本"""
+    if IVF_NLIST > 0:
+        return IVF_NLIST
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def _choose_pq_m(dimension: int) -> int:
+    """选择不超过 IVF_PQ_M 且能整除维度的 PQ 子向量个数"""
+    m = max(1, min(IVF_PQ_M, dimension))
+    while dimension % m != 0:
+        m -= 1
+    return m
+
+
+def _choose_pq_nbits(num_vectors: int) -> int:
+    """PQ 每个子向量的编码位数；样本不足 2^nbits 时降低位数，保证码本可以训练"""
+    return max(1, min(IVF_PQ_NBITS, int(math.log2(max(num_vectors, 2)))))
+
+
+def get_chunk_ids(index: Any) -> np.ndarray:
+    """返回索引中的全部 chunk ID"""
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, faiss.IndexIVF):
+        invlists = concrete.invlists
+        id_lists = [
+            faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+            for i in range(concrete.nlist)
+            if invlists.list_size(i) > 0
+        ]
+        if not id_lists:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(id_lists).astype(np.int64)
+    return faiss.vector_to_array(concrete.id_map).astype(np.int64)
+
+
+def export_vectors(index: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """导出索引中的全部 (chunk ID, 向量)，用于在本地重建索引"""
+    concrete = faiss.downcast_index(index)
+    if not isinstance(
+        concrete, (faiss.IndexIVF, faiss.IndexIDMap, faiss.IndexIDMap2)
+    ):
+        # 旧版按位置存储的索引，ID 即为位置
+        return np.arange(index.ntotal, dtype=np.int64), index.reconstruct_n(
+            0, index.ntotal
+        )
+    ids = get_chunk_ids(index)
+    if len(ids) == 0:
+        return ids, np.zeros((0, index.d), dtype=np.float32)
+    return ids, concrete.reconstruct_batch(ids)
+
+
+def remove_ids(index: Any, ids: np.ndarray):
+    """按 chunk ID 删除向量；HNSW 不支持删除时抛出 RuntimeError"""
+    # IVF 的哈希直接映射只支持 IDSelectorArray
+    index.remove_ids(faiss.IDSelectorArray(ids.astype(np.int64)))
+
+
+def supports_search_selector(index: Any) -> bool:
+    """检索时能否通过 SearchParameters.sel 按 ID 过滤；flat PQ 索引不支持"""
+    return not isinstance(_unwrap_index(index), faiss.IndexPQ)
+
+
+_SQ_TYPES = {
+    STORAGE_FP16: faiss.ScalarQuantizer.QT_fp16,
+    STORAGE_SQ8: faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def build_ann_index(
+    index_type: str,
+    vectors: np.ndarray,
+    ids: Optional[np.ndarray] = None,
+    storage: str = STORAGE_FLOAT32,
+    metric: str = METRIC_L2,
+) -> Any:
+    """
+    按指定类型构建并训练索引，然后以 ID 映射方式写入全部向量。
+
+    Args:
+        index_type: 目标索引类型，见 SUPPORTED_INDEX_TYPES
+        vectors: 形状为 (N, d) 的 float32 向量矩阵；cosine 度量时应已归一化
+        ids: 每个向量对应的 64 位 chunk ID，默认为 0..N-1
+        storage: 向量存储精度，见 SUPPORTED_STORAGE_TYPES；ivf_pq 始终使用 PQ
+        metric: 距离度量，见 SUPPORTED_METRICS；cosine 使用内积索引
+    """
+    num_vectors, dimension = vectors.shape
+    faiss_metric = _FAISS_METRICS[metric]
+    if index_type == INDEX_TYPE_HNSW:
+        if storage in _SQ_TYPES:
+            index = faiss.IndexHNSWSQ(dimension, _SQ_TYPES[storage], HNSW_M, faiss_metric)
+        elif storage == STORAGE_PQ:
+            index = faiss.IndexHNSWPQ(
+                dimension,
+                _choose_pq_m(dimension),
+                HNSW_M,
+                _choose_pq_nbits(num_vectors),
+                faiss_metric,
+            )
+        else:
+            index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss_metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type in (INDEX_TYPE_IVF_FLAT, INDEX_TYPE_IVF_PQ):
+        nlist = _choose_nlist(num_vectors)
+        quantizer = _flat_index(dimension, metric)
+        if index_type == INDEX_TYPE_IVF_PQ or storage == STORAGE_PQ:
+            index = faiss.IndexIVFPQ(
+                quantizer,
+                dimension,
+                nlist,
+                _choose_pq_m(dimension),
+                _choose_pq_nbits(num_vectors),
+                faiss_metric,
+            )
+        elif storage in _SQ_TYPES:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, _SQ_TYPES[storage], faiss_metric
+            )
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+    else:
+        if storage in _SQ_TYPES:
+            index = faiss.IndexScalarQuantizer(dimension, _SQ_TYPES[storage], faiss_metric)
+        elif storage == STORAGE_PQ:
+            index = faiss.IndexPQ(
+                dimension,
+                _choose_pq_m(dimension),
+                _choose_pq_nbits(num_vectors),
+                faiss_metric,
+            )
+        else:
+            index = _flat_index(dimension, metric)
+
+    if ids is None:
+        ids = np.arange(num_vectors, dtype=np.int64)
+
+    if not index.is_trained:
+        if num_vectors > MAX_TRAINING_SAMPLES:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(num_vectors, MAX_TRAINING_SAMPLES, replace=False)]
+        else:
+            sample = vectors
+        index.train(sample)
+
+    if isinstance(index, faiss.IndexIVF):
+        # IVF 原生支持自定义 ID；哈希直接映射用于按 ID 还原与删除向量
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        id_index = index
+    else:
+        id_index = faiss.IndexIDMap2(index)
+    if num_vectors:
+        id_index.add_with_ids(vectors, ids.astype(np.int64))
+    return id_index
+
 
 class FAISSVectorStore:
-    def __init__(self, index_path_prefix: str = VECTOR_DB_PATH):
+    def __init__(
+        self,
+        index_path_prefix: str = VECTOR_DB_PATH,
+        index_type: str = VECTOR_INDEX_TYPE,
+        promote_threshold: int = VECTOR_INDEX_PROMOTE_THRESHOLD,
+        use_mmap: bool = VECTOR_INDEX_MMAP,
+        storage: str = VECTOR_STORAGE,
+        keep_full_precision: bool = VECTOR_KEEP_FULL_PRECISION,
+        metric: str = VECTOR_METRIC,
+    ):
         self.index_path_prefix = index_path_prefix
         self.index_file = index_path_prefix + INDEX_EXTENSION
         self.metadata_file = index_path_prefix + METADATA_EXTENSION
 
-        self.index: Optional[Any] = None  # faiss.Index
-        self.document_chunks: List[
-            LangchainDocument
-        ] = []  # 用于存储与索引向量对应的文档块
+        if index_type not in SUPPORTED_INDEX_TYPES:
+            print(f"警告: 不支持的索引类型 '{index_type}'，将使用 flat 索引。")
+            index_type = INDEX_TYPE_FLAT
+        # 目标索引类型：小语料时始终使用精确的 flat 索引，
+        # 向量数超过 promote_threshold 后在后台切换到目标类型
+        self.index_type = index_type
+        self.promote_threshold = promote_threshold
+        if storage not in SUPPORTED_STORAGE_TYPES:
+            print(f"警告: 不支持的向量存储类型 '{storage}'，将使用 float32。")
+            storage = STORAGE_FLOAT32
+        # 压缩存储时可在 ChunkStore 中保留全精度副本，检索时对候选结果精确重排
+        self.storage = storage
+        self.keep_full_precision = keep_full_precision and storage != STORAGE_FLOAT32
+        self.rerank_factor = max(1, VECTOR_RERANK_FACTOR)
+        if metric not in SUPPORTED_METRICS:
+            print(f"警告: 不支持的距离度量 '{metric}'，将使用 l2。")
+            metric = METRIC_L2
+        # 新建索引使用的距离度量；已有索引沿用其自身的度量，需离线迁移后才会改变
+        self.configured_metric = metric
+        # 只读内存映射模式：多个进程可共享页缓存，启动时只读取索引头部
+        self.use_mmap = use_mmap
+
+        # 当前发布的索引版本。写入方基于最新版本生成新版本并整体替换该引用，
+        # 读取方取一次引用后在整个请求中使用同一个快照，无需加锁
+        self._generation: Optional[IndexGeneration] = None
+        # chunk ID -> 文档块，ID 与索引中的向量 ID 一一对应且在删除后保持稳定；
+        # 文档块内容只在检索命中时按 ID 读取，按文档删除时按 document_id 查询
+        self.chunk_store = ChunkStore(index_path_prefix)
+        self._next_chunk_id = 0
+        # 嵌入失败的文档块不写入索引，持久化在重试队列中，由后台任务重新嵌入后再写入
+        self.retry_queue = EmbeddingRetryQueue(index_path_prefix)
+        self.retrieval_cache = RetrievalCache()
+
+        # 写锁：串行化新增、删除、重置与版本发布，持有时间只包含内存追加和日志写入
+        self._write_lock = threading.RLock()
+        # 合并锁：串行化检查点、索引切换与重置；合并在副本上进行，不阻塞写入方和读取方
+        self._checkpoint_lock = threading.RLock()
+        self._rebuild_requested = False
+
+        # 新增/删除的向量先追加到预写日志，由后台检查点线程合并进索引快照
+        self.wal = IndexWriteAheadLog(index_path_prefix)
+        self.wal_checkpoint_bytes = VECTOR_WAL_CHECKPOINT_BYTES
+        self.checkpoint_interval = VECTOR_CHECKPOINT_INTERVAL_SECONDS
+        self._dirty = False  # 是否有尚未写入快照的变更
+        self._checkpoint_requested = threading.Event()
+        self._stop_event = threading.Event()
 
         self._load_or_initialize()
 
+        self._checkpoint_thread = threading.Thread(
+            target=self._checkpoint_loop, name="faiss-checkpoint", daemon=True
+        )
+        self._checkpoint_thread.start()
+        self._maybe_schedule_promotion()
+
+    @property
+    def index(self) -> Optional[Any]:
+        """当前版本的基础索引（只读，不包含尚未合并的增量与删除）"""
+        generation = self._generation
+        return generation.base if generation is not None else None
+
+    @property
+    def generation(self) -> int:
+        """当前内容版本号，每次新增、删除或重置后递增"""
+        generation = self._generation
+        return generation.number if generation is not None else 0
+
+    @property
+    def metric(self) -> str:
+        """当前索引的距离度量"""
+        return get_metric(self.index) if self.index is not None else self.configured_metric
+
+    def snapshot(self) -> Optional[IndexGeneration]:
+        """返回当前发布的索引版本，一次请求内的多次读取应使用同一个快照"""
+        return self._generation
+
+    def _publish(self, generation: IndexGeneration):
+        # 单次引用赋值，读取方要么看到旧版本，要么看到完整的新版本
+        self._generation = generation
+
     def _load_or_initialize(self):
-        if os.path.exists(self.index_file) and os.path.exists(self.metadata_file):
+        if os.path.exists(self.index_file):
             print(
-                f"从 {self.index_file} 和 {self.metadata_file} 加载 FAISS 索引和元数据..."
+                f"从 {self.index_file} 和 {self.chunk_store.db_file} 加载 FAISS 索引和元数据..."
             )
             try:
-                self.index = faiss.read_index(self.index_file)
-                with open(self.metadata_file, "rb") as f:
-                    self.document_chunks = pickle.load(f)
+                if self.use_mmap:
+                    base = faiss.read_index(
+                        self.index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+                    )
+                    self._publish(IndexGeneration(0, base, mmapped=True))
+                else:
+                    self._publish(IndexGeneration(0, faiss.read_index(self.index_file)))
+                self._migrate_legacy_metadata()
+                self._replay_wal()
+                self._next_chunk_id = self.chunk_store.next_chunk_id()
                 print(
-                    f"成功加载索引，包含 {self.index.ntotal if self.index else 0} 个向量和 {len(self.document_chunks)} 个文档块元数据。"
+                    f"成功加载索引，包含 {self.get_index_size()} 个向量和 {len(self.chunk_store)} 个文档块元数据。"
                 )
+                if self.metric != self.configured_metric:
+                    print(
+                        f"警告: 现有索引使用 {self.metric} 度量，与配置的 {self.configured_metric} 不一致；"
+                        "请停止服务后运行 migrate_vector_metric.py 迁移索引。"
+                    )
             except Exception as e:
-                print(f"加载索引或元数据失败: {e}。将重新初始化空索引。")
-                self._initialize_empty_index()
+                # 不回退到空索引：那样会用空快照覆盖磁盘上的索引、文档块和预写日志
+                print(
+                    f"加载索引或元数据失败: {e}。为保护磁盘上的数据，拒绝初始化向量存储；"
+                    "请检查索引文件后重启，或通过重置接口清空索引。"
+                )
+                raise RuntimeError(f"无法加载现有 FAISS 索引: {e}") from e
         else:
             print("未找到现有索引，正在初始化新的 FAISS 索引...")
             self._initialize_empty_index()
+            # 首个快照写入之前崩溃时，已写入的向量只存在于预写日志中
+            self._replay_wal()
+            self._next_chunk_id = self.chunk_store.next_chunk_id()
+            self.save_index()
+
+    def _migrate_legacy_metadata(self):
+        """
+        将旧版 pickle 元数据（按向量位置排列的文档块列表）迁移到 ChunkStore，
+        索引同时迁移为 ID 映射索引。
+        """
+        if not os.path.exists(self.metadata_file):
+            return
+        with open(self.metadata_file, "rb") as f:
+            metadata = pickle.load(f)
+
+        print("检测到旧版元数据格式，正在迁移到 SQLite 文档块存储...")
+        chunks = dict(enumerate(metadata))
+        base = self._writable_base(self._generation)
+        if isinstance(faiss.downcast_index(base), faiss.IndexIVF):
+            faiss.downcast_index(base).make_direct_map()
+        ids, vectors = export_vectors(base)
+        self._publish(
+            IndexGeneration(
+                0,
+                build_ann_index(
+                    get_index_type(base), vectors, ids, metric=get_metric(base)
+                ),
+            )
+        )
+        self.save_index()
+
+        self.chunk_store.clear()
+        self.chunk_store.add_many(chunks)
+        os.remove(self.metadata_file)
+        print(f"已迁移 {len(chunks)} 个文档块元数据。")
+
+    def _replay_wal(self):
+        """在索引快照之上重放预写日志；重放是幂等的，已包含在快照中的记录会被跳过"""
+        if self.wal.size() == 0:
+            return
+        print(f"正在重放预写日志 {self.wal.wal_file}...")
+        generation = self._generation
+        existing_ids = set(get_chunk_ids(generation.base).tolist())
+        added, removed = 0, 0
+        for op, ids, vectors in self.wal.replay():
+            if op == OP_ADD:
+                mask = np.array([i not in existing_ids for i in ids.tolist()], dtype=bool)
+                if mask.any():
+                    generation = generation.with_added(ids[mask], vectors[mask])
+                    existing_ids.update(ids[mask].tolist())
+                    added += int(mask.sum())
+            else:
+                present = ids[np.array([i in existing_ids for i in ids.tolist()], dtype=bool)]
+                if len(present):
+                    generation = generation.with_removed(present.tolist())
+                    existing_ids.difference_update(present.tolist())
+                    removed += len(present)
+        # 重放的变更先以增量和删除标记的形式生效，由检查点合并进快照
+        self._publish(generation)
+        self._dirty = added > 0 or removed > 0
+        print(f"预写日志重放完成：新增 {added} 个向量，删除 {removed} 个向量。")
+
+    def _writable_base(self, generation: IndexGeneration) -> Any:
+        """复制版本的基础索引供合并修改，已发布的 base 本身保持不变"""
+        if generation.mmapped:
+            # 内存映射的索引是只读的，从快照文件完整加载一份到内存
+            return faiss.read_index(self.index_file)
+        return faiss.deserialize_index(faiss.serialize_index(generation.base))
 
     def _initialize_empty_index(self):
+        """在内存中发布一个空索引版本，不修改磁盘上的快照、文档块和预写日志"""
         # 增加重试次数
         max_retries = 3
         retry_delay = 2  # 秒
@@ -89,9 +567,24 @@ class FAISSVectorStore:
                             f"经过 {max_retries} 次尝试，仍无法获取嵌入模型维度"
                         )
 
-                # 成功获取维度，初始化索引
-                self.index = faiss.IndexFlatL2(dimension)
-                self.document_chunks = []
+                # 成功获取维度，初始化索引；需要训练的压缩格式等到向量数超过阈值后再切换
+                initial_storage = (
+                    self.storage
+                    if self.storage in UNTRAINED_STORAGE_TYPES
+                    else STORAGE_FLOAT32
+                )
+                previous = self._generation
+                self._publish(
+                    IndexGeneration(
+                        previous.number + 1 if previous is not None else 0,
+                        build_ann_index(
+                            INDEX_TYPE_FLAT,
+                            np.zeros((0, dimension), dtype=np.float32),
+                            storage=initial_storage,
+                            metric=self.configured_metric,
+                        ),
+                    )
+                )
                 print(f"新的 FAISS 索引已初始化，维度: {dimension}。")
                 return  # 成功初始化，返回
 
@@ -109,98 +602,1082 @@ class FAISSVectorStore:
                     raise RuntimeError(f"无法初始化 FAISS 索引: {e}")
 
     def save_index(self):
-        if self.index is not None:
-            print(f"正在保存 FAISS 索引到 {self.index_file}...")
-            faiss.write_index(self.index, self.index_file)
-            with open(self.metadata_file, "wb") as f:
-                pickle.dump(self.document_chunks, f)
+        """
+        合并尚未写入快照的增量与删除，写入新的索引快照，并丢弃快照已包含的预写日志。
+
+        快照先写入临时文件并 fsync，再通过原子 rename 发布，崩溃时磁盘上
+        始终保留一份完整的旧快照；也不会覆盖其它进程正在内存映射的文件。
+        """
+        with self._checkpoint_lock:
+            if self._generation is None:
+                print("警告: 索引未初始化，无法保存。")
+                return
+            merged = self._compact()
+            if merged is None:
+                return
+            generation, wal_offset = merged
+            if not generation.mmapped:
+                print(f"正在保存 FAISS 索引到 {self.index_file}...")
+                tmp_index_file = self.index_file + ".tmp"
+                faiss.write_index(generation.base, tmp_index_file)
+                with open(tmp_index_file, "rb") as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp_index_file, self.index_file)
+                fsync_directory(self.index_file)
+            # 快照已包含 wal_offset 之前的全部记录，之后追加的记录保留到下次检查点
+            self.wal.discard_prefix(wal_offset)
+            self._dirty = self.wal.size() > 0
             print("FAISS 索引和元数据保存成功。")
+
+    def _compact(self, rebuild: bool = False) -> Optional[Tuple[IndexGeneration, int]]:
+        """
+        把当前版本的增量与删除合并进新的 base 并发布，返回 (新版本, 已合并的预写日志长度)。
+
+        合并在锁外的副本上进行，期间读取方继续使用旧版本，写入方继续追加；
+        合并期间新增的增量与删除保留在新版本中，留待下次合并。
+        rebuild 为 True 时按目标配置重新训练构建 base，用于后台索引切换。
+        合并期间索引被重置时返回 None。
+        """
+        with self._write_lock:
+            source = self._generation
+            wal_offset = self.wal.size()
+
+        if rebuild:
+            ids, vectors = self._export_live_vectors(source)
+            base = build_ann_index(
+                self.index_type, vectors, ids, self.storage, get_metric(source.base)
+            )
+        elif source.has_pending_changes():
+            base = self._merge_pending(source)
         else:
-            print("警告: 索引未初始化，无法保存。")
+            return source, wal_offset
+
+        with self._write_lock:
+            current = self._generation
+            if current.base is not source.base:
+                print("索引在合并期间已被重置，放弃本次合并。")
+                return None
+            generation = current.rebased(base, source)
+            self._publish(generation)
+        return generation, wal_offset
+
+    def _merge_pending(self, source: IndexGeneration) -> Any:
+        """在 base 的副本上应用删除标记并追加增量向量"""
+        base = self._writable_base(source)
+        if len(source.tombstone_array):
+            try:
+                remove_ids(base, source.tombstone_array)
+            except RuntimeError:
+                # HNSW 不支持删除，用剩余向量重建图索引（不会重新调用嵌入接口）
+                ids, vectors = self._export_live_vectors(source)
+                return build_ann_index(
+                    get_index_type(source.base),
+                    vectors,
+                    ids,
+                    get_storage_type(source.base),
+                    get_metric(source.base),
+                )
+        if source.delta_count:
+            keep = ~np.isin(source.delta_ids, source.tombstone_array)
+            if keep.any():
+                base.add_with_ids(source.delta_vectors[keep], source.delta_ids[keep])
+        return base
+
+    def _export_live_vectors(self, generation: IndexGeneration) -> Tuple[np.ndarray, np.ndarray]:
+        """导出版本中仍然有效的全部 (chunk ID, 向量)：base 去掉删除标记后再加上增量"""
+        ids, vectors = self._export_full_vectors(generation.base)
+        ids = np.concatenate([ids, generation.delta_ids])
+        vectors = np.concatenate([vectors, generation.delta_vectors])
+        keep = ~np.isin(ids, generation.tombstone_array)
+        return ids[keep], vectors[keep]
+
+    def _request_checkpoint_if_needed(self):
+        """预写日志超过大小阈值时唤醒检查点线程"""
+        self._dirty = True
+        if self.wal.size() >= self.wal_checkpoint_bytes:
+            self._checkpoint_requested.set()
+
+    def _checkpoint_loop(self):
+        """后台检查点：日志超过大小阈值或距上次检查点超过时间间隔时写入新快照"""
+        while not self._stop_event.is_set():
+            self._checkpoint_requested.wait(timeout=self.checkpoint_interval)
+            self._checkpoint_requested.clear()
+            if self._stop_event.is_set():
+                break
+            if self._rebuild_requested:
+                self._promote_index()
+            elif self._dirty:
+                try:
+                    self.save_index()
+                except Exception as e:
+                    print(f"后台检查点写入失败: {e}")
+
+    def close(self):
+        """停止检查点线程，并把尚未合并的变更写入快照"""
+        self._stop_event.set()
+        self._checkpoint_requested.set()
+        self._checkpoint_thread.join(timeout=self.checkpoint_interval)
+        if self._dirty:
+            self.save_index()
+        self.wal.close()
+
+    def _target_spec(self) -> Tuple[str, str]:
+        """目标 (索引类型, 存储精度)；IVF 索引使用 PQ 存储即为 ivf_pq"""
+        if self.index_type == INDEX_TYPE_IVF_PQ or (
+            self.index_type == INDEX_TYPE_IVF_FLAT and self.storage == STORAGE_PQ
+        ):
+            return INDEX_TYPE_IVF_PQ, STORAGE_PQ
+        return self.index_type, self.storage
 
-    def add_documents(self, documents: List[LangchainDocument]):
+    def _maybe_schedule_promotion(self):
+        """当索引规模超过阈值且与目标配置不一致时，通知后台线程训练并切换到目标索引"""
+        generation = self._generation
+        if generation is None or self._rebuild_requested:
+            return
+        base = generation.base
+        if (get_index_type(base), get_storage_type(base)) == self._target_spec():
+            return
+        if generation.ntotal < self.promote_threshold:
+            return
+
+        print(
+            f"索引规模 {generation.ntotal} 已超过阈值 {self.promote_threshold}，"
+            f"后台构建 {self.index_type}/{self.storage} 索引..."
+        )
+        self._rebuild_requested = True
+        self._checkpoint_requested.set()
+
+    def _promote_index(self):
+        """训练目标索引并发布为新版本；构建期间读取方继续使用旧版本"""
+        try:
+            with self._checkpoint_lock:
+                if self._compact(rebuild=True) is None:
+                    return
+                self.save_index()
+            print(
+                f"已切换到 {self.index_type} 索引，包含 {self.get_index_size()} 个向量。"
+            )
+        except Exception as e:
+            print(f"后台构建 {self.index_type} 索引失败: {e}")
+            import traceback
+
+            traceback.print_exc()
+        finally:
+            self._rebuild_requested = False
+
+    def _overlay_full_vectors(self, ids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """压缩存储时用全精度副本替换从索引还原出的近似向量，避免重建时误差累积"""
+        if self.keep_full_precision and len(ids):
+            full = self.chunk_store.get_vectors(ids.tolist())
+            for row, chunk_id in enumerate(ids.tolist()):
+                if chunk_id in full:
+                    vectors[row] = full[chunk_id]
+        return vectors
+
+    def _export_full_vectors(self, index: Any) -> Tuple[np.ndarray, np.ndarray]:
+        """导出索引中的全部 (chunk ID, 向量)，优先使用全精度副本"""
+        ids, vectors = export_vectors(index)
+        return ids, self._overlay_full_vectors(ids, vectors)
+
+    def _rerank(
+        self,
+        query_vector: np.ndarray,
+        ids: np.ndarray,
+        distances: np.ndarray,
+        k: int,
+        metric: str,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """用全精度向量重新计算候选的距离并取 top-k；缺少全精度副本的候选保留近似距离"""
+        valid = ids != -1
+        ids, distances = ids[valid], distances[valid].copy()
+        full = self.chunk_store.get_vectors(ids.tolist())
+        for row, chunk_id in enumerate(ids.tolist()):
+            vector = full.get(chunk_id)
+            if vector is not None:
+                if metric == METRIC_COSINE:
+                    distances[row] = -float(np.dot(vector, query_vector))
+                else:
+                    diff = vector - query_vector
+                    distances[row] = float(np.dot(diff, diff))
+        order = np.argsort(distances, kind="stable")[:k]
+        return ids[order], distances[order]
+
+    def _search_params(
+        self,
+        index: Any,
+        k: int,
+        nprobe: Optional[int],
+        ef_search: Optional[int],
+        sel: Optional[Any] = None,
+    ) -> Optional[Any]:
+        """根据索引类型构造单次查询参数，不修改索引本身的全局配置"""
+        index_type = get_index_type(index)
+        if index_type in (INDEX_TYPE_IVF_FLAT, INDEX_TYPE_IVF_PQ):
+            return faiss.SearchParametersIVF(nprobe=nprobe or DEFAULT_NPROBE, sel=sel)
+        if index_type == INDEX_TYPE_HNSW:
+            # efSearch 小于 k 时 HNSW 无法返回足够的结果
+            return faiss.SearchParametersHNSW(
+                efSearch=max(ef_search or DEFAULT_EF_SEARCH, k), sel=sel
+            )
+        if sel is not None:
+            return faiss.SearchParameters(sel=sel)
+        return None
+
+    def add_documents(
+        self,
+        documents: List[LangchainDocument],
+        document_id: Optional[str] = None,
+        ingest_stats: Optional[Dict[str, int]] = None,
+    ):
+        """
+        为文档块生成嵌入并写入索引。已缓存嵌入的文本不会重复调用嵌入接口。
+
+        Args:
+            documents: 待写入的文档块
+            document_id: 文档块所属的文档标识（上传时的文件名），用于按文档删除
+            ingest_stats: 可选，传入的字典会被写入本次导入的嵌入缓存命中/未命中数
+        """
+        if not self._check_can_add(documents):
+            return 0
+
+        texts_to_embed = [doc.page_content for doc in documents]
+        print(f"正在为 {len(texts_to_embed)} 个新文档块生成嵌入...")
+        embeddings, cache_stats = embed_documents(texts_to_embed)
+        if ingest_stats is not None:
+            ingest_stats.update(cache_stats)
+        documents, embeddings = self._defer_failed(
+            documents, embeddings, document_id, ingest_stats
+        )
+        return self._add_embedded(documents, embeddings, document_id)
+
+    async def aadd_documents(
+        self,
+        documents: List[LangchainDocument],
+        document_id: Optional[str] = None,
+        ingest_stats: Optional[Dict[str, int]] = None,
+    ):
+        """
+        add_documents 的异步版本：嵌入请求并发发送，缓存读写、写日志和发布版本在线程池中执行，
+        整个过程不阻塞事件循环。
+        """
+        if not self._check_can_add(documents):
+            return 0
+
+        texts_to_embed = [doc.page_content for doc in documents]
+        print(f"正在为 {len(texts_to_embed)} 个新文档块异步生成嵌入...")
+        embeddings, cache_stats = await aembed_documents(texts_to_embed)
+        if ingest_stats is not None:
+            ingest_stats.update(cache_stats)
+        documents, embeddings = await asyncio.to_thread(
+            self._defer_failed, documents, embeddings, document_id, ingest_stats
+        )
+        return await asyncio.to_thread(
+            self._add_embedded, documents, embeddings, document_id
+        )
+
+    def _defer_failed(
+        self,
+        documents: List[LangchainDocument],
+        embeddings: np.ndarray,
+        document_id: Optional[str],
+        ingest_stats: Optional[Dict[str, int]] = None,
+    ) -> Tuple[List[LangchainDocument], np.ndarray]:
+        """
+        把嵌入失败（全零向量）的文档块加入重试队列，返回其余可写入索引的文档块和嵌入。
+
+        零向量会污染检索结果，因此失败的文档块不写入索引，由后台任务重试成功后再写入。
+        """
+        failed = ~embeddings.any(axis=1)
+        failed_count = int(failed.sum())
+        if ingest_stats is not None:
+            ingest_stats["embedding_failed"] = failed_count
+        if not failed_count:
+            return documents, embeddings
+        self.retry_queue.add_many(
+            [doc for doc, is_failed in zip(documents, failed) if is_failed],
+            document_id,
+            retry_after=get_retry_after_remaining(),
+        )
+        print(f"{failed_count} 个文档块未能生成嵌入，已加入重试队列，暂不写入索引。")
+        return (
+            [doc for doc, is_failed in zip(documents, failed) if not is_failed],
+            embeddings[~failed],
+        )
+
+    async def aretry_pending(self, limit: int = EMBEDDING_RETRY_BATCH_SIZE) -> Dict[str, int]:
+        """
+        重新嵌入重试队列中已到期的文档块，成功的写入索引，失败的按退避策略重新排期。
+
+        Returns:
+            本轮涉及的文档标识 -> 新写入索引的文档块数（全部失败的文档为 0）
+        """
+        entries = await asyncio.to_thread(self.retry_queue.due, limit)
+        if not entries:
+            return {}
+        print(f"正在重试 {len(entries)} 个嵌入失败的文档块...")
+        embeddings, _ = await aembed_documents([doc.page_content for _, _, doc in entries])
+        return await asyncio.to_thread(self._store_retried, entries, embeddings)
+
+    def _store_retried(
+        self, entries: List[Tuple[int, str, LangchainDocument]], embeddings: np.ndarray
+    ) -> Dict[str, int]:
+        succeeded = embeddings.any(axis=1)
+        failed_ids = [entry[0] for entry, ok in zip(entries, succeeded) if not ok]
+        rows_by_document: Dict[str, List[int]] = {}
+        for row, (_, document_id, _) in enumerate(entries):
+            rows_by_document.setdefault(document_id, [])
+            if succeeded[row]:
+                rows_by_document[document_id].append(row)
+
+        added: Dict[str, int] = {}
+        # 持有写锁，期间文档不会被删除；检查条目仍在队列中，避免把已删除文档的文档块写回索引
+        with self._write_lock:
+            live = set(self.retry_queue.existing(entry[0] for entry in entries))
+            for document_id, rows in rows_by_document.items():
+                rows = [row for row in rows if entries[row][0] in live]
+                count = 0
+                if rows:
+                    count = self._add_embedded(
+                        [entries[row][2] for row in rows], embeddings[rows], document_id
+                    )
+                    if count:
+                        self.retry_queue.remove_many(entries[row][0] for row in rows)
+                    else:
+                        failed_ids.extend(entries[row][0] for row in rows)
+                added[document_id] = count
+
+        abandoned = self.retry_queue.reschedule(
+            failed_ids, retry_after=get_retry_after_remaining()
+        )
+        print(
+            f"重试完成: {sum(added.values())} 个文档块已写入索引，"
+            f"{len(failed_ids)} 个仍然失败（其中 {abandoned} 个已达到最大重试次数）。"
+        )
+        return added
+
+    def _check_can_add(self, documents: List[LangchainDocument]) -> bool:
         if not documents:
             print("没有要添加到索引的文档块。")
-            return 0
-        if self.index is None:
+            return False
+        if self._generation is None:
             print("错误: FAISS 索引未初始化，无法添加文档。")
             # 尝试重新初始化，或者直接抛出错误
             # self._initialize_empty_index() # 这可能不是最佳做法，取决于应用逻辑
             raise RuntimeError("FAISS 索引未初始化，无法添加文档。请检查初始化过程。")
+        return True
 
-        texts_to_embed = [doc.page_content for doc in documents]
-        print(f"正在为 {len(texts_to_embed)} 个新文档块生成嵌入...")
-        embeddings = generate_embeddings(texts_to_embed)
-
-        if not embeddings:
+    def _add_embedded(
+        self,
+        documents: List[LangchainDocument],
+        embeddings: np.ndarray,
+        document_id: Optional[str],
+    ) -> int:
+        """把已生成嵌入的文档块写入文档块存储、预写日志和新的索引版本"""
+        if len(embeddings) == 0:
             print("未能为文档块生成嵌入，无法添加到索引。")
             return 0
 
-        np_embeddings = np.array(embeddings, dtype=np.float32)
+        # 嵌入结果已是本次调用独占的 float32 数组，直接使用并原地归一化，不再复制
+        np_embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.metric == METRIC_COSINE:
+            np_embeddings = normalize_vectors(np_embeddings, inplace=True)
 
         try:
-            self.index.add(np_embeddings)
-            self.document_chunks.extend(documents)  # 保存原始文档块及其元数据
-            print(
-                f"{len(documents)} 个文档块及其嵌入已成功添加到 FAISS 索引。当前索引大小: {self.index.ntotal}"
-            )
-            self.save_index()  # 添加文档后立即保存
+            with self._write_lock:
+                chunk_ids = np.arange(
+                    self._next_chunk_id,
+                    self._next_chunk_id + len(documents),
+                    dtype=np.int64,
+                )
+                # 先保存原始文档块及其元数据（只追加新行），再写入向量
+                if document_id is not None:
+                    for doc in documents:
+                        doc.metadata["document_id"] = document_id
+                self.chunk_store.add_many(
+                    dict(zip(chunk_ids.tolist(), documents)),
+                    np_embeddings if self.keep_full_precision else None,
+                )
+                self._next_chunk_id += len(documents)
+                # 先追加到预写日志，再发布包含本批向量的新版本，由检查点线程合并进快照
+                self.wal.append_add(chunk_ids, np_embeddings)
+                self._publish(self._generation.with_added(chunk_ids, np_embeddings))
+                self._request_checkpoint_if_needed()
+                print(
+                    f"{len(documents)} 个文档块及其嵌入已成功添加到 FAISS 索引。当前索引大小: {self.get_index_size()}"
+                )
+            self._maybe_schedule_promotion()
             return len(documents)
         except Exception as e:
             print(f"向 FAISS 索引添加嵌入时发生错误: {e}")
             return 0
 
+    def _filter_oversample(self, num_candidates: int, ntotal: int) -> int:
+        """按过滤条件的选择率放大检索范围，保证过滤后仍能凑够 k 个结果"""
+        if num_candidates <= 0:
+            return 1
+        return max(1, min(math.ceil(ntotal / num_candidates), VECTOR_FILTER_MAX_OVERSAMPLE))
+
+    def _search_generation(
+        self,
+        generation: IndexGeneration,
+        query_vectors: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        id_filter: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        在一个索引版本上检索 top-k：base 上排除删除标记，增量向量精确检索，再按距离合并。
+
+        id_filter 非空时只在这些 chunk ID 中检索：支持的索引在检索时按 ID 过滤，
+        并按选择率放大 nprobe / efSearch；不支持的索引放大候选数后事后过滤。
+
+        Returns:
+            (距离, chunk ID) 矩阵，不足 k 个结果的位置为 -1
+        """
+        base = generation.base
+        tombstones = generation.tombstone_array
+        oversample = 1
+        if id_filter is not None:
+            oversample = self._filter_oversample(len(id_filter), generation.ntotal)
+
+        base_k = k
+        # 选择器只保存底层指针，需要在检索期间保持 Python 对象的引用
+        selectors = []
+        if supports_search_selector(base):
+            if id_filter is not None:
+                selectors.append(faiss.IDSelectorBatch(id_filter))
+                if oversample > 1:
+                    nprobe = (nprobe or DEFAULT_NPROBE) * oversample
+                    ef_search = (ef_search or DEFAULT_EF_SEARCH) * oversample
+            if len(tombstones):
+                selectors.append(faiss.IDSelectorBatch(tombstones))
+                selectors.append(faiss.IDSelectorNot(selectors[-1]))
+                if id_filter is not None:
+                    selectors.append(faiss.IDSelectorAnd(selectors[0], selectors[-1]))
+        else:
+            # 不支持检索时过滤的索引多取候选，事后剔除已删除或不满足过滤条件的向量
+            base_k = min(k * oversample + len(tombstones), max(base.ntotal, k))
+        sel = selectors[-1] if selectors else None
+
+        distances = np.empty((len(query_vectors), 0), dtype=np.float32)
+        indices = np.empty((len(query_vectors), 0), dtype=np.int64)
+        metric = get_metric(base)
+        if base.ntotal:
+            distances, indices = base.search(
+                query_vectors,
+                base_k,
+                params=self._search_params(base, base_k, nprobe, ef_search, sel),
+            )
+            if metric == METRIC_COSINE:
+                distances = -distances
+        if generation.delta_count:
+            delta_ids, delta_vectors = generation.delta_ids, generation.delta_vectors
+            if id_filter is not None:
+                in_scope = np.isin(delta_ids, id_filter)
+                delta_ids, delta_vectors = delta_ids[in_scope], delta_vectors[in_scope]
+            if len(delta_ids):
+                delta_k = min(k + len(tombstones), len(delta_ids))
+                delta_distances, rows = exact_knn(
+                    query_vectors, delta_vectors, delta_k, metric
+                )
+                delta_indices = np.where(rows >= 0, delta_ids[rows], -1)
+                distances = np.hstack([distances, delta_distances])
+                indices = np.hstack([indices, delta_indices])
+
+        invalid = indices == -1
+        if len(tombstones):
+            invalid |= np.isin(indices, tombstones)
+        if id_filter is not None:
+            invalid |= ~np.isin(indices, id_filter)
+        return self._top_k(
+            np.where(invalid, np.inf, distances), np.where(invalid, -1, indices), k
+        )
+
+    @staticmethod
+    def _top_k(
+        distances: np.ndarray, indices: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """按距离对每行候选排序并截断为 k 列"""
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1),
+        )
+
+    def _search_exact(
+        self,
+        generation: IndexGeneration,
+        query_vectors: np.ndarray,
+        k: int,
+        id_filter: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        候选集较小时直接取出候选向量精确计算距离，不受近似索引召回率的影响。
+
+        候选不在该版本中时（例如快照之后才写入的文档块）抛出 RuntimeError。
+        """
+        id_filter = id_filter[~np.isin(id_filter, generation.tombstone_array)]
+        in_delta = np.isin(generation.delta_ids, id_filter)
+        delta_ids = generation.delta_ids[in_delta]
+        base_ids = np.setdiff1d(id_filter, delta_ids)
+        ids = np.concatenate([base_ids, delta_ids])
+        vectors = np.concatenate(
+            [
+                generation.base.reconstruct_batch(base_ids)
+                if len(base_ids)
+                else np.empty((0, generation.dimension), dtype=np.float32),
+                generation.delta_vectors[in_delta],
+            ]
+        )
+        if not len(ids):
+            return (
+                np.full((len(query_vectors), 0), np.inf, dtype=np.float32),
+                np.full((len(query_vectors), 0), -1, dtype=np.int64),
+            )
+        distances, rows = exact_knn(
+            query_vectors, vectors, min(k, len(ids)), get_metric(generation.base)
+        )
+        return self._top_k(distances, np.where(rows >= 0, ids[rows], -1), k)
+
+    def _search_hits(
+        self,
+        generation: IndexGeneration,
+        query_vectors: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        id_filter: Optional[np.ndarray] = None,
+        score_threshold: Optional[float] = None,
+    ) -> List[SearchHits]:
+        """
+        对一组查询向量执行一次矩阵检索，返回每个查询命中的 (chunk ID 数组, 分数数组)。
+
+        id_filter 为元数据过滤解析出的 chunk ID；候选不超过 VECTOR_FILTER_EXACT_THRESHOLD
+        时精确计算，否则在索引上按 ID 过滤检索。
+        分数在 cosine 度量下为余弦相似度（越大越相关），l2 度量下为 L2 距离（越小越相关）；
+        score_threshold 按同样的方向丢弃不够相关的结果。
+        """
+        mode = "batch" if len(query_vectors) > 1 else "single"
+        with VECTOR_SEARCH_SECONDS.labels(mode).time():
+            hits = self._search_hits_untimed(
+                generation, query_vectors, k, nprobe, ef_search, id_filter, score_threshold
+            )
+        VECTOR_SEARCH_QUERIES.labels("index").inc(len(query_vectors))
+        return hits
+
+    def _search_hits_untimed(
+        self,
+        generation: IndexGeneration,
+        query_vectors: np.ndarray,
+        k: int,
+        nprobe: Optional[int],
+        ef_search: Optional[int],
+        id_filter: Optional[np.ndarray],
+        score_threshold: Optional[float],
+    ) -> List[SearchHits]:
+        metric = get_metric(generation.base)
+        if metric == METRIC_COSINE:
+            query_vectors = normalize_vectors(query_vectors)
+        rerank = (
+            self.keep_full_precision
+            and get_storage_type(generation.base) != STORAGE_FLOAT32
+        )
+        fetch_k = k * self.rerank_factor if rerank else k
+        if id_filter is not None and len(id_filter) <= VECTOR_FILTER_EXACT_THRESHOLD:
+            try:
+                distances, indices = self._search_exact(
+                    generation, query_vectors, fetch_k, id_filter
+                )
+            except RuntimeError:
+                distances, indices = self._search_generation(
+                    generation, query_vectors, fetch_k, nprobe, ef_search, id_filter
+                )
+        else:
+            distances, indices = self._search_generation(
+                generation, query_vectors, fetch_k, nprobe, ef_search, id_filter
+            )
+
+        hits = []
+        for row in range(len(query_vectors)):
+            hit_ids, hit_distances = indices[row], distances[row]
+            if rerank:
+                hit_ids, hit_distances = self._rerank(
+                    query_vectors[row], hit_ids, hit_distances, k, metric
+                )
+            if score_threshold is not None:
+                max_distance = -score_threshold if metric == METRIC_COSINE else score_threshold
+                in_range = hit_distances <= max_distance
+                hit_ids, hit_distances = hit_ids[in_range], hit_distances[in_range]
+            # faiss 可能返回 -1 如果找不到足够的邻居
+            found = hit_ids != -1
+            scores = hit_distances[found].astype(np.float64)
+            if metric == METRIC_COSINE:
+                scores = -scores
+            hits.append((hit_ids[found].astype(np.int64), scores))
+        return hits
+
+    def _load_hits(self, hits: List[SearchHits]) -> List[List[Tuple[LangchainDocument, float]]]:
+        """按检索命中的 (chunk ID, 分数) 读取文档块，所有查询命中的文档块一次性读取"""
+        hit_chunks = self.chunk_store.get_many(
+            {int(chunk_id) for hit_ids, _ in hits for chunk_id in hit_ids}
+        )
+        results = []
+        for hit_ids, scores in hits:
+            query_results = []
+            for chunk_id, score in zip(hit_ids, scores):
+                doc = hit_chunks.get(int(chunk_id))
+                if doc is not None:
+                    query_results.append((doc, float(score)))
+            results.append(query_results)
+        return results
+
+    def _resolve_filter(self, metadata_filter: Optional[ChunkFilter]) -> Optional[np.ndarray]:
+        """把元数据过滤条件解析为 chunk ID 集合；无过滤条件时返回 None"""
+        if metadata_filter is None or metadata_filter.is_empty():
+            return None
+        return self.chunk_store.filter_chunk_ids(metadata_filter)
+
     def search(
-        self, query_text: str, k: int = TOP_K_RESULTS
+        self,
+        query_text: str,
+        k: int = TOP_K_RESULTS,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        snapshot: Optional[IndexGeneration] = None,
+        metadata_filter: Optional[ChunkFilter] = None,
+        score_threshold: Optional[float] = None,
     ) -> List[Tuple[LangchainDocument, float]]:
-        if self.index is None or self.index.ntotal == 0:
-            print("警告: FAISS 索引为空或未初始化，无法执行搜索。")
+        """
+        检索与查询最相似的文档块，返回 (文档块, 分数) 列表。
+
+        Args:
+            query_text: 查询文本
+            k: 返回结果数量
+            nprobe: IVF 索引探测的聚类数，越大召回越高、延迟越大
+            ef_search: HNSW 索引的候选队列长度，越大召回越高、延迟越大
+            snapshot: 在指定的索引版本上检索，默认使用当前版本
+            metadata_filter: 只在满足条件的文档块中检索（文档、文件类型、页码、写入时间）
+            score_threshold: 相关性阈值；cosine 度量下丢弃相似度低于该值的结果，
+                l2 度量下丢弃距离大于该值的结果
+
+        相同查询（归一化后）、参数和索引版本的检索结果会被缓存，命中时不生成嵌入也不检索索引。
+        """
+        generation = snapshot or self._generation
+        cache_key = self._retrieval_key(
+            query_text, k, nprobe, ef_search, metadata_filter, score_threshold
+        )
+        cached = self._cached_search(generation, cache_key)
+        if cached is not None:
+            return cached
+        id_filter = self._prepare_search(generation, metadata_filter)
+        if id_filter is False:
             return []
 
         print(f"为查询文本生成嵌入: '{query_text[:50]}...'")
-        query_embedding = generate_embeddings([query_text])
-        if not query_embedding:
+        query_embedding = embed_query(query_text)
+        return self._search_embedded(
+            generation,
+            query_embedding,
+            k,
+            nprobe,
+            ef_search,
+            id_filter,
+            score_threshold,
+            cache_key,
+        )
+
+    async def asearch(
+        self,
+        query_text: str,
+        k: int = TOP_K_RESULTS,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        snapshot: Optional[IndexGeneration] = None,
+        metadata_filter: Optional[ChunkFilter] = None,
+        score_threshold: Optional[float] = None,
+        query_embedding: Optional[np.ndarray] = None,
+        trace: Trace = DISABLED_TRACE,
+        check_cache: bool = True,
+    ) -> List[Tuple[LangchainDocument, float]]:
+        """
+        search 的异步版本：查询嵌入通过异步客户端生成，过滤条件解析和 FAISS 检索
+        在线程池中执行，不阻塞事件循环。参数与 search 相同；
+        调用方已生成查询嵌入时通过 query_embedding 传入，不再重复生成；
+        已通过 cached_search 查过检索结果缓存时传入 check_cache=False，结果仍会写入缓存。
+        trace 分别记录查询嵌入（embed）和检索（search，含缓存查找与读取文档块）的耗时。
+        """
+        generation = snapshot or self._generation
+        cache_key = self._retrieval_key(
+            query_text, k, nprobe, ef_search, metadata_filter, score_threshold
+        )
+        with trace.stage(STAGE_SEARCH):
+            if check_cache:
+                cached = await asyncio.to_thread(
+                    self._cached_search, generation, cache_key
+                )
+                if cached is not None:
+                    return cached
+            id_filter = await asyncio.to_thread(
+                self._prepare_search, generation, metadata_filter
+            )
+            if id_filter is False:
+                return []
+
+        if query_embedding is None:
+            print(f"为查询文本异步生成嵌入: '{query_text[:50]}...'")
+            with trace.stage(STAGE_EMBED):
+                query_embedding = await aembed_query(query_text)
+        with trace.stage(STAGE_SEARCH):
+            return await asyncio.to_thread(
+                self._search_embedded,
+                generation,
+                query_embedding,
+                k,
+                nprobe,
+                ef_search,
+                id_filter,
+                score_threshold,
+                cache_key,
+            )
+
+    @staticmethod
+    def _retrieval_key(
+        query_text: str,
+        k: int,
+        nprobe: Optional[int],
+        ef_search: Optional[int],
+        metadata_filter: Optional[ChunkFilter],
+        score_threshold: Optional[float],
+    ) -> tuple:
+        """检索结果缓存键：归一化后的查询文本和所有影响检索结果的参数"""
+        filter_key = (
+            metadata_filter.cache_key()
+            if metadata_filter is not None and not metadata_filter.is_empty()
+            else None
+        )
+        return (normalize_query(query_text), k, nprobe, ef_search, filter_key, score_threshold)
+
+    def cached_search(
+        self,
+        query_text: str,
+        k: int = TOP_K_RESULTS,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        snapshot: Optional[IndexGeneration] = None,
+        metadata_filter: Optional[ChunkFilter] = None,
+        score_threshold: Optional[float] = None,
+    ) -> Optional[List[Tuple[LangchainDocument, float]]]:
+        """只查检索结果缓存，不生成嵌入也不检索索引；参数与 search 相同，未命中时返回 None"""
+        cache_key = self._retrieval_key(
+            query_text, k, nprobe, ef_search, metadata_filter, score_threshold
+        )
+        return self._cached_search(snapshot or self._generation, cache_key)
+
+    def _cached_search(
+        self, generation: Optional[IndexGeneration], cache_key: tuple
+    ) -> Optional[List[Tuple[LangchainDocument, float]]]:
+        """在检索结果缓存中查找，命中时读取文档块返回，未命中时返回 None"""
+        if generation is None:
+            return None
+        hits = self.retrieval_cache.get(generation.number, cache_key)
+        if hits is None:
+            return None
+        VECTOR_SEARCH_QUERIES.labels("cache").inc()
+        print(f"检索结果缓存命中，跳过查询嵌入和 FAISS 检索，共 {len(hits[0])} 个结果。")
+        return self._load_hits([hits])[0]
+
+    def _prepare_search(
+        self,
+        generation: Optional[IndexGeneration],
+        metadata_filter: Optional[ChunkFilter],
+    ):
+        """
+        检查索引版本并解析过滤条件。
+
+        Returns:
+            过滤后的 chunk ID（无过滤条件时为 None）；索引为空或没有满足条件的文档块时返回 False
+        """
+        if generation is None or generation.ntotal == 0:
+            print("警告: FAISS 索引为空或未初始化，无法执行搜索。")
+            return False
+        id_filter = self._resolve_filter(metadata_filter)
+        if id_filter is not None and not len(id_filter):
+            print("没有满足过滤条件的文档块。")
+            return False
+        return id_filter
+
+    def _search_embedded(
+        self,
+        generation: IndexGeneration,
+        query_embedding: Optional[np.ndarray],
+        k: int,
+        nprobe: Optional[int],
+        ef_search: Optional[int],
+        id_filter: Optional[np.ndarray],
+        score_threshold: Optional[float],
+        cache_key: Optional[tuple] = None,
+    ) -> List[Tuple[LangchainDocument, float]]:
+        """用已生成的查询嵌入检索单个查询；提供 cache_key 时把检索命中写入缓存"""
+        if query_embedding is None:
             print("未能为查询文本生成嵌入，无法执行搜索。")
             return []
 
-        np_query_embedding = np.array(query_embedding, dtype=np.float32)
+        np_query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
 
         try:
             print(f"在 FAISS 索引中搜索 top-{k} 个相似结果...")
-            distances, indices = self.index.search(np_query_embedding, k)
-
-            results = []
-            for i in range(len(indices[0])):
-                idx = indices[0][i]
-                dist = distances[0][i]
-                if idx != -1 and idx < len(
-                    self.document_chunks
-                ):  # faiss 可能返回 -1 如果找不到足够的邻居
-                    results.append((self.document_chunks[idx], float(dist)))
-
+            hits = self._search_hits(
+                generation,
+                np_query_embedding,
+                k,
+                nprobe,
+                ef_search,
+                id_filter,
+                score_threshold,
+            )[0]
+            if cache_key is not None:
+                self.retrieval_cache.put(generation.number, cache_key, hits)
+            results = self._load_hits([hits])[0]
             print(f"找到 {len(results)} 个结果。")
             return results
         except Exception as e:
             print(f"在 FAISS 索引中搜索时发生错误: {e}")
             return []
 
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = TOP_K_RESULTS,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        snapshot: Optional[IndexGeneration] = None,
+        metadata_filter: Optional[ChunkFilter] = None,
+        score_threshold: Optional[float] = None,
+    ) -> List[List[Tuple[LangchainDocument, float]]]:
+        """
+        批量检索：所有查询一次生成嵌入，并在索引上执行一次矩阵检索。
+        命中检索结果缓存的查询不再生成嵌入和检索。
+
+        Returns:
+            与 queries 顺序一致的结果列表，每项为该查询的 (文档块, 分数) 列表
+        """
+        if not queries:
+            return []
+        generation = snapshot or self._generation
+        cache_keys = [
+            self._retrieval_key(query, k, nprobe, ef_search, metadata_filter, score_threshold)
+            for query in queries
+        ]
+        hits: Dict[int, SearchHits] = {}
+        if generation is not None:
+            for row, cache_key in enumerate(cache_keys):
+                cached = self.retrieval_cache.get(generation.number, cache_key)
+                if cached is not None:
+                    hits[row] = cached
+        pending_rows = [row for row in range(len(queries)) if row not in hits]
+        if hits:
+            VECTOR_SEARCH_QUERIES.labels("cache").inc(len(hits))
+            print(f"{len(hits)} 个查询命中检索结果缓存。")
+
+        if pending_rows:
+            id_filter = self._prepare_search(generation, metadata_filter)
+            if id_filter is False:
+                return [[] for _ in queries]
+
+            print(f"为 {len(pending_rows)} 个查询批量生成嵌入...")
+            query_embeddings = embed_queries([queries[row] for row in pending_rows])
+            # 只检索成功生成嵌入的查询，失败的查询返回空结果
+            embedded = [
+                (row, vector)
+                for row, vector in zip(pending_rows, query_embeddings)
+                if vector is not None
+            ]
+            if len(embedded) != len(pending_rows):
+                print(f"{len(pending_rows) - len(embedded)} 个查询未能生成嵌入，返回空结果。")
+
+            if embedded:
+                np_query_embeddings = np.stack([vector for _, vector in embedded])
+                try:
+                    print(f"在 FAISS 索引中批量搜索 {len(embedded)} 个查询的 top-{k} 结果...")
+                    searched = self._search_hits(
+                        generation,
+                        np_query_embeddings,
+                        k,
+                        nprobe,
+                        ef_search,
+                        id_filter,
+                        score_threshold,
+                    )
+                except Exception as e:
+                    print(f"在 FAISS 索引中批量搜索时发生错误: {e}")
+                    return [[] for _ in queries]
+                for (row, _), query_hits in zip(embedded, searched):
+                    self.retrieval_cache.put(generation.number, cache_keys[row], query_hits)
+                    hits[row] = query_hits
+
+        rows = sorted(hits)
+        results: List[List[Tuple[LangchainDocument, float]]] = [[] for _ in queries]
+        for row, query_results in zip(rows, self._load_hits([hits[row] for row in rows])):
+            results[row] = query_results
+        return results
+
+    def remove_document(self, document_id: str) -> int:
+        """
+        删除指定文档的全部向量与元数据，返回删除的文档块数量。
+
+        仅追加删除标记并发布新版本，向量由检查点在后台从索引中移除；
+        不需要重新加载、切分或嵌入其它文档。
+        """
+        with self._write_lock:
+            pending = self.retry_queue.remove_document(document_id)
+            if pending:
+                print(f"已从重试队列删除文档 {document_id} 的 {pending} 个文档块。")
+            chunk_ids = self.chunk_store.document_chunk_ids(document_id)
+            if not chunk_ids or self._generation is None:
+                return 0
+            self.wal.append_remove(np.array(chunk_ids, dtype=np.int64))
+            self._publish(self._generation.with_removed(chunk_ids))
+            self._request_checkpoint_if_needed()
+            self.chunk_store.delete_many(chunk_ids)
+        print(
+            f"已从 FAISS 索引删除文档 {document_id} 的 {len(chunk_ids)} 个文档块。当前索引大小: {self.get_index_size()}"
+        )
+        return len(chunk_ids)
+
+    def migrate_metric(self, metric: str) -> int:
+        """
+        把现有索引离线迁移到指定的距离度量，返回迁移的向量数。
+
+        迁移到 cosine 时，索引中的向量和全精度副本都会先归一化，再按原有的索引类型和
+        存储精度重建；应在服务停止时执行。
+        """
+        if metric not in SUPPORTED_METRICS:
+            raise ValueError(f"不支持的距离度量: {metric}")
+        with self._checkpoint_lock:
+            # 先把增量与删除合并进 base，迁移只需处理一份完整的向量
+            self.save_index()
+            with self._write_lock:
+                generation = self._generation
+                base = generation.base
+                if get_metric(base) == metric:
+                    print(f"索引已使用 {metric} 度量，无需迁移。")
+                    return 0
+                ids, vectors = self._export_live_vectors(generation)
+                if metric == METRIC_COSINE:
+                    vectors = normalize_vectors(vectors)
+                    if self.keep_full_precision:
+                        self.chunk_store.update_vectors(ids, vectors)
+                print(f"正在把 {len(ids)} 个向量从 {get_metric(base)} 迁移到 {metric} 度量...")
+                new_base = build_ann_index(
+                    get_index_type(base), vectors, ids, get_storage_type(base), metric
+                )
+                self._publish(IndexGeneration(generation.number + 1, new_base))
+            self.save_index()
+        self.configured_metric = metric
+        return len(ids)
+
     def reset_index(self):
-        """清空索引和元数据，并重新初始化为空索引。"""
+        """清空索引和元数据，并发布一个空索引版本；进行中的查询继续使用旧版本完成。"""
         print("正在重置 FAISS 索引...")
-        if os.path.exists(self.index_file):
-            os.remove(self.index_file)
-        if os.path.exists(self.metadata_file):
-            os.remove(self.metadata_file)
-        self._initialize_empty_index()
+        with self._checkpoint_lock, self._write_lock:
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
+            if os.path.exists(self.metadata_file):
+                os.remove(self.metadata_file)
+            self._initialize_empty_index()
+            self.chunk_store.clear()
+            self.wal.clear()
+            self._next_chunk_id = 0
+            self.save_index()
+            self.retry_queue.clear()
         print("FAISS 索引已重置。")
 
     def get_index_size(self) -> int:
-        return self.index.ntotal if self.index else 0
+        generation = self._generation
+        return generation.ntotal if generation is not None else 0
+
+    def compression_report(self, k: int = TOP_K_RESULTS) -> dict:
+        """
+        统计当前索引相对 float32 flat 基线节省的内存，以及 recall@k 的变化。
+
+        基线由全精度向量构建精确 flat 索引；查询样本取自已入库的向量。
+        """
+        if k < 1:
+            raise ValueError(f"k 必须大于等于 1: {k}")
+        # 只统计已合并的基础索引；base 发布后不再修改，无需加锁
+        index = self.index
+        if index is None or index.ntotal == 0:
+            return {"ntotal": 0}
+        ids, vectors = self._export_full_vectors(index)
+        ntotal, dimension = vectors.shape
+
+        index_bytes = int(faiss.serialize_index(index).nbytes)
+        baseline_bytes = ntotal * dimension * 4 + ntotal * 8  # 向量 + ID 映射
+        report = {
+            "ntotal": ntotal,
+            "index_type": get_index_type(index),
+            "storage": get_storage_type(index),
+            "index_bytes": index_bytes,
+            "flat_baseline_bytes": baseline_bytes,
+            "memory_saved_bytes": baseline_bytes - index_bytes,
+            "compression_ratio": round(baseline_bytes / max(index_bytes, 1), 2),
+            "full_precision_on_disk_bytes": (
+                ntotal * dimension * 4 if self.keep_full_precision else 0
+            ),
+        }
+
+        k = min(k, ntotal)
+        rng = np.random.default_rng(0)
+        sample = rng.choice(ntotal, min(REPORT_SAMPLE_QUERIES, ntotal), replace=False)
+        queries = vectors[sample]
+        metric = get_metric(index)
+        baseline = _flat_index(dimension, metric)
+        baseline.add(vectors)
+        _, truth_rows = baseline.search(queries, k)
+        truth = ids[truth_rows]
+
+        def recall(found: np.ndarray) -> float:
+            hits = sum(
+                len(set(truth[i].tolist()) & set(found[i].tolist()))
+                for i in range(len(queries))
+            )
+            return hits / (len(queries) * k)
+
+        # 精确基线的 recall 为 1.0，delta 即压缩/近似检索带来的召回损失
+        _, approx = index.search(
+            queries, k, params=self._search_params(index, k, None, None)
+        )
+        report[f"recall@{k}"] = round(recall(approx), 4)
+        report[f"recall@{k}_delta"] = round(report[f"recall@{k}"] - 1.0, 4)
+
+        if self.keep_full_precision:
+            fetch_k = min(k * self.rerank_factor, ntotal)
+            distances, candidates = index.search(
+                queries, fetch_k, params=self._search_params(index, fetch_k, None, None)
+            )
+            if metric == METRIC_COSINE:
+                distances = -distances
+            reranked = np.full((len(queries), k), -1, dtype=np.int64)
+            for i in range(len(queries)):
+                top_ids, _ = self._rerank(
+                    queries[i], candidates[i], distances[i], k, metric
+                )
+                reranked[i, : len(top_ids)] = top_ids
+            report[f"recall@{k}_reranked"] = round(recall(reranked), 4)
+            report[f"recall@{k}_reranked_delta"] = round(
+                report[f"recall@{k}_reranked"] - 1.0, 4
+            )
+        return report
 
 
 # 全局向量存储实例 (单例模式)
 # 这样应用各处都可以通过 get_vector_store() 获取同一个实例
 _vector_store_instance: Optional[FAISSVectorStore] = None
+# 导出指标时读取，未初始化的向量存储不会因此被创建
+VECTOR_STORE_NTOTAL.set_function(
+    lambda: _vector_store_instance.get_index_size() if _vector_store_instance is not None else 0
+)
 
 
 def get_vector_store() -> FAISSVectorStore:
@@ -225,5 +1702,11 @@ def get_vector_store() -> FAISSVectorStore:
     return _vector_store_instance
 
 
+def close_vector_store():
+    """应用关闭时调用：停止后台检查点并把未合并的变更写入快照"""
+    if _vector_store_instance is not None:
+        _vector_store_instance.close()
+
+
 # 可以在模块加载时尝试初始化，以便尽早发现问题
 # get_vector_store()
@@ -0,0 +1,77 @@
+from langchain_core.documents import Document as LangchainDocument
+from services.context_packer import CONTEXT_SEPARATOR, count_tokens, pack_context
+
+
+def _chunk(text, start=None, page=0, source="a.txt"):
+    metadata = {"source": source, "page": page}
+    if start is not None:
+        metadata["start_index"] = start
+    return LangchainDocument(page_content=text, metadata=metadata)
+
+
+def test_merges_overlapping_chunks_into_original_text():
+    source = "First sentence here. Second sentence there. Third one ends it."
+    packed = pack_context(
+        "query", [_chunk(source[20:], 20), _chunk(source[:30], 0)], token_budget=0
+    )
+    assert packed.text == source
+    assert packed.segments == 1
+    assert packed.chunks == 2
+
+
+def test_merges_touching_chunks_without_dropping_text():
+    packed = pack_context("query", [_chunk("abc", 0), _chunk("cde", 3)], token_budget=0)
+    assert packed.text == "abccde"
+    assert packed.segments == 1
+
+
+def test_does_not_merge_across_pages():
+    packed = pack_context(
+        "query",
+        [_chunk("page one text", 0, page=1), _chunk("page two text", 0, page=2)],
+        token_budget=0,
+    )
+    assert packed.text == CONTEXT_SEPARATOR.join(["page one text", "page two text"])
+    assert packed.segments == 2
+
+
+def test_keeps_text_when_offsets_do_not_verify():
+    # 偏移量显示有重叠，但文本对不上：不按字符猜测，两段原文都保留
+    packed = pack_context("query", [_chunk("abc", 0), _chunk("xyz", 2)], token_budget=0)
+    assert packed.text == "abcxyz"
+
+    # 偏移量之间有空隙：即使首尾字符相同也不合并
+    packed = pack_context("query", [_chunk("abc", 0), _chunk("cde", 10)], token_budget=0)
+    assert packed.text == CONTEXT_SEPARATOR.join(["abc", "cde"])
+
+
+def test_drops_exact_duplicate_segments():
+    packed = pack_context(
+        "query",
+        [_chunk("same text"), _chunk("other text"), _chunk("same text", source="b.txt")],
+        token_budget=0,
+    )
+    assert packed.text == CONTEXT_SEPARATOR.join(["same text", "other text"])
+    assert packed.segments == 2
+    assert packed.chunks == 3
+
+
+def test_prunes_sentences_with_least_query_overlap():
+    text = "Apple pie is sweet. The weather is cold. Bananas are yellow."
+    budget = count_tokens("Apple pie is sweet.")
+    packed = pack_context("apple", [_chunk(text)], token_budget=budget)
+    assert packed.text == "Apple pie is sweet."
+    assert packed.pruned_sentences == 2
+    assert packed.tokens_after == budget
+    assert packed.tokens_saved == packed.tokens_before - budget
+
+
+def test_pruning_everything_leaves_zero_tokens():
+    packed = pack_context(
+        "unrelated",
+        [_chunk("First segment sentence."), _chunk("Second segment sentence.")],
+        token_budget=1,
+    )
+    assert packed.text == ""
+    assert packed.segments == 0
+    assert packed.tokens_after == 0
@@ -0,0 +1,81 @@
+import numpy as np
+from services.index_wal import OP_ADD, OP_REMOVE, IndexWriteAheadLog
+
+
+def _vectors(ids, dimension=4):
+    return np.stack([np.full(dimension, i, dtype=np.float32) for i in ids])
+
+
+def _replayed(wal):
+    return [(op, ids.tolist()) for op, ids, _ in wal.replay()]
+
+
+def test_replay_returns_records_in_order(tmp_path):
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    wal.append_add(np.array([0, 1]), _vectors([0, 1]))
+    wal.append_remove(np.array([0]))
+
+    records = list(wal.replay())
+    assert [(op, ids.tolist()) for op, ids, _ in records] == [
+        (OP_ADD, [0, 1]),
+        (OP_REMOVE, [0]),
+    ]
+    np.testing.assert_array_equal(records[0][2], _vectors([0, 1]))
+    assert records[1][2] is None
+    wal.close()
+
+
+def test_replay_truncates_torn_tail(tmp_path):
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    wal.append_add(np.array([0]), _vectors([0]))
+    valid_size = wal.size()
+    wal.append_add(np.array([1]), _vectors([1]))
+    wal.close()
+    # 模拟写入第二条记录时崩溃：只留下一部分字节
+    with open(wal.wal_file, "r+b") as f:
+        f.truncate(valid_size + 10)
+
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    assert _replayed(wal) == [(OP_ADD, [0])]
+    assert wal.size() == valid_size
+
+    # 截断后继续追加的记录可以正常重放
+    wal.append_add(np.array([2]), _vectors([2]))
+    assert _replayed(wal) == [(OP_ADD, [0]), (OP_ADD, [2])]
+    wal.close()
+
+
+def test_replay_truncates_tail_with_bad_crc(tmp_path):
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    wal.append_add(np.array([0]), _vectors([0]))
+    valid_size = wal.size()
+    wal.append_add(np.array([1]), _vectors([1]))
+    wal.close()
+    with open(wal.wal_file, "r+b") as f:
+        f.seek(-1, 2)
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    assert _replayed(wal) == [(OP_ADD, [0])]
+    assert wal.size() == valid_size
+    wal.close()
+
+
+def test_discard_prefix_keeps_records_after_offset(tmp_path):
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    wal.append_add(np.array([0]), _vectors([0]))
+    checkpoint_offset = wal.size()
+    # 检查点记下偏移量之后写入方继续追加
+    wal.append_add(np.array([1]), _vectors([1]))
+    wal.append_remove(np.array([0]))
+
+    wal.discard_prefix(checkpoint_offset)
+    assert _replayed(wal) == [(OP_ADD, [1]), (OP_REMOVE, [0])]
+
+    wal.append_add(np.array([2]), _vectors([2]))
+    wal.close()
+    wal = IndexWriteAheadLog(str(tmp_path / "idx"))
+    assert _replayed(wal) == [(OP_ADD, [1]), (OP_REMOVE, [0]), (OP_ADD, [2])]
+    wal.close()
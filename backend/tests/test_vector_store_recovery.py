@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pytest
+import services.vector_store as vector_store
+from services.vector_store import FAISSVectorStore, LangchainDocument
+
+DIMENSION = 8
+
+
+@pytest.fixture(autouse=True)
+def _no_background_checkpoints(monkeypatch):
+    """固定嵌入维度，并让后台检查点只在测试显式调用时发生"""
+    monkeypatch.setattr(vector_store, "get_embedding_dimension", lambda: DIMENSION)
+    monkeypatch.setattr(vector_store, "VECTOR_CHECKPOINT_INTERVAL_SECONDS", 3600)
+    monkeypatch.setattr(vector_store, "VECTOR_WAL_CHECKPOINT_BYTES", 1 << 40)
+
+
+def _open(tmp_path) -> FAISSVectorStore:
+    return FAISSVectorStore(
+        str(tmp_path / "idx"), index_type="flat", storage="float32", metric="l2"
+    )
+
+
+def _add(store: FAISSVectorStore, start: int, count: int):
+    documents = [
+        LangchainDocument(page_content=f"chunk {i}", metadata={"source": "a.txt"})
+        for i in range(start, start + count)
+    ]
+    embeddings = np.stack(
+        [np.full(DIMENSION, i, dtype=np.float32) for i in range(start, start + count)]
+    )
+    assert store._add_embedded(documents, embeddings, "a.txt") == count
+
+
+def _crash(store: FAISSVectorStore):
+    """模拟进程崩溃：停止后台线程，不写入快照"""
+    store._stop_event.set()
+    store._checkpoint_requested.set()
+    store._checkpoint_thread.join()
+    store.wal.close()
+
+
+def _live_ids(store: FAISSVectorStore):
+    ids, vectors = store._export_live_vectors(store.snapshot())
+    for chunk_id, vector in zip(ids.tolist(), vectors):
+        np.testing.assert_array_equal(vector, np.full(DIMENSION, chunk_id))
+    return sorted(ids.tolist())
+
+
+def test_replays_wal_on_top_of_snapshot(tmp_path):
+    store = _open(tmp_path)
+    _add(store, 0, 3)
+    store.save_index()
+    _add(store, 3, 2)
+    _crash(store)
+
+    store = _open(tmp_path)
+    assert _live_ids(store) == [0, 1, 2, 3, 4]
+    assert len(store.chunk_store) == 5
+    _add(store, 5, 1)
+    assert _live_ids(store) == list(range(6))
+    store.close()
+
+
+def test_recovers_writes_made_before_any_snapshot(tmp_path):
+    store = _open(tmp_path)
+    _add(store, 0, 4)
+    _crash(store)
+    # 首个包含这些向量的快照写入之前崩溃
+    os.remove(store.index_file)
+
+    store = _open(tmp_path)
+    assert _live_ids(store) == [0, 1, 2, 3]
+    assert store.chunk_store.get(2).page_content == "chunk 2"
+    assert os.path.exists(store.index_file)
+    store.close()
+
+
+def test_checkpoint_keeps_records_appended_during_merge(tmp_path):
+    store = _open(tmp_path)
+    _add(store, 0, 3)
+    merge_pending = store._merge_pending
+
+    def merge_while_writing(source):
+        # 合并在锁外进行，期间写入方继续追加到预写日志
+        _add(store, 3, 2)
+        return merge_pending(source)
+
+    store._merge_pending = merge_while_writing
+    store.save_index()
+    del store._merge_pending
+
+    assert store.wal.size() > 0
+    assert _live_ids(store) == [0, 1, 2, 3, 4]
+    _crash(store)
+
+    store = _open(tmp_path)
+    assert _live_ids(store) == [0, 1, 2, 3, 4]
+    store.close()
+
+
+def test_failed_load_does_not_clear_persisted_data(tmp_path, monkeypatch):
+    store = _open(tmp_path)
+    _add(store, 0, 3)
+    store.save_index()
+    _add(store, 3, 2)
+    _crash(store)
+
+    read_index = vector_store.faiss.read_index
+
+    def broken_read_index(*args, **kwargs):
+        raise RuntimeError("simulated read failure")
+
+    monkeypatch.setattr(vector_store.faiss, "read_index", broken_read_index)
+    with pytest.raises(RuntimeError):
+        _open(tmp_path)
+
+    monkeypatch.setattr(vector_store.faiss, "read_index", read_index)
+    store = _open(tmp_path)
+    assert _live_ids(store) == [0, 1, 2, 3, 4]
+    assert len(store.chunk_store) == 5
+    store.close()
+
+
+def test_reset_index_clears_persisted_data(tmp_path):
+    store = _open(tmp_path)
+    _add(store, 0, 3)
+    store.reset_index()
+    _crash(store)
+
+    store = _open(tmp_path)
+    assert _live_ids(store) == []
+    assert len(store.chunk_store) == 0
+    store.close()